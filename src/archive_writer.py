@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import shutil
+import zlib
+from zipfile import ZIP_DEFLATED, ZipFile
+
+JOURNAL_FILE_NAME = "journal.jsonl"
+
+
+def get_journal_dir(output_archive_path: str) -> str:
+    return f"{output_archive_path}.partial"
+
+
+def _crc32_of_file(path: str) -> int:
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _read_journal(journal_dir: str) -> tuple[list[str] | None, dict[int, dict]]:
+    """
+    Returns the source names from the journal's header and the last record of each entry.
+    Lines that can't be parsed (e.g. cut off by a crash) are ignored.
+    """
+    journal_path = os.path.join(journal_dir, JOURNAL_FILE_NAME)
+    if not os.path.isfile(journal_path):
+        return None, {}
+
+    sources: list[str] | None = None
+    records: dict[int, dict] = {}
+    with open(journal_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "sources" in record:
+                sources = record["sources"]
+            elif "index" in record:
+                records[record["index"]] = record
+    return sources, records
+
+
+def _is_valid_record(journal_dir: str, record: dict) -> bool:
+    if record["file"] is None:
+        return True
+
+    path = os.path.join(journal_dir, record["file"])
+    return (
+        os.path.isfile(path)
+        and os.path.getsize(path) == record["size"]
+        and _crc32_of_file(path) == record["crc32"]
+    )
+
+
+def prepare_journal(output_archive_path: str, source_names: list[str]) -> set[int]:
+    """
+    Opens the journal of the given output archive, or starts a new one, and returns the
+    indexes of the entries that were already finished by an earlier run.
+
+    Every finished entry is validated against its recorded size and CRC32. A journal
+    that was written for an archive with different entries is discarded.
+    """
+    journal_dir = get_journal_dir(output_archive_path)
+    sources, records = _read_journal(journal_dir)
+
+    if sources != source_names:
+        shutil.rmtree(journal_dir, ignore_errors=True)
+        os.makedirs(journal_dir)
+        with open(
+            os.path.join(journal_dir, JOURNAL_FILE_NAME), "w", encoding="utf-8"
+        ) as f:
+            f.write(json.dumps({"sources": source_names}) + "\n")
+        return set()
+
+    return {
+        index
+        for index, record in records.items()
+        if _is_valid_record(journal_dir, record)
+    }
+
+
+class ZipArchiveWriter:
+    """
+    Writes the entries of an output archive directly into a temporary zip file, which
+    replaces the output archive once it is finalized. Until then, an existing output
+    archive stays intact and readable.
+    """
+
+    def __init__(self, output_archive_path: str) -> None:
+        self.output_archive_path: str = output_archive_path
+        self._tmp_path = f"{output_archive_path}.tmp"
+        self._zip = ZipFile(self._tmp_path, "w", ZIP_DEFLATED)
+
+    def write(self, index: int, name: str, data: bytes | None) -> None:
+        if data is not None:
+            self._zip.writestr(name, data)
+
+    def finalize(self) -> None:
+        self._zip.close()
+        os.replace(self._tmp_path, self.output_archive_path)
+
+    def close(self) -> None:
+        # the unfinished zip is discarded, the output archive stays as it was
+        self._zip.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._tmp_path)
+
+
+class JournaledArchiveWriter:
+    """
+    Writes the entries of an output archive into its journal (see `prepare_journal`).
+
+    Each entry is stored as a separate file next to the output archive and recorded in the
+    journal once it is complete, so an interrupted archive can be resumed by a later run.
+    `finalize` builds the zip from all journaled entries in archive order and moves it into
+    place atomically, the journal is removed afterwards.
+    """
+
+    def __init__(self, output_archive_path: str) -> None:
+        self.output_archive_path: str = output_archive_path
+        self._journal_dir = get_journal_dir(output_archive_path)
+        self._journal_path = os.path.join(self._journal_dir, JOURNAL_FILE_NAME)
+
+    def write(self, index: int, name: str, data: bytes | None) -> None:
+        record = {"index": index, "name": name, "file": None, "size": 0, "crc32": 0}
+        if data is not None:
+            file_name = f"{index:06d}.page"
+            path = os.path.join(self._journal_dir, file_name)
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.tmp", path)
+            record.update(file=file_name, size=len(data), crc32=zlib.crc32(data))
+
+        # the record is complete on disk once the file is closed
+        with open(self._journal_path, "a", encoding="utf-8") as journal:
+            journal.write(json.dumps(record) + "\n")
+
+    def finalize(self) -> None:
+        sources, records = _read_journal(self._journal_dir)
+        assert sources is not None
+        missing = [i for i in range(len(sources)) if i not in records]
+        if missing:
+            raise RuntimeError(
+                f"{len(missing)} entries of {self.output_archive_path} are missing from its journal"
+            )
+
+        tmp_path = f"{self.output_archive_path}.tmp"
+        with ZipFile(tmp_path, "w", ZIP_DEFLATED) as output_zip:
+            for index in range(len(sources)):
+                record = records[index]
+                if record["file"] is None:
+                    continue
+
+                with open(os.path.join(self._journal_dir, record["file"]), "rb") as f:
+                    data = f.read()
+                if len(data) != record["size"] or zlib.crc32(data) != record["crc32"]:
+                    raise RuntimeError(
+                        f"journaled entry {record['name']} of {self.output_archive_path} is corrupted"
+                    )
+                output_zip.writestr(record["name"], data)
+
+        os.replace(tmp_path, self.output_archive_path)
+        shutil.rmtree(self._journal_dir, ignore_errors=True)
+
+    def close(self) -> None:
+        # keep the journal, the next run picks it up
+        pass
+
+
+ArchiveWriter = ZipArchiveWriter | JournaledArchiveWriter
+
+
+def open_archive_writer(output_archive_path: str, resume: bool) -> ArchiveWriter:
+    if resume:
+        return JournaledArchiveWriter(output_archive_path)
+    return ZipArchiveWriter(output_archive_path)
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from collections import deque
+from collections.abc import Callable
+from queue import Empty
+from threading import Condition, Lock
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class ByteBudgetQueue(Generic[T]):
+    """
+    A FIFO queue for threads whose capacity is a memory budget instead of an item count.
+
+    `put` blocks while the item would push the bytes in the queue above `max_bytes`, or
+    while the queue already holds `max_items` items (0 means no item limit). The size of
+    each item is computed with `size_of`. An item larger than `max_bytes` is still
+    accepted, but only once the queue is empty.
+
+    This lets small items be prefetched deeply while large ones are throttled.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        size_of: Callable[[T], int],
+        max_items: int = 0,
+    ) -> None:
+        self.max_bytes: int = max_bytes
+        self.max_items: int = max_items
+        self._size_of = size_of
+        self._items: deque[tuple[T, int]] = deque()
+        self._bytes: int = 0
+
+        lock = Lock()
+        self._not_empty = Condition(lock)
+        self._not_full = Condition(lock)
+
+    @property
+    def queued_bytes(self) -> int:
+        with self._not_empty:
+            return self._bytes
+
+    def qsize(self) -> int:
+        with self._not_empty:
+            return len(self._items)
+
+    def put(self, item: T) -> None:
+        nbytes = self._size_of(item)
+        with self._not_full:
+            while not self._can_admit(nbytes):
+                self._not_full.wait()
+
+            self._items.append((item, nbytes))
+            self._bytes += nbytes
+            self._not_empty.notify()
+
+    def get(self, timeout: float | None = None) -> T:
+        """
+        Removes and returns the oldest item. Raises `queue.Empty` if no item arrived
+        within `timeout` seconds (`None` waits forever).
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._items, timeout):
+                raise Empty
+
+            item, nbytes = self._items.popleft()
+            self._bytes -= nbytes
+            self._not_full.notify_all()
+            return item
+
+    def _can_admit(self, nbytes: int) -> bool:
+        if not self._items:
+            return True
+        if self.max_items > 0 and len(self._items) >= self.max_items:
+            return False
+        return self._bytes + nbytes <= self.max_bytes
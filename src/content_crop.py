@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+import numpy as np
+from nodes.impl.upscale.disk_canvas import allocate_canvas, is_on_disk
+
+# pixels kept around the content, so the model sees some of the margin at the edges of the
+# content and the seam to the filled margin isn't visible
+CONTENT_CROP_PADDING = 16
+
+# pages are only cropped if this fraction of their pixels can be skipped at least
+MIN_CROPPED_FRACTION = 0.05
+
+
+@dataclass(frozen=True)
+class ContentCrop:
+    """
+    The content box of a page that was cropped before upscaling: the box is at `x`, `y`
+    with size `width` x `height` in the page of size `page_width` x `page_height`, and the
+    margins around it have the color `border_color` (normalized to 0-1, one value per
+    channel).
+    """
+
+    x: int
+    y: int
+    width: int
+    height: int
+    page_width: int
+    page_height: int
+    border_color: tuple[float, ...]
+
+
+def crop_to_content(
+    image: np.ndarray, threshold: float
+) -> tuple[np.ndarray, ContentCrop | None]:
+    """
+    Crops a normalized image to its content, padded by `CONTENT_CROP_PADDING`.
+
+    The border color is the median of the four corner pixels, and every pixel that differs
+    from it by more than `threshold` (0-1) in any channel is content. Returns the image
+    unchanged and `None` if there is no border to crop, or if it is too thin to be worth it.
+    """
+    h, w = image.shape[:2]
+    pixels = image.reshape(h, w, -1)
+
+    corners = pixels[[0, 0, -1, -1], [0, -1, 0, -1]]
+    border_color = np.median(corners, axis=0)
+
+    content = np.any(np.abs(pixels - border_color) > threshold, axis=2)
+    rows = np.flatnonzero(content.any(axis=1))
+    if len(rows) == 0:
+        # a blank page, it is left to the uniform tile fill
+        return image, None
+    cols = np.flatnonzero(content.any(axis=0))
+
+    top = max(0, int(rows[0]) - CONTENT_CROP_PADDING)
+    bottom = min(h, int(rows[-1]) + 1 + CONTENT_CROP_PADDING)
+    left = max(0, int(cols[0]) - CONTENT_CROP_PADDING)
+    right = min(w, int(cols[-1]) + 1 + CONTENT_CROP_PADDING)
+
+    if (bottom - top) * (right - left) > h * w * (1 - MIN_CROPPED_FRACTION):
+        return image, None
+
+    crop = ContentCrop(
+        x=left,
+        y=top,
+        width=right - left,
+        height=bottom - top,
+        page_width=w,
+        page_height=h,
+        border_color=tuple(float(v) for v in border_color),
+    )
+    return np.ascontiguousarray(image[top:bottom, left:right]), crop
+
+
+def uncrop(image: np.ndarray, crop: ContentCrop) -> np.ndarray:
+    """
+    Places the upscaled content of a cropped page on a canvas of the upscaled page size
+    filled with the border color.
+
+    The scale is taken from the size of the upscaled content. uint8 images are in the range
+    0-255, all others in the range 0-1.
+    """
+    h, w = image.shape[:2]
+    scale_y = h / crop.height
+    scale_x = w / crop.width
+    y = round(crop.y * scale_y)
+    x = round(crop.x * scale_x)
+    page_h = max(y + h, round(crop.page_height * scale_y))
+    page_w = max(x + w, round(crop.page_width * scale_x))
+
+    color = np.array(crop.border_color)
+    if image.dtype == np.uint8:
+        color = np.round(color * 255)
+    color = color[0] if image.ndim == 2 else color[: image.shape[2]]
+
+    # pages assembled on disk stay there
+    canvas = allocate_canvas(
+        (page_h, page_w, *image.shape[2:]), image.dtype, on_disk=is_on_disk(image)
+    )
+    canvas[...] = color
+    canvas[y : y + h, x : x + w] = image
+    return canvas
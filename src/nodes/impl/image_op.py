@@ -15,8 +15,17 @@ The given image is guaranteed to *not* be modified.
 def clipped(op: ImageOp) -> ImageOp:
     """
     Ensures that all values in the returned image are between 0 and 1.
+
+    Integer images (e.g. quantized uint8 results) are always in range and returned as is.
     """
-    return lambda i: np.clip(op(i), 0, 1)
+
+    def inner(i: np.ndarray) -> np.ndarray:
+        r = op(i)
+        if np.issubdtype(r.dtype, np.integer):
+            return r
+        return np.clip(r, 0, 1)
+
+    return inner
 
 
 P = ParamSpec("P")
@@ -7,7 +7,9 @@ import numpy as np
 import onnxruntime as ort
 from nodes.impl.onnx.model import SizeReq
 
+from ..image_op import ImageOp
 from ..upscale.auto_split import Tiler, auto_split
+from ..upscale.passthrough import fill_uniform, is_near_uniform
 
 
 def _into_batched_form(img: np.ndarray, change_shape: bool) -> np.ndarray:
@@ -100,24 +102,56 @@ def onnx_auto_split(
     change_shape: bool,
     tiler: Tiler,
     size_req: SizeReq | None = None,
+    *,
+    flip_r_b: bool = True,
+    overlap: int = 16,
+    output_uint8: bool = False,
+    uniform_threshold: float = 0,
+    scale: int = 1,
+    tile_op: ImageOp | None = None,
 ) -> np.ndarray:
+    """
+    Upscales the given image with the session, splitting it into tiles as necessary.
+
+    The red and blue channels are swapped for the model, since models expect RGB and
+    images are BGR. Pass `flip_r_b=False` for images that are RGB already.
+
+    `output_uint8`, `uniform_threshold` and `tile_op` work like they do in
+    `pytorch_auto_split`. Near-uniform tiles are filled at the given `scale`, so
+    `uniform_threshold` is only correct for models that scale by `scale` and have as
+    many output channels as input channels.
+    """
     input_name = session.get_inputs()[0].name
     output_name = session.get_outputs()[0].name
 
     is_fp16_model = session.get_inputs()[0].type == "tensor(float16)"
 
-    def upscale(img: np.ndarray, _: object):
+    def upscale(img: np.ndarray, _: object) -> np.ndarray:
+        out_dtype = np.dtype(np.uint8 if output_uint8 else np.float32)
+        if uniform_threshold > 0 and is_near_uniform(img, uniform_threshold):
+            output = fill_uniform(img, scale, out_dtype)
+        else:
+            output = run_session(img, out_dtype)
+        if tile_op is not None:
+            output = tile_op(output)
+        return output
+
+    def run_session(img: np.ndarray, out_dtype: np.dtype) -> np.ndarray:
         try:
             lr_img = img.astype(np.float16) if is_fp16_model else img
             lr_img, remove_pad = _pad(lr_img, size_req or SizeReq())
-            lr_img = _flip_r_b_channels(lr_img)
+            if flip_r_b:
+                lr_img = _flip_r_b_channels(lr_img)
             lr_img = _into_batched_form(lr_img, change_shape)
 
             output: np.ndarray = session.run([output_name], {input_name: lr_img})[0]
 
             output = _into_standard_image_form(output, change_shape)
-            output = _flip_r_b_channels(output)
+            if flip_r_b:
+                output = _flip_r_b_channels(output)
             output = remove_pad(output)
+            if out_dtype == np.uint8:
+                return (np.clip(output, 0, 1) * 255).round().astype(np.uint8)
             return output.astype(np.float32)
         except Exception as e:
             if "ONNXRuntimeError" in str(e) and (
@@ -133,6 +167,6 @@ def onnx_auto_split(
                 raise
 
     try:
-        return auto_split(img, upscale, tiler)
+        return auto_split(img, upscale, tiler, overlap=overlap)
     finally:
         gc.collect()
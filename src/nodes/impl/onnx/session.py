@@ -1,15 +1,32 @@
 from __future__ import annotations
 
+import hashlib
+import os
 from typing import Any, Union
 from weakref import WeakKeyDictionary
 
 import onnxruntime as ort
+from onnxruntime.capi import onnxruntime_pybind11_state as ort_state
+from sanic.log import logger
 
 from .model import OnnxModel
 from .utils import OnnxParsedTensorShape, parse_onnx_shape
 
 ProviderDesc = Union[str, tuple[str, dict[Any, Any]]]
 
+# the errors ONNX Runtime raises for models it can't load, optimize or run
+ORT_ERRORS: tuple[type[Exception], ...] = (
+    ort_state.Fail,
+    ort_state.InvalidArgument,
+    ort_state.InvalidGraph,
+    ort_state.InvalidProtobuf,
+    ort_state.NoSuchFile,
+    ort_state.NotImplemented,
+    ort_state.RuntimeException,
+    RuntimeError,
+    ValueError,
+)
+
 
 def create_inference_session(
     model: OnnxModel,
@@ -17,7 +34,18 @@ def create_inference_session(
     execution_provider: str,
     should_tensorrt_fp16: bool = False,
     tensorrt_cache_path: str | None = None,
+    *,
+    session_options: ort.SessionOptions | None = None,
+    optimized_model_cache_path: str | None = None,
 ) -> ort.InferenceSession:
+    """
+    Creates a session for the model.
+
+    If `optimized_model_cache_path` is given, the model is stored there with ONNX
+    Runtime's graph optimizations applied, and later sessions load the optimized model
+    instead of optimizing it again (see `get_optimized_model_path`). TensorRT has its
+    own engine cache and doesn't use it.
+    """
     tensorrt: ProviderDesc = (
         "TensorrtExecutionProvider",
         {
@@ -42,13 +70,91 @@ def create_inference_session(
     else:
         providers = [execution_provider, cpu]
 
+    if (
+        optimized_model_cache_path is not None
+        and execution_provider != "TensorrtExecutionProvider"
+    ):
+        path = get_optimized_model_path(
+            model, execution_provider, optimized_model_cache_path
+        )
+        if not os.path.exists(path):
+            _save_optimized_model(model, providers, path)
+        if os.path.exists(path):
+            try:
+                return ort.InferenceSession(
+                    path, sess_options=session_options, providers=providers
+                )
+            except (*ORT_ERRORS, OSError) as e:
+                # e.g. operators of a provider that isn't available anymore, the model
+                # is optimized again by the next session
+                logger.warning(f"Unable to load the optimized model {path}: {e}")
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
     session = ort.InferenceSession(
         model.bytes,
+        sess_options=session_options,
         providers=providers,
     )
     return session
 
 
+def get_optimized_model_path(
+    model: OnnxModel, execution_provider: str, cache_path: str
+) -> str:
+    """
+    The file the optimized model is cached in. Optimized models can contain operators of
+    the execution provider and of the ONNX Runtime version they were optimized with, so
+    both are part of the name.
+    """
+    model_hash = hashlib.sha256(model.bytes).hexdigest()
+    return os.path.join(
+        cache_path, f"{model_hash}-{execution_provider}-ort{ort.__version__}.onnx"
+    )
+
+
+def _save_optimized_model(
+    model: OnnxModel, providers: list[ProviderDesc], path: str
+) -> None:
+    """
+    Saves the model with the graph optimizations up to the extended level applied.
+    Layout optimizations depend on the CPU the model runs on, they are left to the
+    sessions that load it.
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ort.InferenceSession(model.bytes, sess_options=options, providers=providers)
+        os.replace(f"{path}.tmp", path)
+    except (*ORT_ERRORS, OSError) as e:
+        logger.warning(f"Unable to store the optimized model {path}: {e}")
+
+
+def create_cpu_session_options(
+    intra_op_threads: int = 0, inter_op_threads: int = 0
+) -> ort.SessionOptions:
+    """
+    Session options for inference on the CPU: all graph optimizations are enabled, and
+    operators run one after the other on `intra_op_threads` threads, unless
+    `inter_op_threads` allows independent operators to run in parallel. 0 threads lets
+    ONNX Runtime decide.
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = (
+        ort.ExecutionMode.ORT_PARALLEL
+        if inter_op_threads > 1
+        else ort.ExecutionMode.ORT_SEQUENTIAL
+    )
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    return options
+
+
 __session_cache: WeakKeyDictionary[OnnxModel, ort.InferenceSession] = (
     WeakKeyDictionary()
 )
@@ -60,6 +166,9 @@ def get_onnx_session(
     execution_provider: str,
     should_tensorrt_fp16: bool,
     tensorrt_cache_path: str | None = None,
+    *,
+    session_options: ort.SessionOptions | None = None,
+    optimized_model_cache_path: str | None = None,
 ) -> ort.InferenceSession:
     cached = __session_cache.get(model)
     if cached is None:
@@ -69,6 +178,8 @@ def get_onnx_session(
             execution_provider,
             should_tensorrt_fp16,
             tensorrt_cache_path,
+            session_options=session_options,
+            optimized_model_cache_path=optimized_model_cache_path,
         )
         __session_cache[model] = cached
     return cached
@@ -4,12 +4,15 @@ import gc
 
 import numpy as np
 import torch
-from nodes.utils.utils import get_h_w_c
 from spandrel import ImageModelDescriptor
 
 from api import Progress
 
+from ...utils.utils import get_h_w_c
+from ..image_op import ImageOp
 from ..upscale.auto_split import Split, Tiler, auto_split
+from ..upscale.disk_canvas import is_disk_canvas_size
+from ..upscale.passthrough import fill_uniform, is_near_uniform
 from .utils import safe_cuda_cache_empty
 
 
@@ -77,15 +80,9 @@ def _into_tensor(
         img.flags.writeable = writeable
 
 
-@torch.inference_mode()
-def pytorch_auto_split(
-    img: np.ndarray,
-    model: ImageModelDescriptor[torch.nn.Module],
-    device: torch.device,
-    use_fp16: bool,
-    tiler: Tiler,
-    progress: Progress,
-) -> np.ndarray:
+def _prepare_model(
+    model: ImageModelDescriptor[torch.nn.Module], device: torch.device, use_fp16: bool
+) -> tuple[ImageModelDescriptor[torch.nn.Module], torch.dtype]:
     dtype = torch.float32
     if use_fp16:
         if model.supports_half:
@@ -96,58 +93,223 @@ def pytorch_auto_split(
     if model.dtype != dtype or model.device != device:
         # print("move model", flush=True)
         model = model.to(device, dtype, memory_format=torch.channels_last)
+    return model, dtype
+
+
+def _upscale_batch(
+    imgs: np.ndarray,
+    model: ImageModelDescriptor[torch.nn.Module],
+    device: torch.device,
+    dtype: torch.dtype,
+    progress: Progress,
+    *,
+    output_uint8: bool,
+) -> np.ndarray | Split:
+    progress.check_aborted()
+    if progress.paused:
+        # clear resources before pausing
+        gc.collect()
+        safe_cuda_cache_empty()
+        progress.suspend()
 
-    def upscale(img: np.ndarray, _: object):
-        progress.check_aborted()
-        if progress.paused:
-            # clear resources before pausing
+    input_tensor = None
+    try:
+        if imgs.ndim == 3:
+            # (N, H, W) -> (N, H, W, 1)
+            imgs = imgs[..., np.newaxis]
+        input_channels = imgs.shape[3]
+        # convert to tensor
+        input_tensor = _into_tensor(imgs, device, dtype)
+        if imgs.dtype == np.uint8:
+            input_tensor.div_(255)
+        # expand grayscale tensor to match model input channels
+        if input_channels == 1 and model.input_channels > 1:
+            input_tensor = input_tensor.repeat(1, 1, 1, model.input_channels)
+        # (N, H, W, C) -> (N, C, H, W)
+        input_tensor = input_tensor.permute(0, 3, 1, 2)
+        input_tensor = input_tensor.to(
+            memory_format=torch.channels_last
+        )  # TODO refactor
+        # inference
+        with torch.autocast(device_type="cuda", dtype=dtype, enabled=True):
+            output_tensor = model(input_tensor)
+
+        # convert back to numpy
+        # (N, C, H, W) -> (N, H, W, C)
+        output_tensor = output_tensor.permute(0, 2, 3, 1)
+        if input_channels == 1:
+            output_tensor = output_tensor[..., 0:1]
+        if output_uint8:
+            # quantize before the copy, so only a quarter of the data leaves the device
+            output_tensor = (
+                output_tensor.float().clamp_(0, 1).mul_(255).round_().to(torch.uint8)
+            )
+        # print("out dtype", output_tensor.dtype, flush=True)
+        # result = output_tensor.detach().cpu().detach().float().numpy()
+        result = output_tensor.detach().cpu().detach()
+        if result.dtype == torch.bfloat16:
+            result = result.float()
+        result = result.numpy()
+
+        return result
+    except RuntimeError as e:
+        # Check to see if its actually the CUDA out of memory error
+        if "allocate" in str(e) or "CUDA" in str(e):
+            # Collect garbage (clear VRAM)
+            if input_tensor is not None:
+                try:
+                    input_tensor.detach().cpu()
+                except Exception:
+                    pass
+                del input_tensor
             gc.collect()
             safe_cuda_cache_empty()
-            progress.suspend()
-
-        input_tensor = None
-        try:
-            _, _, input_channels = get_h_w_c(img)
-            # convert to tensor
-            input_tensor = _into_tensor(img, device, dtype)
-            # expand grayscale tensor to match model input channels
-            if input_channels == 1 and model.input_channels > 1:
-                input_tensor = input_tensor.repeat(1, 1, model.input_channels)
-            input_tensor = _into_batched_form(input_tensor)
-            input_tensor = input_tensor.to(
-                memory_format=torch.channels_last
-            )  # TODO refactor
-            # inference
-            with torch.autocast(device_type="cuda", dtype=dtype, enabled=True):
-                output_tensor = model(input_tensor)
-
-            # convert back to numpy
-            output_tensor = _into_standard_image_form(output_tensor)
-            if input_channels == 1:
-                output_tensor = output_tensor[:, :, 0].unsqueeze(-1)
-            # print("out dtype", output_tensor.dtype, flush=True)
-            # result = output_tensor.detach().cpu().detach().float().numpy()
-            result = output_tensor.detach().cpu().detach()
-            if result.dtype == torch.bfloat16:
-                result = result.float()
-            result = result.numpy()
+            return Split()
+        else:
+            # Re-raise the exception if not an OOM error
+            raise
+
+
+def _upscale_batch_or_fill(
+    imgs: np.ndarray,
+    model: ImageModelDescriptor[torch.nn.Module],
+    device: torch.device,
+    dtype: torch.dtype,
+    progress: Progress,
+    *,
+    output_uint8: bool,
+    uniform_threshold: float,
+) -> np.ndarray | Split:
+    """
+    Like `_upscale_batch`, but near-uniform images (see `is_near_uniform`) are filled
+    with their color at the upscaled size instead of going through the model.
+    """
+    if uniform_threshold <= 0 or model.input_channels != model.output_channels:
+        return _upscale_batch(
+            imgs, model, device, dtype, progress, output_uint8=output_uint8
+        )
+
+    uniform = np.array([is_near_uniform(img, uniform_threshold) for img in imgs])
+    if not uniform.any():
+        return _upscale_batch(
+            imgs, model, device, dtype, progress, output_uint8=output_uint8
+        )
+
+    out_dtype = np.dtype(np.uint8 if output_uint8 else np.float32)
+    filled = [fill_uniform(img, model.scale, out_dtype) for img in imgs[uniform]]
+    if uniform.all():
+        return np.stack(filled)
+
+    upscaled = _upscale_batch(
+        imgs[~uniform], model, device, dtype, progress, output_uint8=output_uint8
+    )
+    if isinstance(upscaled, Split):
+        return upscaled
+
+    result = np.empty((len(imgs), *upscaled.shape[1:]), upscaled.dtype)
+    result[~uniform] = upscaled
+    result[uniform] = filled
+    return result
 
+
+def _apply_tile_op(
+    result: np.ndarray | Split, tile_op: ImageOp | None
+) -> np.ndarray | Split:
+    if tile_op is None or isinstance(result, Split):
+        return result
+    return np.stack([tile_op(tile) for tile in result])
+
+
+@torch.inference_mode()
+def pytorch_auto_split(
+    img: np.ndarray,
+    model: ImageModelDescriptor[torch.nn.Module],
+    device: torch.device,
+    use_fp16: bool,
+    tiler: Tiler,
+    progress: Progress,
+    *,
+    output_uint8: bool = False,
+    uniform_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+    overlap: int = 16,
+) -> np.ndarray:
+    """
+    Upscales the given image with the model, splitting it into tiles as necessary.
+
+    Tiles whose channels vary by at most `uniform_threshold` (0-1) are filled with their
+    color instead of going through the model, 0 disables this.
+
+    Tiles are upscaled in batches if the tiler allows it (see `Tiler.starting_batch_size`).
+
+    If `output_uint8` is set, the model output is quantized to uint8 on the device before
+    it is copied back, so the returned image is uint8 instead of float. uint8 input
+    images (e.g. from a previous pass) are supported either way. Results that are large
+    enough to be assembled on disk (see `allocate_canvas`) are always uint8.
+
+    `tile_op` is applied to every upscaled tile before the tiles are blended, e.g. to
+    downscale them to the final size right away. It has to scale all tiles by the same
+    integer factor.
+
+    Neighboring tiles overlap by `overlap` pixels on each side, see
+    `get_tile_overlap`.
+    """
+    model, dtype = _prepare_model(model, device, use_fp16)
+
+    h, w, c = get_h_w_c(img)
+    if is_disk_canvas_size((h * model.scale, w * model.scale, c)):
+        # uint8 takes a quarter of the space on disk
+        output_uint8 = True
+
+    def upscale(img: np.ndarray, _: object) -> np.ndarray | Split:
+        # a batch of one, without copying the image
+        result = upscale_batch(img[np.newaxis])
+        if isinstance(result, Split):
             return result
-        except RuntimeError as e:
-            # Check to see if its actually the CUDA out of memory error
-            if "allocate" in str(e) or "CUDA" in str(e):
-                # Collect garbage (clear VRAM)
-                if input_tensor is not None:
-                    try:
-                        input_tensor.detach().cpu()
-                    except Exception:
-                        pass
-                    del input_tensor
-                gc.collect()
-                safe_cuda_cache_empty()
-                return Split()
-            else:
-                # Re-raise the exception if not an OOM error
-                raise
-
-    return auto_split(img, upscale, tiler)
+        return result[0]
+
+    def upscale_batch(imgs: np.ndarray) -> np.ndarray | Split:
+        result = _upscale_batch_or_fill(
+            imgs,
+            model,
+            device,
+            dtype,
+            progress,
+            output_uint8=output_uint8,
+            uniform_threshold=uniform_threshold,
+        )
+        return _apply_tile_op(result, tile_op)
+
+    return auto_split(
+        img, upscale, tiler, overlap=overlap, upscale_batch=upscale_batch
+    )
+
+
+@torch.inference_mode()
+def pytorch_upscale_batch(
+    imgs: np.ndarray,
+    model: ImageModelDescriptor[torch.nn.Module],
+    device: torch.device,
+    use_fp16: bool,
+    progress: Progress,
+    *,
+    output_uint8: bool = False,
+    uniform_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+) -> np.ndarray | Split:
+    """
+    Upscales a batch of images of the same size, given as one (N, H, W, C) array, in a
+    single forward pass without any tiling. Returns `Split` if the batch doesn't fit into
+    memory. See `pytorch_auto_split` for `uniform_threshold` and `tile_op`.
+    """
+    model, dtype = _prepare_model(model, device, use_fp16)
+    result = _upscale_batch_or_fill(
+        imgs,
+        model,
+        device,
+        dtype,
+        progress,
+        output_uint8=output_uint8,
+        uniform_threshold=uniform_threshold,
+    )
+    return _apply_tile_op(result, tile_op)
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import math
+import time
+from dataclasses import dataclass
+from threading import Event, Thread
+from typing import Self
+
+import numpy as np
+import psutil
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+from api import Progress
+
+from ..upscale.auto_split import Split
+from .auto_split import pytorch_upscale_batch
+from .tuning_cache import TuningCache, get_tuning_key
+
+MEMORY_MODEL_CACHE_FILE_NAME = "memory-model-cache.json"
+
+# tile sizes (with overlap) at which the peak memory is measured
+PROBE_SIZES = [128, 192, 256]
+
+MEMORY_MODEL_CACHE = TuningCache(MEMORY_MODEL_CACHE_FILE_NAME)
+
+# keys that couldn't be measured in this process, they are only tried again by the next run
+_unmeasurable_keys: set[str] = set()
+
+
+@dataclass(frozen=True)
+class MemoryModel:
+    """
+    The peak memory an upscale needs on top of the loaded model, as a linear function of
+    the number of pixels of the tile.
+    """
+
+    fixed_bytes: float
+    bytes_per_pixel: float
+
+    def max_pixels(self, budget: int) -> int:
+        """
+        The largest number of pixels whose peak memory fits into the given budget.
+        """
+        return max(0, int((budget - self.fixed_bytes) / self.bytes_per_pixel))
+
+
+def tile_size_for_pixels(pixels: int, overlap: int = 16) -> int:
+    """
+    The largest square tile (without overlap, a multiple of 16) whose padded tile has at
+    most the given number of pixels.
+    """
+    return max(16, (math.isqrt(pixels) - 2 * overlap) // 16 * 16)
+
+
+class _PeakRssSampler:
+    """
+    Samples the resident memory of this process in the background, since the peak of a
+    CPU upscale can't be read from PyTorch.
+    """
+
+    def __init__(self, interval: float = 0.002) -> None:
+        self._process = psutil.Process()
+        self._interval = interval
+        self._stop = Event()
+        self.peak: int = self._process.memory_info().rss
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            time.sleep(self._interval)
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+
+def _measure_peak_bytes(
+    model: ImageModelDescriptor,
+    device: torch.device,
+    use_fp16: bool,
+    img: np.ndarray,
+    progress: Progress,
+) -> int | None:
+    """
+    Returns the peak memory of upscaling the given batch on top of the memory in use
+    before, or `None` if it can't be measured on this device or doesn't fit.
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+        result = pytorch_upscale_batch(img, model, device, use_fp16, progress)
+        if isinstance(result, Split):
+            return None
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - baseline
+
+    if device.type == "cpu":
+        baseline = psutil.Process().memory_info().rss
+        with _PeakRssSampler() as sampler:
+            result = pytorch_upscale_batch(img, model, device, use_fp16, progress)
+            if isinstance(result, Split):
+                return None
+            del result
+        return sampler.peak - baseline
+
+    return None
+
+
+def get_memory_model(
+    model: ImageModelDescriptor,
+    device: torch.device,
+    use_fp16: bool,
+    *,
+    channels: int,
+    cache_dir: str | None,
+    progress: Progress,
+    measure: bool = True,
+) -> MemoryModel | None:
+    """
+    Returns the memory model of the model on the given device.
+
+    The peak memory is measured at a few probe tile sizes (allocator statistics on CUDA,
+    the resident memory of the process on CPU) and a line is fit through the
+    measurements. The fit is stored in a cache file in `cache_dir`, so it is only measured
+    once per machine. Returns `None` if the memory can't be measured on this device, or
+    if `measure` is false and the memory model isn't cached yet.
+    """
+    if device.type not in ("cuda", "cpu"):
+        return None
+
+    key = get_tuning_key(model, device, use_fp16, channels)
+
+    with MEMORY_MODEL_CACHE.lock:
+        cached = MEMORY_MODEL_CACHE.get(cache_dir, key)
+        if cached is not None:
+            return MemoryModel(**cached)
+        if key in _unmeasurable_keys or not measure:
+            return None
+
+        logger.info(f"Measuring the memory usage of {model.architecture.name}")
+
+        rng = np.random.default_rng(0)
+        pixels: list[int] = []
+        peaks: list[int] = []
+        # the first run only warms up, one-time allocations would distort the fit
+        for i, probe_size in enumerate([PROBE_SIZES[0], *PROBE_SIZES]):
+            pad = model.size_requirements.get_padding(probe_size, probe_size)[0]
+            size = probe_size + pad
+            img = rng.random((1, size, size, channels)).astype(np.float32)
+            peak = _measure_peak_bytes(model, device, use_fp16, img, progress)
+            if peak is None:
+                _unmeasurable_keys.add(key)
+                return None
+            if i > 0:
+                pixels.append(size * size)
+                peaks.append(peak)
+                logger.debug(
+                    f"Peak memory at {size}x{size}px: {peak / 1024**2:.1f} MiB"
+                )
+
+        bytes_per_pixel, fixed_bytes = np.polyfit(pixels, peaks, 1)
+        if bytes_per_pixel <= 0:
+            # the measurements are too noisy to be of use
+            logger.warning(
+                f"Unable to measure the memory usage of {model.architecture.name}"
+            )
+            _unmeasurable_keys.add(key)
+            return None
+
+        memory_model = MemoryModel(
+            fixed_bytes=max(0.0, float(fixed_bytes)),
+            bytes_per_pixel=float(bytes_per_pixel),
+        )
+        logger.info(
+            f"Memory usage: {memory_model.fixed_bytes / 1024**2:.1f} MiB"
+            f" + {memory_model.bytes_per_pixel / 1024:.2f} KiB per pixel"
+        )
+        MEMORY_MODEL_CACHE.set(
+            cache_dir,
+            key,
+            {
+                "fixed_bytes": memory_model.fixed_bytes,
+                "bytes_per_pixel": memory_model.bytes_per_pixel,
+            },
+        )
+        return memory_model
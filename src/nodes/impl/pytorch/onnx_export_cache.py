@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import os
+
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+from .convert_to_onnx_impl import convert_to_onnx_impl, is_onnx_supported
+from .tuning_cache import get_model_hash
+
+ONNX_OPSET = 14
+
+
+def get_onnx_export_path(
+    model: ImageModelDescriptor, cache_dir: str, use_half: bool, opset: int
+) -> str:
+    """
+    The file an exported model is cached in. Exports are identified by the model's
+    weights, its architecture, the opset and the precision.
+    """
+    precision = "fp16" if use_half else "fp32"
+    file_name = (
+        f"{get_model_hash(model)}-{model.architecture.id}-opset{opset}-{precision}.onnx"
+    )
+    return os.path.join(cache_dir, file_name)
+
+
+def get_onnx_export(
+    model: ImageModelDescriptor,
+    cache_dir: str,
+    use_half: bool = False,
+    opset: int = ONNX_OPSET,
+) -> bytes:
+    """
+    Returns the model exported to ONNX.
+
+    The model is exported on first use and the export is stored in `cache_dir`, so later
+    runs load it directly. Raises a `ValueError` if the architecture can't be exported.
+    """
+    if not is_onnx_supported(model):
+        raise ValueError(
+            f"Model of arch {model.architecture.name} can't be exported to ONNX."
+        )
+
+    path = get_onnx_export_path(model, cache_dir, use_half, opset)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        pass
+
+    logger.info(f"Exporting {model.architecture.name} to ONNX (opset {opset})")
+    model_bytes = convert_to_onnx_impl(
+        model, model.device, use_half=use_half, opset_version=opset
+    )
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(model_bytes)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning(f"Unable to write {path}: {e}")
+
+    return model_bytes
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import numpy as np
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+from api import Progress
+
+from ...utils.utils import Region
+from ..upscale.auto_split import Split
+from ..upscale.exact_split import exact_split
+from .auto_split import pytorch_upscale_batch
+from .tuning_cache import TuningCache, get_tuning_key
+
+OVERLAP_CACHE_FILE_NAME = "overlap-cache.json"
+
+# the overlap used when it isn't calibrated
+DEFAULT_OVERLAP = 16
+
+# overlaps to try, from the smallest
+CANDIDATE_OVERLAPS = [4, 8, 12, 16, 24, 32, 48]
+
+# the size of the probe image, it is split into two tiles side by side
+PROBE_WIDTH = 256
+PROBE_HEIGHT = 128
+
+OVERLAP_CACHE = TuningCache(OVERLAP_CACHE_FILE_NAME)
+
+
+class _SplitEx(Exception):
+    pass
+
+
+def _probe_image(channels: int) -> np.ndarray:
+    """
+    A deterministic image with hard edges, gradients and fine texture, so both the near
+    and the far context of the model matter.
+    """
+    rng = np.random.default_rng(0)
+    blocks = rng.random((PROBE_HEIGHT // 16, PROBE_WIDTH // 16, channels))
+    blocks = np.kron(blocks, np.ones((16, 16, 1)))
+    y, x = np.mgrid[0:PROBE_HEIGHT, 0:PROBE_WIDTH]
+    waves = (np.sin(x * 0.3) * np.cos(y * 0.2))[..., np.newaxis]
+    noise = rng.random((PROBE_HEIGHT, PROBE_WIDTH, channels))
+    img = 0.6 * blocks + 0.2 * waves + 0.2 * noise
+    return np.clip(img, 0, 1).astype(np.float32)
+
+
+def _seam_error(tiled: np.ndarray, untiled: np.ndarray) -> float:
+    """
+    The largest absolute difference of a pixel around the seam, in levels of 255. The
+    seam is vertical in the middle of the image, and the band around it is as wide as
+    the largest candidate overlap on either side, so all candidates are measured alike.
+    """
+    scale = tiled.shape[1] // PROBE_WIDTH
+    band = slice(
+        (PROBE_WIDTH // 2 - CANDIDATE_OVERLAPS[-1]) * scale,
+        (PROBE_WIDTH // 2 + CANDIDATE_OVERLAPS[-1]) * scale,
+    )
+    diff = np.abs(
+        tiled[:, band].astype(np.float32) - untiled[:, band].astype(np.float32)
+    )
+    return float(diff.max() * 255)
+
+
+def get_tile_overlap(
+    model: ImageModelDescriptor,
+    device: torch.device,
+    use_fp16: bool,
+    *,
+    channels: int,
+    cache_dir: str | None,
+    seam_tolerance: int,
+    progress: Progress,
+) -> int:
+    """
+    Returns the smallest overlap between tiles whose seams stay within `seam_tolerance`
+    (in levels of 255) for the model on the given device.
+
+    A probe image is upscaled once as a whole and once as two tiles side by side for
+    every candidate overlap, and the seam error is the largest difference of a pixel
+    around the seam. The result is stored in a cache file in `cache_dir`, so each model
+    is only calibrated once per machine and tolerance. Returns `DEFAULT_OVERLAP` if the
+    model can't be calibrated, and the largest candidate if no candidate is within
+    tolerance.
+    """
+    key = f"{get_tuning_key(model, device, use_fp16, channels)}:{seam_tolerance}"
+
+    with OVERLAP_CACHE.lock:
+        cached = OVERLAP_CACHE.get(cache_dir, key)
+        if cached is not None:
+            return cached
+
+        logger.info(f"Calibrating the tile overlap of {model.architecture.name}")
+
+        img = _probe_image(channels)
+        untiled = pytorch_upscale_batch(
+            img[np.newaxis], model, device, use_fp16, progress
+        )
+        if isinstance(untiled, Split):
+            logger.warning(
+                f"Unable to calibrate the tile overlap of {model.architecture.name}"
+            )
+            return DEFAULT_OVERLAP
+
+        def upscale(tile: np.ndarray, _: Region) -> np.ndarray:
+            result = pytorch_upscale_batch(
+                tile[np.newaxis], model, device, use_fp16, progress
+            )
+            if isinstance(result, Split):
+                raise _SplitEx
+            return result[0]
+
+        overlap = CANDIDATE_OVERLAPS[-1]
+        for candidate in CANDIDATE_OVERLAPS:
+            try:
+                tiled = exact_split(
+                    img,
+                    (PROBE_WIDTH // 2 + candidate, PROBE_HEIGHT),
+                    upscale,
+                    overlap=candidate,
+                )
+            except _SplitEx:
+                return DEFAULT_OVERLAP
+
+            error = _seam_error(tiled, untiled[0])
+            logger.debug(f"Overlap {candidate}px: seam error {error:.2f}")
+            if error <= seam_tolerance:
+                overlap = candidate
+                break
+        else:
+            logger.warning(
+                f"No overlap keeps the seams of {model.architecture.name} within the"
+                f" tolerance, using {overlap}px"
+            )
+
+        logger.info(f"Using a tile overlap of {overlap}px")
+        OVERLAP_CACHE.set(cache_dir, key, overlap)
+        return overlap
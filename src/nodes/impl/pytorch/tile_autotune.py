@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import time
+
+import numpy as np
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+from api import Progress
+
+from ..upscale.auto_split import Split
+from .auto_split import pytorch_upscale_batch
+from .tuning_cache import TuningCache, get_tuning_key
+
+TILE_SIZE_CACHE_FILE_NAME = "tile-size-cache.json"
+
+# tile sizes without overlap, before they are adjusted to the size requirements of the model
+CANDIDATE_TILE_SIZES = [128, 192, 256, 384, 512, 768, 1024]
+
+# larger candidates are not measured once a single tile takes longer than this (in seconds)
+MAX_SECONDS_PER_TILE = 10
+
+TILE_SIZE_CACHE = TuningCache(TILE_SIZE_CACHE_FILE_NAME)
+
+
+def get_tile_size_candidates(model: ImageModelDescriptor, overlap: int) -> list[int]:
+    """
+    The tile sizes to benchmark. Tiles plus their overlap satisfy the model's size
+    requirements, so spandrel doesn't have to pad them.
+    """
+    candidates: list[int] = []
+    for tile_size in CANDIDATE_TILE_SIZES:
+        padded_size = tile_size + 2 * overlap
+        padded_size += model.size_requirements.get_padding(padded_size, padded_size)[0]
+        if padded_size - 2 * overlap not in candidates:
+            candidates.append(padded_size - 2 * overlap)
+    return candidates
+
+
+def _benchmark_tile_size(
+    model: ImageModelDescriptor,
+    device: torch.device,
+    use_fp16: bool,
+    *,
+    channels: int,
+    tile_size: int,
+    overlap: int,
+    progress: Progress,
+) -> tuple[float, float] | None:
+    """
+    Returns the pixels per second and the seconds per tile, or `None` if the tile doesn't
+    fit into memory.
+    """
+    padded_size = tile_size + 2 * overlap
+    img = (
+        np.random.default_rng(0)
+        .random((1, padded_size, padded_size, channels))
+        .astype(np.float32)
+    )
+
+    timings: list[float] = []
+    # the first run is only a warm-up (e.g. for cuDNN's algorithm search), unless it is
+    # already too slow to repeat
+    for _ in range(3):
+        start = time.perf_counter()
+        if isinstance(
+            pytorch_upscale_batch(img, model, device, use_fp16, progress), Split
+        ):
+            return None
+        timings.append(time.perf_counter() - start)
+        if timings[0] > MAX_SECONDS_PER_TILE:
+            break
+
+    seconds = min(timings[1:] or timings)
+    return tile_size * tile_size / seconds, seconds
+
+
+def autotune_tile_size(
+    model: ImageModelDescriptor,
+    device: torch.device,
+    use_fp16: bool,
+    *,
+    channels: int,
+    cache_dir: str | None,
+    progress: Progress,
+    overlap: int = 16,
+) -> int | None:
+    """
+    Returns the tile size with the highest throughput for the model on the given device.
+
+    The candidates are benchmarked once per model, architecture, device, precision,
+    channel count and overlap, and the winner is stored in a cache file in `cache_dir`, so later runs
+    use it directly. Returns `None` if not even the smallest candidate fits into memory.
+    """
+    # the overlap changes the padded size of the benchmarked tiles
+    key = f"{get_tuning_key(model, device, use_fp16, channels)}:{overlap}"
+
+    with TILE_SIZE_CACHE.lock:
+        cached = TILE_SIZE_CACHE.get(cache_dir, key)
+        if cached is not None:
+            return cached
+
+        logger.info(f"Benchmarking tile sizes for {model.architecture.name}")
+
+        best_tile_size: int | None = None
+        best_pixels_per_second = 0.0
+        for tile_size in get_tile_size_candidates(model, overlap):
+            measurement = _benchmark_tile_size(
+                model,
+                device,
+                use_fp16,
+                channels=channels,
+                tile_size=tile_size,
+                overlap=overlap,
+                progress=progress,
+            )
+            if measurement is None:
+                # larger tiles won't fit either
+                break
+
+            pixels_per_second, seconds = measurement
+            logger.info(
+                f"Tile size {tile_size}: {pixels_per_second / 1e6:.2f} MP/s ({seconds:.2f}s per tile)"
+            )
+            if pixels_per_second > best_pixels_per_second:
+                best_tile_size = tile_size
+                best_pixels_per_second = pixels_per_second
+            if seconds > MAX_SECONDS_PER_TILE:
+                break
+
+        if best_tile_size is None:
+            return None
+
+        logger.info(f"Using tile size {best_tile_size}")
+        TILE_SIZE_CACHE.set(cache_dir, key, best_tile_size)
+        return best_tile_size
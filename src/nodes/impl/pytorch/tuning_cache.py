@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import weakref
+from threading import RLock
+from typing import Any
+
+import torch
+from sanic.log import logger
+from spandrel import ImageModelDescriptor
+
+MODEL_HASH_CACHE: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_model_hash(model: ImageModelDescriptor) -> str:
+    """
+    A hash of the model's weights. The weights are hashed at half precision, so the hash
+    doesn't change when the model is moved to FP16.
+    """
+    model_hash = MODEL_HASH_CACHE.get(model)
+    if model_hash is None:
+        sha256 = hashlib.sha256()
+        for name, tensor in model.model.state_dict().items():
+            sha256.update(name.encode())
+            sha256.update(tensor.detach().cpu().half().numpy().tobytes())
+        model_hash = sha256.hexdigest()
+        MODEL_HASH_CACHE[model] = model_hash
+    return model_hash
+
+
+def get_tuning_key(
+    model: ImageModelDescriptor, device: torch.device, use_fp16: bool, channels: int
+) -> str:
+    """
+    Identifies a measurement: the model, its architecture, the device, the precision and
+    the channel count of the images.
+    """
+    return ":".join(
+        [
+            get_model_hash(model),
+            model.architecture.id,
+            str(device),
+            "fp16" if use_fp16 else "fp32",
+            str(channels),
+        ]
+    )
+
+
+class TuningCache:
+    """
+    A JSON file in a cache directory that maps tuning keys (see `get_tuning_key`) to
+    measured values, so measurements are only taken once per machine.
+
+    Without a cache directory, values are only kept in memory. Writes merge with the
+    entries other processes may have written in the meantime. Hold `lock` while
+    measuring, so a value is only measured once.
+    """
+
+    def __init__(self, file_name: str) -> None:
+        self.file_name: str = file_name
+        self.lock = RLock()
+        self._loaded: dict[str, dict[str, Any]] = {}
+
+    def _path(self, cache_dir: str | None) -> str:
+        return os.path.join(cache_dir, self.file_name) if cache_dir else ""
+
+    def _read(self, path: str) -> dict[str, Any]:
+        if not path:
+            return {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def get(self, cache_dir: str | None, key: str) -> Any | None:
+        path = self._path(cache_dir)
+        with self.lock:
+            entries = self._loaded.get(path)
+            if entries is None:
+                entries = self._read(path)
+                self._loaded[path] = entries
+            return entries.get(key)
+
+    def set(self, cache_dir: str | None, key: str, value: Any) -> None:
+        path = self._path(cache_dir)
+        with self.lock:
+            entries = self._read(path) if path else self._loaded.get(path, {})
+            entries[key] = value
+            self._loaded[path] = entries
+            if not path:
+                return
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                    json.dump(entries, f, indent=2, sort_keys=True)
+                os.replace(f"{path}.tmp", path)
+            except OSError as e:
+                logger.warning(f"Unable to write {path}: {e}")
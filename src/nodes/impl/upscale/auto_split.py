@@ -6,9 +6,14 @@ from collections.abc import Callable
 import numpy as np
 from sanic.log import logger
 
-from ...utils.utils import Region, Size, get_h_w_c
+from ...utils.utils import Padding, Region, Size, get_h_w_c
 from .exact_split import exact_split
-from .tile_blending import BlendDirection, TileBlender, TileOverlap, half_sin_blend_fn
+from .tile_blending import (
+    StreamingTileBlender,
+    TileOverlap,
+    blend_dtype,
+    half_sin_blend_fn,
+)
 from .tiler import Tiler
 
 
@@ -17,6 +22,11 @@ class Split:
 
 
 SplitImageOp = Callable[[np.ndarray, Region], np.ndarray | Split]
+BatchSplitImageOp = Callable[[np.ndarray], np.ndarray | Split]
+"""
+Upscales a batch of tiles of the same size, given as one (N, H, W, C) array, and returns
+the upscaled tiles as one (N, H', W', C') array.
+"""
 
 
 def auto_split(
@@ -24,6 +34,7 @@ def auto_split(
     upscale: SplitImageOp,
     tiler: Tiler,
     overlap: int = 16,
+    upscale_batch: BatchSplitImageOp | None = None,
 ) -> np.ndarray:
     """
     Splits the image into tiles according to the given tiler.
@@ -37,17 +48,39 @@ def auto_split(
 
     If the given tiler allows smaller tile sizes, then it is guaranteed that no padding will be added.
     Otherwise, no padding is only guaranteed if the starting tile size is not larger than the size of the given image.
+
+    ## Batching
+
+    If `upscale_batch` is given and the tiler allows smaller tile sizes, then several tiles may be upscaled at once.
+    The tiles of a batch are padded to a common size by repeating their right and bottom edges, and the padding is removed from the upscaled tiles.
     """
 
     h, w, c = get_h_w_c(img)
-    split = _max_split if tiler.allow_smaller_tile_size() else _exact_split
+    starting_tile_size = tiler.starting_tile_size(w, h, c)
+
+    if not tiler.allow_smaller_tile_size():
+        return _exact_split(
+            img,
+            upscale=upscale,
+            starting_tile_size=starting_tile_size,
+            split_tile_size=tiler.split,
+            overlap=overlap,
+        )
 
-    return split(
+    batch_size = 1
+    if upscale_batch is not None:
+        batch_size = tiler.starting_batch_size(
+            (starting_tile_size[0] + 2 * overlap, starting_tile_size[1] + 2 * overlap)
+        )
+
+    return _max_split(
         img,
         upscale=upscale,
-        starting_tile_size=tiler.starting_tile_size(w, h, c),
+        starting_tile_size=starting_tile_size,
         split_tile_size=tiler.split,
         overlap=overlap,
+        upscale_batch=upscale_batch,
+        batch_size=batch_size,
     )
 
 
@@ -96,11 +129,17 @@ def _max_split(
     starting_tile_size: Size,
     split_tile_size: Callable[[Size], Size],
     overlap: int,
+    *,
+    upscale_batch: BatchSplitImageOp | None = None,
+    batch_size: int = 1,
 ) -> np.ndarray:
     """
     Splits the image into tiles with at most the given tile size.
 
-    If the upscale method requests a split, then the tile size will be lowered.
+    If the upscale method requests a split for a tile, then only that tile is subdivided
+    into smaller tiles (recursively, if necessary). Tiles that were already upscaled are
+    kept, and all following tiles are subdivided right away.
+    If a batch of tiles requests a split, then the batch size is halved first.
     """
 
     h, w, c = get_h_w_c(img)
@@ -119,125 +158,194 @@ def _max_split(
             return upscale_result
 
         # the image was too large
-        max_tile_size = split_tile_size(max_tile_size)
+        max_tile_size = _smaller_tile_size(max_tile_size, split_tile_size)
 
         logger.warn(
             f"Unable to upscale the whole image at once. Reduced tile size to {max_tile_size}."
         )
 
-    # The upscale method is allowed to request splits at any time.
-    # When a split occurs, we have to "restart" the loop and
-    # this variable allow us to split the already processed tiles.
-    start_y = 0
+    # This is a bit complex.
+    # We don't actually use the current tile size to partition the image.
+    # If we did, then tile_size=1024 and w=1200 would result in very uneven tiles.
+    # Instead, we use tile_size to calculate how many tiles we get in the x and y direction
+    # and then calculate the optimal tile size for the x and y direction using the counts.
+    # This yields optimal tile sizes which should prevent unnecessary splitting.
+    tile_count_x = math.ceil(w / max_tile_size[0])
+    tile_count_y = math.ceil(h / max_tile_size[1])
+    tile_size_x = math.ceil(w / tile_count_x)
+    tile_size_y = math.ceil(h / tile_count_y)
 
-    # To allocate the result image, we need to know the upscale factor first,
-    # and we only get to know this factor after the first successful upscale.
-    result: TileBlender | None = None
-    scale: int = 0
-    out_channels: int = 0
-
-    restart = True
-    while restart:
-        restart = False
-
-        # This is a bit complex.
-        # We don't actually use the current tile size to partition the image.
-        # If we did, then tile_size=1024 and w=1200 would result in very uneven tiles.
-        # Instead, we use tile_size to calculate how many tiles we get in the x and y direction
-        # and then calculate the optimal tile size for the x and y direction using the counts.
-        # This yields optimal tile sizes which should prevent unnecessary splitting.
-        tile_count_x = math.ceil(w / max_tile_size[0])
-        tile_count_y = math.ceil(h / max_tile_size[1])
-        tile_size_x = math.ceil(w / tile_count_x)
-        tile_size_y = math.ceil(h / tile_count_y)
-
-        logger.debug(
-            f"Currently {tile_count_x}x{tile_count_y} tiles each {tile_size_x}x{tile_size_y}px."
-        )
+    logger.debug(
+        f"Currently {tile_count_x}x{tile_count_y} tiles each {tile_size_x}x{tile_size_y}px."
+    )
 
-        prev_row_result: TileBlender | None = None
+    # the tile size tiles are subdivided with, once a tile requested a split
+    subdivided_tile_size: Size | None = None
+
+    # tiles upscaled ahead of time as part of a batch, by their region
+    batched_results: dict[Region, np.ndarray] = {}
+    batch_tiles = [
+        _padded_tile(
+            img_region,
+            x,
+            y,
+            tile_size_x=tile_size_x,
+            tile_size_y=tile_size_y,
+            overlap=overlap,
+        )[1]
+        for y in range(tile_count_y)
+        for x in range(tile_count_x)
+    ]
+    batch_width = max(t.width for t in batch_tiles)
+    batch_height = max(t.height for t in batch_tiles)
+    # larger batches would only request the same tiles again
+    batch_size = min(batch_size, len(batch_tiles))
+
+    def upscale_tile(padded_tile: Region) -> np.ndarray | Split:
+        nonlocal batch_size
+
+        if padded_tile in batched_results:
+            return batched_results.pop(padded_tile)
+
+        while upscale_batch is not None and batch_size > 1:
+            index = batch_tiles.index(padded_tile)
+            batch_size = min(batch_size, len(batch_tiles) - index)
+            batch = batch_tiles[index : index + batch_size]
+            if len(batch) == 1:
+                break
 
-        for y in range(tile_count_y):
-            if y < start_y:
+            batch_result = upscale_batch(
+                np.stack(
+                    [
+                        _pad_to(t.read_from(img), batch_width, batch_height)
+                        for t in batch
+                    ]
+                )
+            )
+            if isinstance(batch_result, Split):
+                batch_size //= 2
+                logger.debug(f"Split occurred. New batch size is {batch_size}.")
                 continue
 
-            row_result: TileBlender | None = None
-            row_overlap: TileOverlap | None = None
-
-            for x in range(tile_count_x):
-                tile = Region(
-                    x * tile_size_x, y * tile_size_y, tile_size_x, tile_size_y
-                ).intersect(img_region)
-                pad = img_region.child_padding(tile).min(overlap)
-                padded_tile = tile.add_padding(pad)
+            batch_scale = batch_result.shape[1] // batch_height
+            for t, tile_result in zip(batch, batch_result, strict=True):
+                batched_results[t] = tile_result[
+                    : t.height * batch_scale, : t.width * batch_scale
+                ]
+            return batched_results.pop(padded_tile)
+
+        return upscale(padded_tile.read_from(img), padded_tile)
+
+    def subdivide_tile(padded_tile: Region, tile_size: Size) -> np.ndarray:
+        def upscale_part(part: np.ndarray, part_region: Region) -> np.ndarray | Split:
+            # regions are relative to the whole image
+            return upscale(
+                part,
+                Region(
+                    padded_tile.x + part_region.x,
+                    padded_tile.y + part_region.y,
+                    part_region.width,
+                    part_region.height,
+                ),
+            )
 
-                upscale_result = upscale(padded_tile.read_from(img), padded_tile)
+        return _max_split(
+            padded_tile.read_from(img),
+            upscale=upscale_part,
+            starting_tile_size=tile_size,
+            split_tile_size=split_tile_size,
+            overlap=overlap,
+        )
 
-                if isinstance(upscale_result, Split):
-                    max_tile_size = split_tile_size(max_tile_size)
+    # To allocate the result image, we need to know the upscale factor first,
+    # and we only get to know this factor after the first successful upscale.
+    result: StreamingTileBlender | None = None
+    scale: int = 0
 
-                    new_tile_count_y = math.ceil(h / max_tile_size[1])
-                    new_tile_size_y = math.ceil(h / new_tile_count_y)
-                    start_y = (y * tile_size_x) // new_tile_size_y
+    for y in range(tile_count_y):
+        for x in range(tile_count_x):
+            pad, padded_tile = _padded_tile(
+                img_region,
+                x,
+                y,
+                tile_size_x=tile_size_x,
+                tile_size_y=tile_size_y,
+                overlap=overlap,
+            )
 
-                    logger.debug(
-                        f"Split occurred. New tile size is {max_tile_size}. Starting at row {start_y}."
+            if subdivided_tile_size is None:
+                upscale_result = upscale_tile(padded_tile)
+                if isinstance(upscale_result, Split):
+                    subdivided_tile_size = _smaller_tile_size(
+                        (tile_size_x, tile_size_y), split_tile_size
                     )
-
-                    # reset result
-                    if result is not None:
-                        # we already added at least one row, so we have to set the offset back
-                        result.offset = start_y * new_tile_size_y
-
-                    restart = True
-                    break
-
-                # figure out by how much the image was upscaled by
-                up_h, up_w, up_c = get_h_w_c(upscale_result)
-                current_scale = up_h // padded_tile.height
-                assert current_scale > 0
-                assert padded_tile.height * current_scale == up_h
-                assert padded_tile.width * current_scale == up_w
-
-                if row_result is None:
-                    # allocate the result image
-                    scale = current_scale
-                    out_channels = up_c
-                    row_result = TileBlender(
-                        width=w * scale,
-                        height=padded_tile.height * scale,
-                        channels=out_channels,
-                        direction=BlendDirection.X,
-                        blend_fn=half_sin_blend_fn,
-                        _prev=prev_row_result,
+                    logger.debug(
+                        f"Split occurred. Subdividing the remaining tiles with tile size {subdivided_tile_size}."
                     )
-                    prev_row_result = row_result
-                    row_overlap = TileOverlap(pad.top * scale, pad.bottom * scale)
+            if subdivided_tile_size is not None:
+                upscale_result = subdivide_tile(padded_tile, subdivided_tile_size)
+            assert not isinstance(upscale_result, Split)
 
-                assert current_scale == scale
-
-                # add to row
-                row_result.add_tile(
-                    upscale_result, TileOverlap(pad.left * scale, pad.right * scale)
-                )
-
-            if restart:
-                break
-
-            assert row_result is not None
-            assert row_overlap is not None
+            # figure out by how much the image was upscaled by
+            up_h, up_w, up_c = get_h_w_c(upscale_result)
+            current_scale = up_h // padded_tile.height
+            assert current_scale > 0
+            assert padded_tile.height * current_scale == up_h
+            assert padded_tile.width * current_scale == up_w
 
             if result is None:
-                result = TileBlender(
+                # allocate the result image
+                scale = current_scale
+                result = StreamingTileBlender(
                     width=w * scale,
                     height=h * scale,
-                    channels=out_channels,
-                    direction=BlendDirection.Y,
+                    channels=up_c,
                     blend_fn=half_sin_blend_fn,
+                    dtype=blend_dtype(upscale_result),
                 )
 
-            # add row
-            result.add_tile(row_result.get_result(), row_overlap)
+            assert current_scale == scale
+
+            result.add_tile(
+                upscale_result,
+                TileOverlap(pad.left * scale, pad.right * scale),
+                TileOverlap(pad.top * scale, pad.bottom * scale),
+            )
 
     assert result is not None
     return result.get_result()
+
+
+def _smaller_tile_size(
+    tile_size: Size, split_tile_size: Callable[[Size], Size]
+) -> Size:
+    smaller = split_tile_size(tile_size)
+    if smaller[0] >= tile_size[0] and smaller[1] >= tile_size[1]:
+        raise ValueError(
+            f"Unable to upscale image with tile size {tile_size[0]}x{tile_size[1]}px."
+        )
+    return smaller
+
+
+def _padded_tile(
+    img_region: Region,
+    x: int,
+    y: int,
+    *,
+    tile_size_x: int,
+    tile_size_y: int,
+    overlap: int,
+) -> tuple[Padding, Region]:
+    tile = Region(x * tile_size_x, y * tile_size_y, tile_size_x, tile_size_y).intersect(
+        img_region
+    )
+    pad = img_region.child_padding(tile).min(overlap)
+    return pad, tile.add_padding(pad)
+
+
+def _pad_to(tile: np.ndarray, width: int, height: int) -> np.ndarray:
+    h, w, _ = get_h_w_c(tile)
+    if w == width and h == height:
+        return tile
+    pad_width = [(0, height - h), (0, width - w)] + [(0, 0)] * (tile.ndim - 2)
+    return np.pad(tile, pad_width, mode="edge")
@@ -10,6 +10,31 @@ from .tiler import MaxTileSize, NoTiling, Tiler
 GB_AMT = 1024**3
 
 
+def estimate_tile_pixels(
+    budget: int,
+    model_size: int,
+    img: np.ndarray,
+    img_element_size: int = 4,
+) -> int:
+    """
+    Estimates how many pixels of the given image can be upscaled at once with the given
+    memory budget, either as one tile or as a batch of smaller tiles.
+    """
+    _, _, c = get_h_w_c(img)
+    return int(budget / estimate_bytes_per_pixel(model_size, c, img_element_size))
+
+
+def estimate_bytes_per_pixel(
+    model_size: int,
+    channels: int,
+    img_element_size: int = 4,
+) -> float:
+    """
+    The memory the heuristic estimates an upscale needs per pixel of the tile.
+    """
+    return (model_size / (1024 * 52)) * channels * img_element_size
+
+
 def estimate_tile_size(
     budget: int,
     model_size: int,
@@ -20,7 +45,7 @@ def estimate_tile_size(
     img_bytes = h * w * c * img_element_size
     mem_required_estimation = (model_size / (1024 * 52)) * img_bytes
 
-    tile_pixels = w * h * budget / mem_required_estimation
+    tile_pixels = estimate_tile_pixels(budget, model_size, img, img_element_size)
     # the largest power-of-2 tile_size such that tile_size**2 < tile_pixels
     tile_size = 2 ** (int(tile_pixels**0.5).bit_length() - 1)
     # tile_size = int(tile_pixels**0.5) // 16 * 16
@@ -40,11 +65,13 @@ ESTIMATE = TileSize(0)
 NO_TILING = TileSize(-1)
 MAX_TILE_SIZE = TileSize(-2)
 CUSTOM = TileSize(-3)
+AUTOTUNE = TileSize(-4)
 TILE_SIZE_256 = TileSize(256)
 
 
 def parse_tile_size_input(tile_size: TileSize, estimate: Callable[[], Tiler]) -> Tiler:
-    if tile_size == 0:
+    if tile_size in (0, -4):
+        # backends without a tile size tuner estimate instead
         return estimate()
     if tile_size == -1:
         return NoTiling()
@@ -4,11 +4,12 @@ from enum import Enum
 
 import numpy as np
 from nodes.impl.image_op import ImageOp
-from nodes.impl.image_utils import BorderType
+from nodes.impl.image_utils import BorderType, normalize
 from nodes.impl.resize import ResizeFilter, resize
-from nodes.utils.utils import get_h_w_c
+from nodes.utils.utils import Region, get_h_w_c
 
 from .convenient_upscale import convenient_upscale
+from .exact_split import exact_split
 
 
 @dataclass
@@ -45,6 +46,51 @@ class PaddingType(Enum):
 
 PAD_SIZE = 16
 
+# the size of the tiles of a fused multi-pass upscale after all passes
+FUSED_TILE_OUTPUT_SIZE = 4096
+FUSED_MIN_TILE_SIZE = 128
+
+
+def _fused_overlap(natural_scale: int, iterations: int) -> int:
+    """
+    The overlap in input pixels that covers the edges of all passes of a fused upscale.
+    Every pass needs `PAD_SIZE` pixels of its own input, which are `natural_scale` times
+    fewer pixels in the input of the pass before.
+    """
+    return math.ceil(sum(PAD_SIZE / natural_scale**i for i in range(iterations)))
+
+
+def _fused_multi_pass_upscale(
+    img: np.ndarray,
+    upscale: ImageOp,
+    natural_scale: int,
+    iterations: int,
+) -> np.ndarray:
+    """
+    Applies `upscale` `iterations` times like upscaling the whole image repeatedly, but
+    takes every tile of the input through all passes before it is blended into the
+    result. Only the final result is allocated at full size, no intermediate images are.
+    """
+    h, w, _ = get_h_w_c(img)
+    tile_size = max(
+        FUSED_MIN_TILE_SIZE, FUSED_TILE_OUTPUT_SIZE // natural_scale**iterations
+    )
+
+    def upscale_tile(tile: np.ndarray, _region: Region) -> np.ndarray:
+        for _ in range(iterations):
+            tile = upscale(tile)
+        return tile
+
+    if w <= tile_size and h <= tile_size:
+        return upscale_tile(img, Region(0, 0, w, h))
+
+    return exact_split(
+        img,
+        (min(w, tile_size), min(h, tile_size)),
+        upscale_tile,
+        overlap=_fused_overlap(natural_scale, iterations),
+    )
+
 
 def _custom_scale_upscale(
     img: np.ndarray,
@@ -52,6 +98,8 @@ def _custom_scale_upscale(
     natural_scale: int,
     custom_scale: int,
     separate_alpha: bool,
+    *,
+    fuse_passes: bool = False,
 ) -> np.ndarray:
     if custom_scale == natural_scale:
         return upscale(img)
@@ -60,8 +108,11 @@ def _custom_scale_upscale(
     # e.g. if the model is 2x and the desired scale is 13x, we need to do 4 iterations
     iterations = max(1, math.ceil(math.log(custom_scale, natural_scale)))
     org_h, org_w, _ = get_h_w_c(img)
-    for _ in range(iterations):
-        img = upscale(img)
+    if fuse_passes and iterations > 1:
+        img = _fused_multi_pass_upscale(img, upscale, natural_scale, iterations)
+    else:
+        for _ in range(iterations):
+            img = upscale(img)
 
     # resize, if necessary
     target_size = (
@@ -70,8 +121,9 @@ def _custom_scale_upscale(
     )
     h, w, _ = get_h_w_c(img)
     if (w, h) != target_size:
+        # resizing needs float, upscale results may be quantized to uint8
         img = resize(
-            img,
+            normalize(img),
             target_size,
             ResizeFilter.BOX,
             separate_alpha=separate_alpha,
@@ -87,7 +139,16 @@ def basic_upscale(
     scale: int,
     separate_alpha: bool,
     clip: bool = True,
+    fuse_passes: bool = False,
 ):
+    """
+    Upscales the image with the given upscale function by the given scale.
+
+    If the scale needs several passes of the model, `fuse_passes` takes each tile of
+    the image through all passes before the tiles are blended, instead of upscaling the
+    whole image once per pass.
+    """
+
     def inner_upscale(img: np.ndarray) -> np.ndarray:
         return convenient_upscale(
             img,
@@ -109,6 +170,7 @@ def basic_upscale(
         natural_scale=upscale_info.scale,
         custom_scale=scale,
         separate_alpha=separate_alpha,
+        fuse_passes=fuse_passes,
     )
 
     return img
@@ -4,7 +4,7 @@ import numpy as np
 
 from ...utils.utils import get_h_w_c
 from ..image_op import ImageOp, clipped
-from ..image_utils import as_target_channels
+from ..image_utils import as_target_channels, normalize
 
 
 def with_black_and_white_backgrounds(img: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
@@ -28,6 +28,10 @@ def denoise_and_flatten_alpha(img: np.ndarray) -> np.ndarray:
     return alpha.clip(0, 1)
 
 
+def _as_float(op: ImageOp) -> ImageOp:
+    return lambda i: normalize(op(i))
+
+
 def convenient_upscale(
     img: np.ndarray,
     model_in_nc: int,
@@ -58,6 +62,9 @@ def convenient_upscale(
         return upscale(img)
 
     if in_img_c == 4:
+        # the alpha handling below needs float math, so undo any quantization
+        upscale = _as_float(upscale)
+
         # Ignore alpha if single-color or not being replaced
         unique = np.unique(img[:, :, 3])
         if len(unique) == 1:
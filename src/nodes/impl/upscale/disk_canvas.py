@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import atexit
+import mmap
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+# images whose float32 pixels would take at least this many bytes are assembled on disk
+DISK_CANVAS_THRESHOLD = 2**30
+
+# the canvases on disk by the address of their data: their file, size, and the finalizer
+# that deletes the file once the memory map is gone
+_canvases: dict[int, tuple[str, int, weakref.finalize]] = {}
+
+
+def is_disk_canvas_size(shape: tuple[int, ...]) -> bool:
+    """
+    Returns whether an image of the given shape is large enough to be kept on disk.
+    """
+    return int(np.prod(shape)) * 4 >= DISK_CANVAS_THRESHOLD
+
+
+def is_on_disk(img: np.ndarray) -> bool:
+    """
+    Returns whether the given image is (a view of) a memory-mapped file.
+    """
+    base = img
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, "base", None)
+    return False
+
+
+def allocate_canvas(
+    shape: tuple[int, ...], dtype: np.dtype, on_disk: bool = False
+) -> np.ndarray:
+    """
+    Allocates an uninitialized image of the given shape.
+
+    Images that are large enough (see `is_disk_canvas_size`) or that are requested `on_disk` are a `np.memmap` of a temporary file, so the operating system can page them out instead of holding them in memory. The file is deleted once the canvas is garbage collected, unless it is handed over with `detach_disk_canvas`.
+    """
+    if not on_disk and not is_disk_canvas_size(shape):
+        return np.empty(shape, dtype=dtype)
+
+    fd, path = tempfile.mkstemp(prefix="canvas-", suffix=".raw")
+    os.close(fd)
+    canvas = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+
+    # views of the canvas (e.g. from `np.squeeze`) keep the memory map alive, not the canvas
+    address = canvas.ctypes.data
+    finalizer = weakref.finalize(canvas.base, _release_canvas, address, path)
+    _canvases[address] = (path, canvas.nbytes, finalizer)
+    return canvas
+
+
+def _release_canvas(address: int, path: str) -> None:
+    _canvases.pop(address, None)
+    remove_disk_canvas(path)
+
+
+def detach_disk_canvas(img: np.ndarray) -> str | None:
+    """
+    If the given image is a whole canvas kept on disk (see `allocate_canvas`) or a view of all of it, flushes it and returns the path of its file. The file is no longer deleted automatically, the caller has to delete it with `remove_disk_canvas`.
+
+    Returns `None` for all other images.
+    """
+    if not img.flags.c_contiguous:
+        return None
+    canvas = _canvases.get(img.ctypes.data)
+    if canvas is None:
+        return None
+    path, nbytes, finalizer = canvas
+    if img.nbytes != nbytes:
+        return None
+
+    memory_map = finalizer.peek()
+    if memory_map is not None:
+        memory_map[0].flush()
+    finalizer.detach()
+    del _canvases[img.ctypes.data]
+    return path
+
+
+def remove_disk_canvas(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # the file is still mapped somewhere (Windows doesn't allow deleting it then)
+        atexit.register(_remove_quietly, path)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
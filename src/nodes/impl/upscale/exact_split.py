@@ -3,13 +3,19 @@ from __future__ import annotations
 import math
 from collections.abc import Callable
 from dataclasses import dataclass
+from itertools import pairwise
 
 import numpy as np
 from sanic.log import logger
 
 from ...utils.utils import Padding, Region, Size, get_h_w_c
 from ..image_utils import BorderType, create_border
-from .tile_blending import BlendDirection, TileBlender, TileOverlap, half_sin_blend_fn
+from .tile_blending import (
+    StreamingTileBlender,
+    TileOverlap,
+    blend_dtype,
+    half_sin_blend_fn,
+)
 
 
 def _pad_image(img: np.ndarray, min_size: Size):
@@ -52,35 +58,32 @@ def _exact_split_into_segments(length: int, exact: int, overlap: int) -> list[_S
     assert length > exact
     assert exact > overlap * 2
 
-    result: list[_Segment] = []
-
-    def add(s: _Segment) -> None:
-        assert s.padded_length == exact
-        result.append(s)
-
-    # The current strategy is to go from left to right and to align segments
-    # such that we use the least overlap possible. The last segment will then
-    # be the smallest with potentially a lot of overlap.
-    # While this is easy to implement, it's actually not ideal. Ideally, we
-    # would want for the overlap to be distributed evenly between segments.
-    # However, this is complex to implement and the current method also works.
+    # Neighboring padded segments have to share at least `2 * overlap` pixels, so we need
+    # at least this many segments. Since every segment has the same padded length, the
+    # fewest segments also process the fewest pixels.
+    count = 1 + math.ceil((length - exact) / (exact - overlap * 2))
 
-    # we know that the first segment looks like this
-    add(_Segment(0, exact - overlap, 0, overlap))
+    # The padded segments are spread evenly over the length, so the overlap between
+    # them differs by at most one pixel, and each pair of neighbors splits its shared
+    # pixels in the middle.
+    starts = [round(i * (length - exact) / (count - 1)) for i in range(count)]
+    bounds = [0]
+    for start, next_start in pairwise(starts):
+        bounds.append((next_start + start + exact) // 2)
+    bounds.append(length)
 
-    while result[-1].end < length:
-        start_padding = overlap
-        start = result[-1].end
-        end = start + exact - overlap * 2
-        end_padding = overlap
-
-        if end + end_padding >= length:
-            # last segment
-            end_padding = 0
-            end = length
-            start_padding = exact - (end - start)
-
-        add(_Segment(start, end, start_padding, end_padding))
+    result: list[_Segment] = []
+    for i, padded_start in enumerate(starts):
+        segment = _Segment(
+            bounds[i],
+            bounds[i + 1],
+            bounds[i] - padded_start,
+            padded_start + exact - bounds[i + 1],
+        )
+        assert segment.padded_length == exact
+        assert i == 0 or segment.start_padding >= overlap
+        assert i == count - 1 or segment.end_padding >= overlap
+        result.append(segment)
 
     return result
 
@@ -106,6 +109,10 @@ def _exact_split_into_regions(
         f"Image is split into {len(x_segments)}x{len(y_segments)} tiles each exactly {exact_w}x{exact_h}px."
     )
 
+    # pixels that go through the model more than once because tiles overlap
+    redundancy = len(x_segments) * exact_w * len(y_segments) * exact_h / (w * h) - 1
+    logger.debug(f"Tiles process {redundancy:.1%} more pixels than the image has.")
+
     result: list[list[tuple[Region, Padding]]] = []
     for y in y_segments:
         row: list[tuple[Region, Padding]] = []
@@ -137,15 +144,11 @@ def _exact_split_without_padding(
 
     # To allocate the result image, we need to know the upscale factor first,
     # and we only get to know this factor after the first successful upscale.
-    result: TileBlender | None = None
+    result: StreamingTileBlender | None = None
     scale: int = 0
-    out_channels: int = 0
 
     regions = _exact_split_into_regions(w, h, exact_w, exact_h, overlap)
     for row in regions:
-        row_result: TileBlender | None = None
-        row_overlap: TileOverlap | None = None
-
         for tile, pad in row:
             padded_tile = tile.add_padding(pad)
             assert padded_tile.size == exact_size
@@ -159,38 +162,25 @@ def _exact_split_without_padding(
             assert exact_h * current_scale == up_h
             assert exact_w * current_scale == up_w
 
-            if row_result is None:
+            if result is None:
                 # allocate the result image
                 scale = current_scale
-                out_channels = up_c
-                row_result = TileBlender(
+                result = StreamingTileBlender(
                     width=w * scale,
-                    height=exact_h * scale,
-                    channels=out_channels,
-                    direction=BlendDirection.X,
+                    height=h * scale,
+                    channels=up_c,
                     blend_fn=half_sin_blend_fn,
+                    dtype=blend_dtype(upscale_result),
                 )
-                row_overlap = TileOverlap(pad.top * scale, pad.bottom * scale)
 
             assert current_scale == scale
 
-            row_result.add_tile(
-                upscale_result, TileOverlap(pad.left * scale, pad.right * scale)
+            result.add_tile(
+                upscale_result,
+                TileOverlap(pad.left * scale, pad.right * scale),
+                TileOverlap(pad.top * scale, pad.bottom * scale),
             )
 
-        assert row_result is not None
-        assert row_overlap is not None
-        if result is None:
-            result = TileBlender(
-                width=w * scale,
-                height=h * scale,
-                channels=out_channels,
-                direction=BlendDirection.Y,
-                blend_fn=half_sin_blend_fn,
-            )
-
-        result.add_tile(row_result.get_result(), row_overlap)
-
     assert result is not None
 
     # remove initially added padding
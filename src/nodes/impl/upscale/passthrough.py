@@ -38,3 +38,36 @@ def passthrough_single_color(img: np.ndarray, scale: int, op: ImageOp) -> np.nda
             return np.dstack(channels)
 
     return op(img)
+
+
+def is_near_uniform(img: np.ndarray, threshold: float) -> bool:
+    """
+    Returns whether none of the channels of the given image varies by more than `threshold`.
+
+    `threshold` is relative to the value range of the image (0-1 for float images, 0-255 for uint8 images).
+    This only compares the minimum and maximum of each channel, so it is a lot cheaper than `np.unique`.
+    """
+
+    _, _, c = get_h_w_c(img)
+    if img.dtype == np.uint8:
+        threshold *= 255
+
+    pixels = img.reshape(-1, c)
+    return bool(np.all(pixels.max(axis=0) - pixels.min(axis=0) <= threshold))
+
+
+def fill_uniform(img: np.ndarray, scale: int, dtype: np.dtype) -> np.ndarray:
+    """
+    Returns the given (near-)uniform image upscaled by `scale`, filled with its mean color.
+
+    The result always has a channel axis and has the given dtype (uint8 results are in the range 0-255, float results in the range 0-1).
+    """
+
+    h, w, c = get_h_w_c(img)
+    color = img.reshape(-1, c).mean(axis=0, dtype=np.float64)
+    if img.dtype == np.uint8:
+        color /= 255
+    if dtype == np.uint8:
+        color = np.round(color * 255)
+
+    return np.full((h * scale, w * scale, c), color, dtype)
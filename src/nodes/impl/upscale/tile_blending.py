@@ -8,6 +8,8 @@ from enum import Enum
 import numpy as np
 from nodes.utils.utils import get_h_w_c
 
+from .disk_canvas import allocate_canvas
+
 
 def sin_blend_fn(x: np.ndarray) -> np.ndarray:
     return (np.sin(x * math.pi - math.pi / 2) + 1) / 2
@@ -46,6 +48,28 @@ def _fast_mix(a: np.ndarray, b: np.ndarray, blend: np.ndarray) -> np.ndarray:
     return r
 
 
+def _blend_weights(
+    blend_fn: Callable[[np.ndarray], np.ndarray], blend_size: int
+) -> np.ndarray:
+    return blend_fn(np.arange(blend_size, dtype=np.float32) / (blend_size - 1))
+
+
+# the dtype tiles are blended in unless they are quantized
+FLOAT32 = np.dtype(np.float32)
+
+
+def blend_dtype(tile: np.ndarray) -> np.dtype:
+    """
+    Returns the dtype a `TileBlender` should use to assemble tiles like the given one.
+
+    uint8 tiles (quantized inference output) stay uint8, everything else is blended in
+    float32.
+    """
+    if tile.dtype == np.uint8:
+        return np.dtype(np.uint8)
+    return FLOAT32
+
+
 class TileBlender:
     def __init__(
         self,
@@ -54,6 +78,8 @@ class TileBlender:
         channels: int,
         direction: BlendDirection,
         blend_fn: Callable[[np.ndarray], np.ndarray] = sin_blend_fn,
+        *,
+        dtype: np.dtype = FLOAT32,
         _prev: TileBlender | None = None,
     ) -> None:
         self.direction: BlendDirection = direction
@@ -68,13 +94,14 @@ class TileBlender:
             and _prev.width == width
             and _prev.height == height
             and _prev.channels == channels
+            and _prev.result.dtype == dtype
         ):
             if _prev.blend_fn == blend_fn:
                 # reuse blend
                 self._last_blend = _prev._last_blend  # noqa: SLF001
             result = _prev.result
         else:
-            result = np.zeros((height, width, channels), dtype=np.float32)
+            result = np.zeros((height, width, channels), dtype=dtype)
         self.result: np.ndarray = result
 
     @property
@@ -90,30 +117,31 @@ class TileBlender:
         return self.result.shape[2]
 
     def _get_blend(self, blend_size: int) -> np.ndarray:
+        # the blend only varies along the blend direction, it is broadcast over the rest
         if self.direction == BlendDirection.X:
             if self._last_blend is not None and self._last_blend.shape[1] == blend_size:
                 return self._last_blend
 
-            blend = self.blend_fn(
-                np.arange(blend_size, dtype=np.float32) / (blend_size - 1)
-            )
+            blend = _blend_weights(self.blend_fn, blend_size)
             blend = blend.reshape((1, blend_size, 1))
-            blend = np.repeat(blend, repeats=self.height, axis=0)
-            blend = np.repeat(blend, repeats=self.channels, axis=2)
         else:
             if self._last_blend is not None and self._last_blend.shape[0] == blend_size:
                 return self._last_blend
 
-            blend = self.blend_fn(
-                np.arange(blend_size, dtype=np.float32) / (blend_size - 1)
-            )
+            blend = _blend_weights(self.blend_fn, blend_size)
             blend = blend.reshape((blend_size, 1, 1))
-            blend = np.repeat(blend, repeats=self.width, axis=1)
-            blend = np.repeat(blend, repeats=self.channels, axis=2)
 
         self._last_blend = blend
         return blend
 
+    def _mix(self, a: np.ndarray, b: np.ndarray, blend: np.ndarray) -> np.ndarray:
+        if self.result.dtype == np.float32:
+            return _fast_mix(a, b, blend)
+
+        # blend integer tiles in float and round, assigning would truncate otherwise
+        r = _fast_mix(a.astype(np.float32), b.astype(np.float32), blend)
+        return np.rint(r, out=r)
+
     def add_tile(self, tile: np.ndarray, overlap: TileOverlap) -> None:
         h, w, c = get_h_w_c(tile)
         assert c == self.channels
@@ -156,7 +184,7 @@ class TileBlender:
                 right = tile[:, :blend_size, ...]
 
                 self.result[:, self.offset - o.start : self.offset + o.start, ...] = (
-                    _fast_mix(left, right, blend)
+                    self._mix(left, right, blend)
                 )
 
                 self.offset += w - o.total
@@ -198,7 +226,7 @@ class TileBlender:
                 right = tile[: o.start * 2, :, ...]
 
                 self.result[self.offset - o.start : self.offset + o.start, :, ...] = (
-                    _fast_mix(left, right, blend)
+                    self._mix(left, right, blend)
                 )
 
                 self.offset += h - o.total
@@ -211,3 +239,196 @@ class TileBlender:
             assert self.offset == self.height
 
         return self.result
+
+
+class StreamingTileBlender:
+    """
+    Blends a grid of tiles into one preallocated result image.
+
+    Tiles have to be added row by row, from left to right. Unlike a `TileBlender` per row
+    plus one for the rows, tiles are written in place into the result and only their
+    overlapping strips are blended. The top strip of the current row is assembled in a
+    small buffer, since it can only be blended with the previous row once the row is
+    complete. The result is the same as that of blending rows with `TileBlender`s.
+
+    Large results are kept on disk, see `allocate_canvas`. With `on_disk`, the result is
+    always kept on disk, so only the rows of the current tile row are held in memory.
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        channels: int,
+        blend_fn: Callable[[np.ndarray], np.ndarray] = sin_blend_fn,
+        dtype: np.dtype = FLOAT32,
+        *,
+        on_disk: bool = False,
+    ) -> None:
+        self.blend_fn: Callable[[np.ndarray], np.ndarray] = blend_fn
+        self.offset_x: int = 0
+        self.offset_y: int = 0
+        self.last_end_overlap_x: int = 0
+        self.last_end_overlap_y: int = 0
+        self.result: np.ndarray = allocate_canvas(
+            (height, width, channels), dtype, on_disk=on_disk
+        )
+
+        # the current row
+        self._row_start: int = 0
+        self._row_cut: int = 0
+        self._row_overlap: TileOverlap = TileOverlap(0, 0)
+        self._strip: np.ndarray = self.result[:0]
+
+        self._blends: dict[int, np.ndarray] = {}
+        self._strip_buffer: np.ndarray = self.result[:0]
+        self._scratch: np.ndarray = np.empty(0, dtype=np.float32)
+
+    @property
+    def width(self) -> int:
+        return self.result.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.result.shape[0]
+
+    @property
+    def channels(self) -> int:
+        return self.result.shape[2]
+
+    def _get_blend(self, blend_size: int) -> np.ndarray:
+        blend = self._blends.get(blend_size)
+        if blend is None:
+            blend = _blend_weights(self.blend_fn, blend_size)
+            self._blends[blend_size] = blend
+        return blend
+
+    def _mix_into(self, a: np.ndarray, b: np.ndarray, blend: np.ndarray) -> None:
+        """
+        Sets `a` to `a * (1 - blend) + b * blend` in place. `blend` is broadcast to `a`.
+        """
+        size = a.size
+        if self._scratch.size < size:
+            self._scratch = np.empty(size, dtype=np.float32)
+        r = self._scratch[:size].reshape(a.shape)
+
+        # a + (b - a) * blend
+        np.subtract(b, a, out=r, dtype=np.float32)
+        r *= blend
+        if a.dtype == np.float32:
+            a += r
+        else:
+            # blend integer tiles in float and round, assigning would truncate otherwise
+            r += a
+            np.rint(r, out=r)
+            a[...] = r
+
+    def _start_row(self, tile_height: int, overlap: TileOverlap) -> None:
+        assert self.offset_y < self.height, "All tiles were filled in already"
+
+        self._row_cut = 0
+        if self.offset_y == 0:
+            assert overlap.start == 0
+        elif self.last_end_overlap_y < overlap.start:
+            # we can't use all the overlap of the current row, so we have to cut it off
+            self._row_cut = overlap.start - self.last_end_overlap_y
+            overlap = TileOverlap(self.last_end_overlap_y, overlap.end)
+
+        self._row_overlap = overlap
+        self._row_start = self.offset_y - overlap.start
+
+        strip_height = overlap.start * 2
+        if self._strip_buffer.shape[0] < strip_height:
+            self._strip_buffer = np.empty(
+                (strip_height, self.width, self.channels), dtype=self.result.dtype
+            )
+        self._strip = self._strip_buffer[:strip_height]
+
+        assert tile_height - self._row_cut > overlap.total
+
+    def _end_row(self, tile_height: int) -> None:
+        o = self._row_overlap
+        if o.start > 0:
+            # blend the top strip with the previous row
+            self._mix_into(
+                self.result[self._row_start : self._row_start + o.start * 2, ...],
+                self._strip,
+                self._get_blend(o.start * 2).reshape((o.start * 2, 1, 1)),
+            )
+
+        if self.offset_y == 0:
+            self.offset_y += tile_height - o.end
+        else:
+            self.offset_y += tile_height - o.total
+        self.last_end_overlap_y = o.end
+        self.offset_x = 0
+        self.last_end_overlap_x = 0
+
+    def _add_to_row(self, target: np.ndarray, tile: np.ndarray, start: int) -> None:
+        w = tile.shape[1]
+        if self.offset_x == 0:
+            # the first tile is copied in as is
+            target[:, :w, ...] = tile
+            return
+
+        # copy over the part that doesn't need blending (yet)
+        target[:, self.offset_x + start : self.offset_x + w - start, ...] = tile[
+            :, start * 2 :, ...
+        ]
+
+        # blend the overlapping part
+        self._mix_into(
+            target[:, self.offset_x - start : self.offset_x + start, ...],
+            tile[:, : start * 2, ...],
+            self._get_blend(start * 2).reshape((1, start * 2, 1)),
+        )
+
+    def add_tile(
+        self, tile: np.ndarray, overlap_x: TileOverlap, overlap_y: TileOverlap
+    ) -> None:
+        """
+        Adds the next tile. `overlap_x` and `overlap_y` are the overlaps of the tile with
+        its neighbors, all tiles of a row have to have the same height and `overlap_y`.
+        """
+        h, w, c = get_h_w_c(tile)
+        assert c == self.channels
+
+        if self.offset_x == 0:
+            self._start_row(h, overlap_y)
+        tile = tile[self._row_cut :, ...]
+        h = h - self._row_cut
+
+        o = overlap_x
+        if self.offset_x == 0:
+            assert o.start == 0
+        else:
+            assert self.offset_x < self.width, "All tiles were filled in already"
+            if self.last_end_overlap_x < o.start:
+                # we can't use all the overlap of the current tile, so we have to cut it off
+                diff = o.start - self.last_end_overlap_x
+                tile = tile[:, diff:, ...]
+                w -= diff
+                o = TileOverlap(self.last_end_overlap_x, o.end)
+        assert w > o.total
+
+        strip_height = self._row_overlap.start * 2
+        self._add_to_row(self._strip, tile[:strip_height, ...], o.start)
+        self._add_to_row(
+            self.result[self._row_start + strip_height : self._row_start + h, ...],
+            tile[strip_height:, ...],
+            o.start,
+        )
+
+        if self.offset_x == 0:
+            self.offset_x += w - o.end
+        else:
+            self.offset_x += w - o.total
+        self.last_end_overlap_x = o.end
+
+        if self.offset_x == self.width:
+            self._end_row(h)
+
+    def get_result(self) -> np.ndarray:
+        assert self.offset_y == self.height
+
+        return self.result
@@ -1,4 +1,6 @@
 from abc import ABC, abstractmethod
+from collections.abc import Hashable
+from dataclasses import dataclass
 
 from ...utils.utils import Size
 
@@ -21,6 +23,14 @@ class Tiler(ABC):
         We generally prefer square tile sizes, but any tile size may be used.
         """
 
+    def starting_batch_size(self, tile_size: Size) -> int:
+        """
+        The number of tiles of the given size that may be upscaled at once.
+
+        This is only a starting point. If a batch is too large, the split implementation halves the batch size before it lowers the tile size.
+        """
+        return 1
+
     def split(self, tile_size: Size) -> Size:
         w, h = tile_size
         assert w >= 16 and h >= 16
@@ -41,8 +51,9 @@ class NoTiling(Tiler):
 
 
 class MaxTileSize(Tiler):
-    def __init__(self, tile_size: int = 2**31) -> None:
+    def __init__(self, tile_size: int = 2**31, max_batch_pixels: int = 0) -> None:
         self.tile_size: int = tile_size
+        self.max_batch_pixels: int = max_batch_pixels
 
     def allow_smaller_tile_size(self) -> bool:
         return True
@@ -54,6 +65,11 @@ class MaxTileSize(Tiler):
         size = min(self.tile_size, max_tile_size)
         return size, size
 
+    def starting_batch_size(self, tile_size: Size) -> int:
+        # as many tiles as fit into the pixels the memory budget allows for
+        w, h = tile_size
+        return max(1, self.max_batch_pixels // (w * h))
+
 
 class ExactTileSize(Tiler):
     def __init__(self, exact_size: Size) -> None:
@@ -70,3 +86,68 @@ class ExactTileSize(Tiler):
             f"Splits are not supported for exact size ({self.exact_size[0]}x{self.exact_size[1]}px) splitting."
             f" This typically means that your machine does not have enough VRAM to run the current model."
         )
+
+
+@dataclass
+class _KnownTileSize:
+    tile_size: Size
+    successes: int = 0
+
+
+class TileSizeMemory:
+    """
+    Remembers the tile sizes the split implementation had to fall back to, so that later images with the same key start at the tile size that worked instead of running out of memory again.
+
+    After `probe_interval` images in a row succeeded without a split, the next image probes a tile size twice as large.
+    """
+
+    def __init__(self) -> None:
+        self._known: dict[Hashable, _KnownTileSize] = {}
+
+    def get(self, key: Hashable) -> Size | None:
+        known = self._known.get(key)
+        return known.tile_size if known is not None else None
+
+    def record_split(self, key: Hashable, tile_size: Size) -> None:
+        self._known[key] = _KnownTileSize(tile_size)
+
+    def record_success(self, key: Hashable, probe_interval: int) -> None:
+        known = self._known.get(key)
+        if known is None:
+            return
+
+        known.successes += 1
+        if probe_interval > 0 and known.successes >= probe_interval:
+            w, h = known.tile_size
+            known.tile_size = w * 2, h * 2
+            known.successes = 0
+
+    def wrap(self, tiler: Tiler, key: Hashable) -> Tiler:
+        if not tiler.allow_smaller_tile_size():
+            return tiler
+        return _RememberingTiler(tiler, self, key)
+
+
+class _RememberingTiler(Tiler):
+    def __init__(self, tiler: Tiler, memory: TileSizeMemory, key: Hashable) -> None:
+        self.tiler = tiler
+        self.memory = memory
+        self.key = key
+
+    def allow_smaller_tile_size(self) -> bool:
+        return self.tiler.allow_smaller_tile_size()
+
+    def starting_tile_size(self, width: int, height: int, channels: int) -> Size:
+        w, h = self.tiler.starting_tile_size(width, height, channels)
+        known = self.memory.get(self.key)
+        if known is not None:
+            w, h = min(w, known[0]), min(h, known[1])
+        return w, h
+
+    def starting_batch_size(self, tile_size: Size) -> int:
+        return self.tiler.starting_batch_size(tile_size)
+
+    def split(self, tile_size: Size) -> Size:
+        tile_size = self.tiler.split(tile_size)
+        self.memory.record_split(self.key, tile_size)
+        return tile_size
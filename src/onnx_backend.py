@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import weakref
+from threading import Lock, Thread
+
+import numpy as np
+import onnxruntime as ort
+import psutil
+from nodes.impl.image_op import ImageOp
+from nodes.impl.image_utils import normalize
+from nodes.impl.onnx.auto_split import onnx_auto_split
+from nodes.impl.onnx.model import OnnxGeneric, OnnxInfo, SizeReq
+from nodes.impl.onnx.session import (
+    ORT_ERRORS,
+    create_cpu_session_options,
+    get_onnx_session,
+)
+from nodes.impl.pytorch.convert_to_onnx_impl import is_onnx_supported
+from nodes.impl.pytorch.onnx_export_cache import ONNX_OPSET, get_onnx_export
+from nodes.impl.upscale.auto_split_tiles import (
+    TileSize,
+    estimate_tile_size,
+    parse_tile_size_input,
+)
+from nodes.impl.upscale.basic_upscale import UpscaleInfo, basic_upscale
+from nodes.impl.upscale.tiler import MaxTileSize
+from nodes.utils.utils import get_h_w_c
+from sanic.log import logger
+from spandrel import ImageModelDescriptor, ModelDescriptor
+
+# the ONNX export of each PyTorch model
+ONNX_MODELS: weakref.WeakKeyDictionary[ModelDescriptor, OnnxGeneric] = (
+    weakref.WeakKeyDictionary()
+)
+
+# the tile size the session is warmed up with if the tile size isn't fixed
+WARM_UP_TILE_SIZE = 256
+
+# the overlap between tiles, the warm-up tile is padded by it like the real tiles
+TILE_OVERLAP = 16
+
+# exporting and optimizing a model happens once, even with a warm-up running
+_session_lock = Lock()
+
+
+def supports_onnx_backend(model: ModelDescriptor) -> bool:
+    """
+    whether the model can be exported to ONNX and run with ONNX Runtime
+    """
+    return (
+        isinstance(model, ImageModelDescriptor)
+        and is_onnx_supported(model)
+        and not model.size_requirements.square
+    )
+
+
+def get_onnx_model(model: ImageModelDescriptor, cache_dir: str) -> OnnxGeneric:
+    """
+    the model exported to ONNX at full precision, exported on first use and cached in
+    cache_dir
+    """
+    onnx_model = ONNX_MODELS.get(model)
+    if onnx_model is None:
+        info = OnnxInfo(
+            opset=ONNX_OPSET,
+            dtype="float32",
+            scale_width=model.scale,
+            scale_height=model.scale,
+            input_channels=model.input_channels,
+            output_channels=model.output_channels,
+            size_req=SizeReq(
+                minimum=max(1, model.size_requirements.minimum),
+                multiple_of=model.size_requirements.multiple_of,
+            ),
+        )
+        onnx_model = OnnxGeneric(get_onnx_export(model, cache_dir), info)
+        ONNX_MODELS[model] = onnx_model
+    return onnx_model
+
+
+def get_session(
+    model: ImageModelDescriptor,
+    cache_dir: str,
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+) -> tuple[OnnxGeneric, ort.InferenceSession]:
+    """
+    the exported model and its session. the optimized model is cached in cache_dir
+    next to the export, so later runs skip most of the graph optimizations
+    """
+    with _session_lock:
+        onnx_model = get_onnx_model(model, cache_dir)
+        session_options = create_cpu_session_options(intra_op_threads, inter_op_threads)
+        session = get_onnx_session(
+            onnx_model,
+            0,
+            "CPUExecutionProvider",
+            False,
+            session_options=session_options,
+            optimized_model_cache_path=cache_dir,
+        )
+        return onnx_model, session
+
+
+def warm_up(
+    model: ImageModelDescriptor,
+    tile_size: TileSize,
+    cache_dir: str,
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+) -> None:
+    """
+    create the session of the model and run one tile through it in the background, so
+    the first page doesn't wait for the export, the graph optimizations and the first
+    allocations. the tile has the fixed tile size plus overlap, or WARM_UP_TILE_SIZE
+    """
+
+    def run() -> None:
+        try:
+            onnx_model, session = get_session(
+                model, cache_dir, intra_op_threads, inter_op_threads
+            )
+            size = tile_size if tile_size > 0 else WARM_UP_TILE_SIZE
+            size += 2 * TILE_OVERLAP
+            pad_w, pad_h = onnx_model.info.size_req.get_padding(size, size)
+            tile = np.zeros(
+                (1, model.input_channels, size + pad_h, size + pad_w), np.float32
+            )
+            session.run(None, {session.get_inputs()[0].name: tile})
+            logger.debug(f"Warmed up {model.architecture.name} with ONNX Runtime")
+        except (*ORT_ERRORS, OSError, MemoryError) as e:
+            # the first page reports the problem
+            logger.warning(f"Unable to warm up {model.architecture.name}: {e}")
+
+    Thread(target=run, daemon=True).start()
+
+
+def _estimate_tiler(img: np.ndarray, model: ImageModelDescriptor) -> MaxTileSize:
+    """
+    the largest tiles that fit into the available memory, with the same heuristic as the
+    PyTorch CPU backend
+    """
+    budget = int(psutil.virtual_memory().available * 0.8)
+    model_bytes = sum(p.numel() * 4 for p in model.model.parameters())
+    return MaxTileSize(estimate_tile_size(budget, model_bytes, img, 4))
+
+
+def onnx_upscale_image(
+    img: np.ndarray,
+    model: ImageModelDescriptor,
+    tile_size: TileSize,
+    *,
+    cache_dir: str,
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+    output_uint8: bool = False,
+    uniform_tile_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+    tile_op_overlap: int = 0,
+) -> np.ndarray:
+    """
+    upscale the image like upscale_image, but run the model with ONNX Runtime on the
+    CPU. images are RGB, tiles are split and blended the same way as with PyTorch, and
+    the results are float unless output_uint8 is set
+    """
+    onnx_model, session = get_session(
+        model, cache_dir, intra_op_threads, inter_op_threads
+    )
+
+    def upscale(i: np.ndarray) -> np.ndarray:
+        i = normalize(i)
+        _, _, c = get_h_w_c(i)
+        if c == 1 and model.input_channels > 1:
+            # grayscale images are passed through as they are, see convenient_upscale
+            i = np.repeat(i.reshape(*i.shape[:2], 1), model.input_channels, axis=2)
+            return onnx_upscale(i)[..., :1]
+        return onnx_upscale(i)
+
+    overlap = TILE_OVERLAP
+    if tile_op is not None:
+        # the tile op needs context beyond the part of the tiles that is blended
+        overlap = max(overlap, tile_op_overlap)
+    if model.input_channels != model.output_channels:
+        # filled tiles keep the channels of the input
+        uniform_tile_threshold = 0
+
+    def onnx_upscale(i: np.ndarray) -> np.ndarray:
+        tiler = parse_tile_size_input(tile_size, lambda: _estimate_tiler(i, model))
+        return onnx_auto_split(
+            i,
+            session,
+            change_shape=False,
+            tiler=tiler,
+            size_req=onnx_model.info.size_req,
+            flip_r_b=False,
+            overlap=overlap,
+            output_uint8=output_uint8,
+            uniform_threshold=uniform_tile_threshold,
+            scale=model.scale,
+            tile_op=tile_op,
+        )
+
+    logger.debug("Upscaling image with ONNX Runtime")
+    return basic_upscale(
+        img,
+        upscale,
+        upscale_info=UpscaleInfo(
+            in_nc=model.input_channels, out_nc=model.output_channels, scale=model.scale
+        ),
+        scale=model.scale,
+        separate_alpha=False,
+    )
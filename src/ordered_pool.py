@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class OrderedWorkerPool(Generic[T]):
+    """
+    Runs jobs on a pool of worker threads and passes their results to `sink` in the
+    order in which the jobs were submitted.
+
+    Results that finish early are held back in a reorder buffer until all earlier jobs
+    are done. At most `max_pending` jobs are running or buffered at any time, `submit`
+    blocks (by handing finished results to `sink`) once that limit is reached.
+
+    `sink` is only ever called from the thread that submits jobs.
+    """
+
+    def __init__(
+        self,
+        worker_count: int,
+        sink: Callable[[T], None],
+        max_pending: int = 0,
+        name: str = "worker",
+    ) -> None:
+        self.worker_count: int = max(1, worker_count)
+        self.max_pending: int = max(
+            self.worker_count, max_pending or self.worker_count * 2
+        )
+        self._sink = sink
+        self._pending: deque[Future[T]] = deque()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.worker_count, thread_name_prefix=name
+        )
+
+    def submit(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> None:
+        self._wait_for_room()
+        self._append(self._executor.submit(fn, *args, **kwargs))
+
+    def submit_result(self, result: T) -> None:
+        """
+        Passes an already available result to the sink, in order with the submitted jobs.
+        """
+        self._wait_for_room()
+        future: Future[T] = Future()
+        future.set_result(result)
+        self._append(future)
+
+    def _wait_for_room(self) -> None:
+        while len(self._pending) >= self.max_pending:
+            self._flush_next()
+
+    def _append(self, future: Future[T]) -> None:
+        self._pending.append(future)
+
+        # hand over everything that is already done, without waiting
+        while self._pending and self._pending[0].done():
+            self._flush_next()
+
+    def drain(self) -> None:
+        """
+        Waits for all submitted jobs and passes their results to the sink.
+        """
+        while self._pending:
+            self._flush_next()
+
+    def close(self) -> None:
+        try:
+            self.drain()
+        finally:
+            self._executor.shutdown()
+
+    def _flush_next(self) -> None:
+        self._sink(self._pending.popleft().result())
+
+    def __enter__(self) -> OrderedWorkerPool[T]:
+        return self
+
+    def __exit__(self, exc_type: object, exc: object, tb: object) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._pending.clear()
+            self._executor.shutdown(cancel_futures=True)
@@ -6,18 +6,30 @@ import numpy as np
 import psutil
 import torch
 from nodes.groups import Condition, if_enum_group, if_group
-from nodes.impl.pytorch.auto_split import pytorch_auto_split
+from nodes.impl.image_op import ImageOp
+from nodes.impl.pytorch.auto_split import pytorch_auto_split, pytorch_upscale_batch
+from nodes.impl.pytorch.memory_model import (
+    MemoryModel,
+    get_memory_model,
+    tile_size_for_pixels,
+)
+from nodes.impl.pytorch.overlap_calibration import DEFAULT_OVERLAP, get_tile_overlap
+from nodes.impl.pytorch.tile_autotune import autotune_tile_size
 from nodes.impl.pytorch.utils import safe_cuda_cache_empty
+from nodes.impl.upscale.auto_split import Split
 from nodes.impl.upscale.auto_split_tiles import (
+    AUTOTUNE,
     CUSTOM,
+    ESTIMATE,
     NO_TILING,
     TILE_SIZE_256,
     TileSize,
+    estimate_tile_pixels,
     estimate_tile_size,
     parse_tile_size_input,
 )
 from nodes.impl.upscale.basic_upscale import UpscaleInfo, basic_upscale
-from nodes.impl.upscale.tiler import MaxTileSize
+from nodes.impl.upscale.tiler import ExactTileSize, MaxTileSize, TileSizeMemory
 from nodes.properties.inputs import (
     BoolInput,
     ImageInput,
@@ -26,6 +38,7 @@ from nodes.properties.inputs import (
     TileSizeDropdown,
 )
 from nodes.properties.outputs import ImageOutput
+from nodes.utils.utils import get_h_w_c
 from sanic.log import logger
 from spandrel import ImageModelDescriptor, ModelTiling
 
@@ -35,6 +48,136 @@ from ...settings import PyTorchSettings, get_settings
 from .. import processing_group
 
 MODEL_BYTES_CACHE = weakref.WeakKeyDictionary()
+TILE_SIZE_MEMORY = weakref.WeakKeyDictionary()
+
+# the memory model is fit on small probe tiles, larger tiles get this factor of headroom
+# for allocator fragmentation and measurement noise
+MEMORY_MODEL_SAFETY_MARGIN = 1.25
+
+
+def _memory_budget(
+    model: ImageModelDescriptor, options: PyTorchSettings
+) -> tuple[int, int, int] | None:
+    """
+    Returns the memory budget, the model size and the image element size in bytes, or
+    `None` if the device is unknown.
+    """
+    device = options.device
+    use_fp16 = options.use_fp16
+
+    model_bytes = MODEL_BYTES_CACHE.get(model)
+    if model_bytes is None:
+        model_bytes = sum(p.numel() * 4 for p in model.model.parameters())
+        MODEL_BYTES_CACHE[model] = model_bytes
+
+    if "cuda" in device.type:
+        if options.use_fp16:
+            model_bytes = model_bytes // 2
+        mem_info: tuple[int, int] = torch.cuda.mem_get_info(device)  # type: ignore
+        _free, total = mem_info
+        # only use 75% of the total memory
+        total = int(total * 0.75)
+        if options.budget_limit > 0:
+            total = min(options.budget_limit * 1024**3, total)
+        # Estimate using 80% of the value to be more conservative
+        budget = int(total * 0.8)
+
+        return budget, model_bytes, 2 if use_fp16 else 4
+    elif device.type == "cpu":
+        free = psutil.virtual_memory().available
+        if options.budget_limit > 0:
+            free = min(options.budget_limit * 1024**3, free)
+        budget = int(free * 0.8)
+        return budget, model_bytes, 4
+    return None
+
+
+def _memory_model_pixels(
+    memory_model: MemoryModel,
+    options: PyTorchSettings,
+    budget: int,
+    model_bytes: int,
+) -> int:
+    """
+    The largest number of pixels the measured memory model allows for within the budget,
+    with `MEMORY_MODEL_SAFETY_MARGIN` of headroom.
+    """
+    if options.device.type != "cpu":
+        # the memory model only covers the memory on top of the loaded model. the CPU
+        # budget comes from the available RAM, which the loaded model is already gone from
+        budget -= model_bytes
+    return memory_model.max_pixels(int(budget / MEMORY_MODEL_SAFETY_MARGIN))
+
+
+def _estimate_tiler(
+    img: np.ndarray,
+    model: ImageModelDescriptor,
+    options: PyTorchSettings,
+    progress: Progress,
+    overlap: int = DEFAULT_OVERLAP,
+) -> MaxTileSize:
+    """
+    The largest tiles that fit into the memory budget, from the measured memory model of
+    the model if memory calibration is enabled, or from a heuristic otherwise.
+    """
+    memory = _memory_budget(model, options)
+    if memory is None:
+        return MaxTileSize()
+    budget, model_bytes, element_size = memory
+
+    if options.calibrate_memory:
+        memory_model = get_memory_model(
+            model,
+            options.device,
+            options.use_fp16,
+            channels=get_h_w_c(img)[2],
+            cache_dir=options.tile_size_cache,
+            progress=progress,
+        )
+        if memory_model is not None:
+            tile_pixels = _memory_model_pixels(
+                memory_model, options, budget, model_bytes
+            )
+            return MaxTileSize(
+                tile_size_for_pixels(tile_pixels, overlap),
+                max_batch_pixels=tile_pixels,
+            )
+
+    return MaxTileSize(
+        estimate_tile_size(budget, model_bytes, img, element_size),
+        max_batch_pixels=estimate_tile_pixels(budget, model_bytes, img, element_size),
+    )
+
+
+def _known_max_batch_pixels(
+    img: np.ndarray,
+    model: ImageModelDescriptor,
+    options: PyTorchSettings,
+    progress: Progress,
+) -> int:
+    """
+    The pixels a batch of tiles may have if the memory model of the model was already
+    measured, and 0 otherwise. Fixed tile sizes use this, they never estimate or measure.
+    """
+    if not options.calibrate_memory:
+        return 0
+    memory = _memory_budget(model, options)
+    if memory is None:
+        return 0
+    budget, model_bytes, _ = memory
+
+    memory_model = get_memory_model(
+        model,
+        options.device,
+        options.use_fp16,
+        channels=get_h_w_c(img)[2],
+        cache_dir=options.tile_size_cache,
+        progress=progress,
+        measure=False,
+    )
+    if memory_model is None:
+        return 0
+    return _memory_model_pixels(memory_model, options, budget, model_bytes)
 
 
 def upscale(
@@ -43,6 +186,10 @@ def upscale(
     tile_size: TileSize,
     options: PyTorchSettings,
     progress: Progress,
+    *,
+    uniform_tile_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+    tile_op_overlap: int = 0,
 ):
     with torch.no_grad():
         # Borrowed from iNNfer
@@ -56,60 +203,180 @@ def upscale(
             # disable tiling if the model already does it internally
             tile_size = NO_TILING
 
-        def estimate():
-            model_bytes = MODEL_BYTES_CACHE.get(model)
-            if model_bytes is None:
-                model_bytes = sum(p.numel() * 4 for p in model.model.parameters())
-                MODEL_BYTES_CACHE[model] = model_bytes
-
-            if "cuda" in device.type:
-                if options.use_fp16:
-                    model_bytes = model_bytes // 2
-                mem_info: tuple[int, int] = torch.cuda.mem_get_info(device)  # type: ignore
-                _free, total = mem_info
-                # only use 75% of the total memory
-                total = int(total * 0.75)
-                if options.budget_limit > 0:
-                    total = min(options.budget_limit * 1024**3, total)
-                # Estimate using 80% of the value to be more conservative
-                budget = int(total * 0.8)
-
-                return MaxTileSize(
-                    estimate_tile_size(
-                        budget,
-                        model_bytes,
-                        img,
-                        2 if use_fp16 else 4,
-                    )
-                )
-            elif device.type == "cpu":
-                free = psutil.virtual_memory().available
-                if options.budget_limit > 0:
-                    free = min(options.budget_limit * 1024**3, free)
-                budget = int(free * 0.8)
-                return MaxTileSize(
-                    estimate_tile_size(
-                        budget,
-                        model_bytes,
-                        img,
-                        4,
-                    )
-                )
-            return MaxTileSize()
+        overlap = DEFAULT_OVERLAP
+        if options.seam_tolerance > 0 and tile_size != NO_TILING:
+            overlap = get_tile_overlap(
+                model,
+                device,
+                use_fp16,
+                channels=get_h_w_c(img)[2],
+                cache_dir=options.tile_size_cache,
+                seam_tolerance=options.seam_tolerance,
+                progress=progress,
+            )
+        if tile_op is not None and overlap < tile_op_overlap:
+            # the tile op needs context beyond the part of the tiles that is blended
+            overlap = tile_op_overlap
+
+        tuned_tiler: ExactTileSize | None = None
+        if tile_size == AUTOTUNE:
+            tuned_tile_size = autotune_tile_size(
+                model,
+                device,
+                use_fp16,
+                channels=get_h_w_c(img)[2],
+                cache_dir=options.tile_size_cache,
+                progress=progress,
+                overlap=overlap,
+            )
+            if tuned_tile_size is None:
+                tile_size = ESTIMATE
+            else:
+                tile_size = TileSize(tuned_tile_size)
+                # keep the benchmarked (aligned) tile size instead of letting the
+                # splitter even the tiles out to some other size
+                tuned_padded_size = tuned_tile_size + 2 * overlap
+                h, w, _ = get_h_w_c(img)
+                if h >= tuned_padded_size and w >= tuned_padded_size:
+                    tuned_tiler = ExactTileSize((tuned_padded_size, tuned_padded_size))
+
+        def estimate() -> MaxTileSize:
+            return _estimate_tiler(img, model, options, progress, overlap)
+
+        tiler = parse_tile_size_input(tile_size, estimate)
+        if tuned_tiler is not None:
+            tiler = tuned_tiler
+        elif tile_size > 0:
+            # fixed tile sizes are only batched if the memory budget is already known
+            tiler = MaxTileSize(
+                tile_size,
+                max_batch_pixels=_known_max_batch_pixels(img, model, options, progress),
+            )
+
+        # start where earlier images of the same size class had to split to
+        h, w, c = get_h_w_c(img)
+        memory_key = (str(device), use_fp16, c, h.bit_length(), w.bit_length())
+        tile_size_memory = TILE_SIZE_MEMORY.setdefault(model, TileSizeMemory())
+        tiler = tile_size_memory.wrap(tiler, memory_key)
 
         img_out = pytorch_auto_split(
             img,
             model=model,
             device=device,
             use_fp16=use_fp16,
-            tiler=parse_tile_size_input(tile_size, estimate),
+            tiler=tiler,
             progress=progress,
+            output_uint8=options.output_uint8,
+            uniform_threshold=uniform_tile_threshold,
+            tile_op=tile_op,
+            overlap=overlap,
         )
+        tile_size_memory.record_success(memory_key, options.tile_size_probe_interval)
         logger.debug("Done upscaling")
 
         return img_out
 
 
+def upscale_images(
+    context: NodeContext,
+    imgs: list[np.ndarray],
+    model: ImageModelDescriptor,
+    tile_size: TileSize,
+    *,
+    uniform_tile_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+    tile_op_overlap: int = 0,
+) -> list[np.ndarray] | None:
+    """
+    Upscales several images with as few forward passes as the memory budget allows. The
+    images are padded to a common size by repeating their edges, and the padding is
+    removed from the results.
+
+    Only images that would be upscaled in one piece can be batched: grayscale images or
+    images with the model's input channels that don't need tiling. Returns `None` for any
+    other images, they have to be upscaled one by one.
+    """
+    options = get_settings(context)
+
+    if model.tiling == ModelTiling.INTERNAL:
+        return None
+
+    sizes = [get_h_w_c(img) for img in imgs]
+    h = max(size[0] for size in sizes)
+    w = max(size[1] for size in sizes)
+    channels = {size[2] for size in sizes}
+    if len(channels) != 1 or len({img.dtype for img in imgs}) != 1:
+        return None
+    if channels.pop() not in (1, model.input_channels):
+        return None
+    if tile_size > 0 and max(w, h) > tile_size:
+        return None
+
+    if tile_size > 0:
+        max_batch_pixels = _known_max_batch_pixels(imgs[0], model, options, context)
+    else:
+        max_batch_pixels = _estimate_tiler(
+            imgs[0], model, options, context
+        ).max_batch_pixels
+    batch_size = max_batch_pixels // (w * h)
+    if batch_size < 2:
+        return None
+
+    context.add_cleanup(
+        safe_cuda_cache_empty,
+        after="node" if options.force_cache_wipe else "chain",
+    )
+
+    def pad(img: np.ndarray) -> np.ndarray:
+        img_h, img_w, _ = get_h_w_c(img)
+        pad_width = [(0, h - img_h), (0, w - img_w)] + [(0, 0)] * (img.ndim - 2)
+        return np.pad(img, pad_width, mode="edge")
+
+    logger.debug(f"Upscaling {len(imgs)} images in batches of up to {batch_size}")
+
+    results: list[np.ndarray] = []
+    while len(results) < len(imgs):
+        batch = imgs[len(results) : len(results) + batch_size]
+        if batch_size == 1:
+            results.append(
+                upscale(
+                    batch[0],
+                    model,
+                    tile_size,
+                    options,
+                    context,
+                    uniform_tile_threshold=uniform_tile_threshold,
+                    tile_op=tile_op,
+                    tile_op_overlap=tile_op_overlap,
+                )
+            )
+            continue
+
+        batch_result = pytorch_upscale_batch(
+            np.stack([pad(img) for img in batch]),
+            model=model,
+            device=options.device,
+            use_fp16=options.use_fp16,
+            progress=context,
+            output_uint8=options.output_uint8,
+            uniform_threshold=uniform_tile_threshold,
+            tile_op=tile_op,
+        )
+        if isinstance(batch_result, Split):
+            batch_size //= 2
+            logger.debug(f"Split occurred. New batch size is {batch_size}.")
+            continue
+
+        scale = batch_result.shape[1] // h
+        batch_sizes = sizes[len(results) : len(results) + len(batch)]
+        for (img_h, img_w, _), img_result in zip(
+            batch_sizes, batch_result, strict=True
+        ):
+            results.append(img_result[: img_h * scale, : img_w * scale])
+
+    return results
+
+
 @processing_group.register(
     schema_id="chainner:pytorch:upscale_image",
     name="Upscale Image",
@@ -264,6 +531,44 @@ def upscale_image_node(
     custom_tile_size: int,
     separate_alpha: bool,
 ) -> np.ndarray:
+    info = UpscaleInfo(
+        in_nc=model.input_channels, out_nc=model.output_channels, scale=model.scale
+    )
+    if not use_custom_scale or not info.supports_custom_scale:
+        custom_scale = model.scale
+
+    return upscale_image(
+        context,
+        img,
+        model,
+        TileSize(custom_tile_size) if tile_size == CUSTOM else tile_size,
+        scale=custom_scale,
+        separate_alpha=separate_alpha,
+    )
+
+
+def upscale_image(
+    context: NodeContext,
+    img: np.ndarray,
+    model: ImageModelDescriptor,
+    tile_size: TileSize,
+    scale: int | None = None,
+    *,
+    separate_alpha: bool = False,
+    uniform_tile_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+    tile_op_overlap: int = 0,
+) -> np.ndarray:
+    """
+    Upscales the image like the Upscale Image node. `scale` defaults to the scale of the
+    model.
+
+    Tiles whose channels vary by at most `uniform_tile_threshold` (0-1) are filled with
+    their color instead of going through the model, 0 disables this. `tile_op` is
+    applied to every upscaled tile before blending, see `pytorch_auto_split`. Tiles
+    overlap by at least `tile_op_overlap` pixels then, so edge effects of the tile op
+    stay out of the blended result.
+    """
     exec_options = get_settings(context)
 
     context.add_cleanup(
@@ -274,20 +579,22 @@ def upscale_image_node(
     info = UpscaleInfo(
         in_nc=model.input_channels, out_nc=model.output_channels, scale=model.scale
     )
-    if not use_custom_scale or not info.supports_custom_scale:
-        custom_scale = model.scale
 
     return basic_upscale(
         img,
         lambda i: upscale(
             i,
             model,
-            TileSize(custom_tile_size) if tile_size == CUSTOM else tile_size,
+            tile_size,
             exec_options,
             context,
+            uniform_tile_threshold=uniform_tile_threshold,
+            tile_op=tile_op,
+            tile_op_overlap=tile_op_overlap,
         ),
         upscale_info=info,
-        scale=custom_scale,
+        scale=scale or model.scale,
         separate_alpha=separate_alpha,
         clip=False,  # pytorch_auto_split already does clipping internally
+        fuse_passes=exec_options.fuse_custom_scale_passes,
     )
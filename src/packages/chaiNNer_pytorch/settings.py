@@ -5,7 +5,13 @@ from gpu import nvidia
 from sanic.log import logger
 from system import is_arm_mac
 
-from api import DropdownSetting, NodeContext, NumberSetting, ToggleSetting
+from api import (
+    CacheSetting,
+    DropdownSetting,
+    NodeContext,
+    NumberSetting,
+    ToggleSetting,
+)
 
 from . import package
 
@@ -75,6 +81,64 @@ package.add_setting(
     )
 )
 
+package.add_setting(
+    ToggleSetting(
+        label="Quantize Output to 8-bit",
+        key="output_uint8",
+        description="Converts upscaled images to 8-bit on the inference device before they are copied back and assembled. This cuts the memory used by upscaled images by 4x, but the Upscale Image node will output 8-bit (uint8) images instead of float images.",
+        default=False,
+    )
+)
+
+package.add_setting(
+    NumberSetting(
+        label="Tile Size Probe Interval",
+        key="tile_size_probe_interval",
+        description="When an image runs out of memory and has to be split into smaller tiles, the following images start at the smaller tile size. After this many images succeeded, a tile size twice as large is tried again. 0 means the smaller tile size is kept.",
+        default=16,
+        min=0,
+        max=1000,
+    )
+)
+
+package.add_setting(
+    ToggleSetting(
+        label="Calibrate Memory Usage",
+        key="calibrate_memory",
+        description="Measures the peak memory of each model at a few small tile sizes the first time it is used, and picks automatic tile sizes from these measurements instead of a rough estimate. The measurements are stored in the tile size cache.",
+        default=True,
+    )
+)
+
+package.add_setting(
+    NumberSetting(
+        label="Tile Seam Tolerance",
+        key="seam_tolerance",
+        description="Calibrates the overlap between tiles for each model the first time it is used: the smallest overlap is used whose seams differ from an untiled upscale by at most this many levels (of 255) at any pixel around the seam. Compact models need less overlap than the default of 16px, large models may need more. The calibration is stored in the tile size cache. 0 always uses an overlap of 16px.",
+        default=0,
+        min=0,
+        max=255,
+    )
+)
+
+package.add_setting(
+    ToggleSetting(
+        label="Fuse Custom Scale Passes",
+        key="fuse_custom_scale_passes",
+        description="When a custom scale needs several passes of the model (e.g. 8x with a 2x model), each tile of the image goes through all passes before the tiles are blended. This avoids upscaling the whole image once per pass, which needs a lot of memory for the intermediate images.",
+        default=False,
+    )
+)
+
+package.add_setting(
+    CacheSetting(
+        label="Tile Size Cache",
+        key="tile_size_cache",
+        description="Where the tile sizes measured by the tuned tile size mode and the memory calibration are stored. Each model is only measured once per device and precision.",
+        directory="pytorch_tile_size_cache",
+    )
+)
+
 if nvidia.is_available:
     package.add_setting(
         ToggleSetting(
@@ -93,6 +157,12 @@ class PyTorchSettings:
     gpu_index: int
     budget_limit: int
     force_cache_wipe: bool = False
+    output_uint8: bool = False
+    tile_size_cache: str | None = None
+    calibrate_memory: bool = False
+    tile_size_probe_interval: int = 0
+    fuse_custom_scale_passes: bool = False
+    seam_tolerance: int = 0
 
     # PyTorch 2.0 does not support FP16 when using CPU
     def __post_init__(self):
@@ -134,4 +204,12 @@ def get_settings(context: NodeContext) -> PyTorchSettings:
         gpu_index=settings.get_int("gpu_index", 0, parse_str=True),
         budget_limit=settings.get_int("budget_limit", 0, parse_str=True),
         force_cache_wipe=settings.get_bool("force_cache_wipe", False),
+        output_uint8=settings.get_bool("output_uint8", False),
+        tile_size_cache=settings.get_cache_location("tile_size_cache"),
+        calibrate_memory=settings.get_bool("calibrate_memory", True),
+        tile_size_probe_interval=settings.get_int(
+            "tile_size_probe_interval", 16, parse_str=True
+        ),
+        fuse_custom_scale_passes=settings.get_bool("fuse_custom_scale_passes", False),
+        seam_tolerance=settings.get_int("seam_tolerance", 0, parse_str=True),
     )
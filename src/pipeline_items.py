@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import numpy as np
+from content_crop import ContentCrop
+from nodes.impl.upscale.auto_split_tiles import ESTIMATE, TileSize
+from nodes.impl.upscale.disk_canvas import remove_disk_canvas
+from shared_page_ring import SharedPage
+from upscale_manifest import ManifestEntry
+
+if TYPE_CHECKING:
+    from spandrel import ModelDescriptor
+
+
+@dataclass(frozen=True)
+class ArchiveStart:
+    """
+    Marks the start of an output archive. Its entries follow in archive order.
+    """
+
+    output_archive_path: str
+    entry_count: int
+    manifest_entry: ManifestEntry | None = None
+
+
+@dataclass(frozen=True)
+class ArchiveEnd:
+    """
+    Marks the end of an output archive. The archive is finalized once all entries before
+    this marker have been written.
+    """
+
+    output_archive_path: str
+
+
+@dataclass
+class UpscaleItem:
+    """
+    A preprocessed page on its way to the upscale worker.
+
+    `destination` is the output file path of the page, or its entry name inside
+    `output_archive_path` for archive pages, `archive_index` is the position of an archive
+    page in its archive. Pages that could not be read as images (`is_image` is false)
+    carry the raw file data, which is copied as is. `manifest_entry` is recorded in the
+    manifest once the page is written. Tiles of the page that vary by at most
+    `uniform_tile_threshold` (0-1) are filled instead of upscaled, and upscaled tiles are
+    downscaled by `tile_downscale` before they are blended. `content_crop` is set
+    if the image was cropped to its content and has to be placed back on its margins
+    after upscaling.
+    """
+
+    image: np.ndarray | bytes | None
+    destination: str
+    output_archive_path: str | None = None
+    archive_index: int = 0
+    is_image: bool = True
+    is_grayscale: bool = False
+    original_width: int = 0
+    original_height: int = 0
+    model_tile_size: TileSize = ESTIMATE
+    model: ModelDescriptor | None = None
+    manifest_entry: ManifestEntry | None = None
+    uniform_tile_threshold: float = 0
+    tile_downscale: int = 1
+    content_crop: ContentCrop | None = None
+
+    @property
+    def nbytes(self) -> int:
+        if isinstance(self.image, np.ndarray):
+            return self.image.nbytes
+        if isinstance(self.image, bytes):
+            return len(self.image)
+        return 0
+
+
+@dataclass(frozen=True)
+class DiskPage:
+    """
+    An upscaled image that was assembled on disk (see `allocate_canvas`), sent instead of
+    a `SharedPage`. The receiver owns the file and removes it once it is done.
+    """
+
+    path: str
+    shape: tuple[int, ...]
+    dtype: str
+
+    def open(self) -> np.ndarray:
+        return np.memmap(self.path, dtype=self.dtype, mode="r", shape=self.shape)
+
+    def remove(self) -> None:
+        remove_disk_canvas(self.path)
+
+
+@dataclass(frozen=True)
+class StripBand:
+    """
+    One horizontal band of an upscaled long strip page. The bands of a page are sent in
+    order and blended into the page by the postprocess worker.
+
+    `overlap_top` and `overlap_bottom` are the rows the band shares with its neighbors,
+    `page_height` is the height of the whole upscaled page.
+    """
+
+    index: int
+    count: int
+    page_height: int
+    overlap_top: int
+    overlap_bottom: int
+
+    @property
+    def is_last(self) -> bool:
+        return self.index == self.count - 1
+
+
+@dataclass
+class PostprocessItem:
+    """
+    An upscaled page on its way to the postprocess worker, see `UpscaleItem`.
+
+    Images are stored in the shared page ring, only their `SharedPage` is sent. Images
+    assembled on disk are sent as a `DiskPage` instead. Bands of long strip pages carry
+    their `strip_band`, the postprocess worker passes the assembled page on as an array.
+    """
+
+    image: SharedPage | DiskPage | np.ndarray | bytes | None
+    destination: str
+    output_archive_path: str | None = None
+    archive_index: int = 0
+    is_image: bool = True
+    is_grayscale: bool = False
+    original_width: int = 0
+    original_height: int = 0
+    manifest_entry: ManifestEntry | None = None
+    content_crop: ContentCrop | None = None
+    strip_band: StripBand | None = None
+
+
+UpscaleQueueEntry = UpscaleItem | ArchiveStart | ArchiveEnd | None
+PostprocessQueueEntry = PostprocessItem | ArchiveStart | ArchiveEnd | None
+
+
+def upscale_queue_entry_nbytes(entry: UpscaleQueueEntry) -> int:
+    """
+    The memory held by an upscale queue entry, markers and the sentinel are free.
+    """
+    if isinstance(entry, UpscaleItem):
+        return entry.nbytes
+    return 0
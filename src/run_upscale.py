@@ -1,19 +1,20 @@
 import argparse
 import ctypes
-import io
 import json
+import math
 import os
 import platform
 import sys
 import time
 from collections.abc import Callable
+from dataclasses import replace
 from io import BytesIO
 from pathlib import Path
-from queue import Queue
+from queue import Empty, Queue
 from multiprocessing import Queue as MPQueue, Process
-from threading import Thread
+from threading import Lock, Thread
 from typing import Any, Literal
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import BadZipFile, ZipFile
 
 import cv2
 import numpy as np
@@ -29,19 +30,50 @@ from spandrel import ImageModelDescriptor, ModelDescriptor
 
 sys.path.append(os.path.normpath(os.path.dirname(os.path.abspath(__file__))))
 
+from nodes.impl.image_op import ImageOp
 from nodes.impl.image_utils import normalize, to_uint8, to_uint16
 from nodes.impl.upscale.auto_split_tiles import (
+    AUTOTUNE,
     ESTIMATE,
     MAX_TILE_SIZE,
     NO_TILING,
     TileSize,
 )
+from nodes.impl.upscale.disk_canvas import (
+    allocate_canvas,
+    detach_disk_canvas,
+    is_on_disk,
+)
+from nodes.impl.upscale.tile_blending import (
+    StreamingTileBlender,
+    TileOverlap,
+    blend_dtype,
+    half_sin_blend_fn,
+)
 from nodes.utils.utils import get_h_w_c
 from packages.chaiNNer_pytorch.pytorch.io.load_model import load_model_node
 from packages.chaiNNer_pytorch.pytorch.processing.upscale_image import (
-    upscale_image_node,
+    upscale_image,
+    upscale_images as upscale_image_batch,
+)
+from archive_writer import ArchiveWriter, open_archive_writer, prepare_journal
+from byte_budget_queue import ByteBudgetQueue
+from content_crop import ContentCrop, crop_to_content, uncrop
+from ordered_pool import OrderedWorkerPool
+from pipeline_items import (
+    ArchiveEnd,
+    ArchiveStart,
+    DiskPage,
+    PostprocessItem,
+    PostprocessQueueEntry,
+    StripBand,
+    UpscaleItem,
+    UpscaleQueueEntry,
+    upscale_queue_entry_nbytes,
 )
 from progress_controller import ProgressController, ProgressToken
+from shared_page_ring import SharedPage, SharedPageRing
+from upscale_manifest import ManifestEntry, UpscaleManifest
 
 from api import (
     NodeContext,
@@ -122,6 +154,8 @@ class _ExecutorNodeContext(NodeContext):
 def get_tile_size(tile_size_str: str) -> TileSize:
     if tile_size_str == "Auto (Estimate)":
         return ESTIMATE
+    elif tile_size_str == "Auto (Tune)":
+        return AUTOTUNE
     elif tile_size_str == "Maximum":
         return MAX_TILE_SIZE
     elif tile_size_str == "No Tiling":
@@ -156,12 +190,17 @@ final downscale for grayscale images only
 """
 
 
-def dotgain20_resize(image: np.ndarray, new_size: tuple[int, int]) -> np.ndarray:
-    h, _, c = get_h_w_c(image)
-    size_ratio = h / new_size[1]
+def dotgain20_blur_size(height: int, new_height: int) -> float:
+    size_ratio = height / new_height
     blur_size = (1 / size_ratio - 1) / 3.5
     if blur_size >= 0.1:
         blur_size = min(blur_size, 250)
+    return blur_size
+
+
+def dotgain20_resize(image: np.ndarray, new_size: tuple[int, int]) -> np.ndarray:
+    h, _, c = get_h_w_c(image)
+    blur_size = dotgain20_blur_size(h, new_size[1])
 
     pil_image = Image.fromarray(image, mode="L")
     pil_image = pil_image.filter(ImageFilter.GaussianBlur(radius=blur_size))
@@ -381,20 +420,64 @@ def should_chain_activate_for_image(
     return True
 
 
+def uses_onnx_backend(model: ImageModelDescriptor) -> bool:
+    """
+    whether the model runs with onnx runtime instead of pytorch. models that can't be
+    exported to onnx stay on pytorch
+    """
+    if backend != "onnxruntime":
+        return False
+
+    # imported lazily, onnxruntime is only required by this backend
+    from onnx_backend import supports_onnx_backend  # noqa: PLC0415
+
+    if supports_onnx_backend(model):
+        return True
+    if model.architecture.name not in onnx_unsupported_architectures:
+        onnx_unsupported_architectures.add(model.architecture.name)
+        print(
+            f"{model.architecture.name} can't run with onnxruntime, using pytorch",
+            flush=True,
+        )
+    return False
+
+
 def ai_upscale_image(
-    image: np.ndarray, model_tile_size: TileSize, model: ImageModelDescriptor | None
+    image: np.ndarray,
+    model_tile_size: TileSize,
+    model: ImageModelDescriptor | None,
+    *,
+    uniform_tile_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+    tile_op_overlap: int = 0,
 ) -> np.ndarray:
     if model is not None:
-        result = upscale_image_node(
-            context,
-            image,
-            model,
-            False,
-            0,
-            model_tile_size,
-            256,
-            False,
-        )
+        if uses_onnx_backend(model):
+            # imported lazily, onnxruntime is only required by this backend
+            from onnx_backend import onnx_upscale_image  # noqa: PLC0415
+
+            result = onnx_upscale_image(
+                image,
+                model,
+                model_tile_size,
+                cache_dir=onnx_cache_directory,
+                intra_op_threads=onnx_intra_op_threads,
+                inter_op_threads=onnx_inter_op_threads,
+                output_uint8=settings.get("QuantizeInferenceOutput", False),
+                uniform_tile_threshold=uniform_tile_threshold,
+                tile_op=tile_op,
+                tile_op_overlap=tile_op_overlap,
+            )
+        else:
+            result = upscale_image(
+                context,
+                image,
+                model,
+                model_tile_size,
+                uniform_tile_threshold=uniform_tile_threshold,
+                tile_op=tile_op,
+                tile_op_overlap=tile_op_overlap,
+            )
 
         _, _, c = get_h_w_c(image)
 
@@ -406,23 +489,202 @@ def ai_upscale_image(
     return image
 
 
+def ai_upscale_images(
+    images: list[np.ndarray],
+    model_tile_size: TileSize,
+    model: ImageModelDescriptor | None,
+    *,
+    uniform_tile_threshold: float = 0,
+    tile_op: ImageOp | None = None,
+    tile_op_overlap: int = 0,
+) -> list[np.ndarray]:
+    """
+    upscale images that go through the same model together, falling back to one at a time
+    """
+    if model is not None and len(images) > 1 and not uses_onnx_backend(model):
+        results = upscale_image_batch(
+            context,
+            images,
+            model,
+            model_tile_size,
+            uniform_tile_threshold,
+            tile_op,
+            tile_op_overlap,
+        )
+        if results is not None:
+            return [
+                np.squeeze(result, axis=-1)
+                if get_h_w_c(image)[2] == 1 and result.ndim == 3
+                else result
+                for image, result in zip(images, results, strict=True)
+            ]
+
+    return [
+        ai_upscale_image(
+            image,
+            model_tile_size,
+            model,
+            uniform_tile_threshold=uniform_tile_threshold,
+            tile_op=tile_op,
+            tile_op_overlap=tile_op_overlap,
+        )
+        for image in images
+    ]
+
+
+def get_tile_downscale(
+    image: np.ndarray,
+    model_scale: int,
+    *,
+    target_scale: float | None,
+    target_width: int,
+    target_height: int,
+    original_width: int,
+    original_height: int,
+) -> int:
+    """
+    the largest factor the upscaled tiles of the page can be downscaled by before they are
+    blended, without getting smaller than the final target size. only factors that divide
+    the model scale are used, so tiles stay aligned. 1 if the tiles can't be downscaled
+    """
+    h, w, _ = get_h_w_c(image)
+    new_size = final_target_size(
+        w * model_scale,
+        h * model_scale,
+        target_scale=target_scale or 0,
+        target_width=target_width,
+        target_height=target_height,
+        original_width=original_width,
+        original_height=original_height,
+    )
+    if new_size is None:
+        return 1
+
+    new_w, new_h = new_size
+    for factor in range(model_scale, 1, -1):
+        if model_scale % factor != 0:
+            continue
+        if h * model_scale // factor >= new_h and w * model_scale // factor >= new_w:
+            return factor
+    return 1
+
+
+def downscale_tile(tile: np.ndarray, factor: int, is_grayscale: bool) -> np.ndarray:
+    """
+    apply the final downscale to an upscaled tile, quantized to uint8 like in save_image
+    """
+    h, w, c = get_h_w_c(tile)
+    image = to_uint8(tile, normalized=True)
+    if c == 1 and image.ndim == 3:
+        image = image[..., 0]
+
+    image = image_resize(image, (w // factor, h // factor), is_grayscale)
+
+    if tile.ndim == 3 and image.ndim == 2:
+        image = image[..., np.newaxis]
+    return image
+
+
+def get_tile_op(item: UpscaleItem) -> ImageOp | None:
+    if item.tile_downscale <= 1:
+        return None
+    return lambda tile: downscale_tile(tile, item.tile_downscale, item.is_grayscale)
+
+
+def get_tile_op_overlap(item: UpscaleItem) -> int:
+    """
+    the least overlap between tiles the tile op of the page needs: the radius of the
+    lanczos kernel of the final downscale times the downscale factor, so the edges of the
+    downscaled tiles never reach the part of the tiles that is blended
+    """
+    return 3 * item.tile_downscale if item.tile_downscale > 1 else 0
+
+
+def is_long_strip(item: UpscaleItem) -> bool:
+    """
+    whether the page is tall enough relative to its width to be upscaled in bands
+    """
+    if not item.is_image or item.model is None or long_strip_aspect_ratio <= 0:
+        return False
+    if not isinstance(item.image, np.ndarray):
+        return False
+    h, w, _ = get_h_w_c(item.image)
+    return h > long_strip_band_height and h > w * long_strip_aspect_ratio
+
+
+def long_strip_bands(
+    height: int, min_overlap: int = 0
+) -> list[tuple[int, int, int, int]]:
+    """
+    split a long strip into bands of at most long_strip_band_height rows plus their overlap
+    with the neighboring bands, long_strip_overlap rows or min_overlap if that is more.
+    returns the first and last row (exclusive) of each band, including its overlap, and
+    its top and bottom overlap
+    """
+    overlap = max(long_strip_overlap, min_overlap)
+    band_count = math.ceil(height / long_strip_band_height)
+    band_height = math.ceil(height / band_count)
+    bands = []
+    for i in range(band_count):
+        start = i * band_height
+        end = min(height, start + band_height)
+        top = min(overlap, start)
+        bottom = min(overlap, height - end)
+        bands.append((start - top, end + bottom, top, bottom))
+    return bands
+
+
+def can_batch_with(batch: list[UpscaleItem], item: UpscaleItem) -> bool:
+    """
+    whether the page can be upscaled in one forward pass with the pages of the batch.
+    pages have to go through the same model and padding them to a common size must not
+    waste more than upscale_batch_max_padding of any page
+    """
+    first = batch[0]
+    if not item.is_image or item.model is None or is_long_strip(item):
+        return False
+    if item.model is not first.model or item.model_tile_size != first.model_tile_size:
+        return False
+    if item.uniform_tile_threshold != first.uniform_tile_threshold:
+        return False
+    if (item.tile_downscale, item.is_grayscale) != (
+        first.tile_downscale,
+        first.is_grayscale,
+    ):
+        return False
+
+    images = [entry.image for entry in (*batch, item)]
+    if not all(isinstance(image, np.ndarray) for image in images):
+        return False
+    if len({(image.ndim, image.dtype) for image in images}) != 1:  # type: ignore
+        return False
+    sizes = [get_h_w_c(image) for image in images]  # type: ignore
+    if len({c for _, _, c in sizes}) != 1:
+        return False
+    common_pixels = max(h for h, _, _ in sizes) * max(w for _, w, _ in sizes)
+    return common_pixels <= min(h * w for h, w, _ in sizes) * upscale_batch_max_padding
+
+
 def postprocess_image(image: np.ndarray) -> np.ndarray:
     # print(f"postprocess_image")
     return to_uint8(image, normalized=True)
 
 
-def final_target_resize(
-    image: np.ndarray,
+def final_target_size(
+    width: int,
+    height: int,
+    *,
     target_scale: float,
     target_width: int,
     target_height: int,
     original_width: int,
     original_height: int,
-    is_grayscale: bool,
-) -> np.ndarray:
+) -> tuple[int, int] | None:
+    """
+    the size an upscaled image of the given size is resized to, or None if it already has it
+    """
     # fit to dimensions
     if target_height != 0 and target_width != 0:
-        h, w, _ = get_h_w_c(image)
         # determine whether to fit to height or width
         if target_height / original_height < target_width / original_width:
             target_width = 0
@@ -431,46 +693,68 @@ def final_target_resize(
 
     # resize height, keep proportional width
     if target_height != 0:
-        h, w, _ = get_h_w_c(image)
-        if h != target_height:
-            return image_resize(
-                image, (round(w * target_height / h), target_height), is_grayscale
-            )
+        if height != target_height:
+            return round(width * target_height / height), target_height
     # resize width, keep proportional height
     elif target_width != 0:
-        h, w, _ = get_h_w_c(image)
-        if w != target_width:
-            return image_resize(
-                image, (target_width, round(h * target_width / w)), is_grayscale
-            )
+        if width != target_width:
+            return target_width, round(height * target_width / width)
     else:
-        h, w, _ = get_h_w_c(image)
         new_target_height = round(original_height * target_scale)
-        if h != new_target_height:
-            return image_resize(
-                image,
-                (round(w * new_target_height / h), new_target_height),
-                is_grayscale,
-            )
+        if height != new_target_height:
+            return round(width * new_target_height / height), new_target_height
 
-    return image
+    return None
 
 
-def save_image_zip(
+def final_target_resize(
     image: np.ndarray,
-    file_name: str,
-    output_zip: ZipFile,
-    image_format: str,
-    lossy_compression_quality: int,
-    use_lossless_compression: bool,
+    target_scale: float,
+    target_width: int,
+    target_height: int,
     original_width: int,
     original_height: int,
+    is_grayscale: bool,
+) -> np.ndarray:
+    h, w, _ = get_h_w_c(image)
+    new_size = final_target_size(
+        w,
+        h,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        original_width=original_width,
+        original_height=original_height,
+    )
+    if new_size is not None:
+        return image_resize(image, new_size, is_grayscale)
+
+    return image
+
+
+def final_vips_image(
+    image: np.ndarray,
+    *,
     target_scale: float,
     target_width: int,
     target_height: int,
+    original_width: int,
+    original_height: int,
     is_grayscale: bool,
-) -> None:
-    print(f"save image to zip: {file_name}", flush=True)
+) -> pyvips.Image:
+    """
+    convert the upscaled image to uint8 and apply the final resize, ready to be encoded
+    """
+    if is_on_disk(image):
+        return disk_final_vips_image(
+            image,
+            target_scale=target_scale,
+            target_width=target_width,
+            target_height=target_height,
+            original_width=original_width,
+            original_height=original_height,
+            is_grayscale=is_grayscale,
+        )
 
     image = to_uint8(image, normalized=True)
 
@@ -484,17 +768,169 @@ def save_image_zip(
         is_grayscale,
     )
 
+    return pyvips.Image.new_from_array(image)
+
+
+# the pixels of a strip when images on disk are converted or resized strip by strip
+DISK_STRIP_PIXELS = 2**24
+
+
+def to_uint8_in_strips(image: np.ndarray) -> np.ndarray:
+    """
+    to_uint8 for images assembled on disk, strip by strip into a canvas on disk
+    """
+    if image.dtype == np.uint8:
+        return image
+
+    h, w, _ = get_h_w_c(image)
+    result = allocate_canvas(image.shape, np.dtype(np.uint8), on_disk=True)
+    step = max(1, DISK_STRIP_PIXELS // w)
+    for y in range(0, h, step):
+        result[y : y + step] = to_uint8(image[y : y + step], normalized=True)
+    return result
+
+
+def resize_in_strips(
+    image: np.ndarray, new_size: tuple[int, int], resize_filter: ResizeFilter
+) -> np.ndarray:
+    """
+    resize a uint8 image on disk like standard_resize, first its width in strips of rows
+    and then its height in strips of columns. the filters are separable, so this is the
+    same as resizing the whole image, but only one strip is held in memory.
+    the intermediate image and the result are canvases on disk
+    """
+    h, w, c = get_h_w_c(image)
+    new_w, new_h = new_size
+    image = image.reshape((h, w, c))
+
+    rows = allocate_canvas((h, new_w, c), np.dtype(np.float32), on_disk=True)
+    step = max(1, DISK_STRIP_PIXELS // max(w, new_w))
+    for y in range(0, h, step):
+        strip = image[y : y + step].astype(np.float32) / 255.0
+        strip = resize(strip, (new_w, strip.shape[0]), resize_filter, False)
+        rows[y : y + step] = strip.reshape((-1, new_w, c))
+
+    result = allocate_canvas((new_h, new_w, c), np.dtype(np.uint8), on_disk=True)
+    step = max(1, DISK_STRIP_PIXELS // max(h, new_h))
+    for x in range(0, new_w, step):
+        strip = np.ascontiguousarray(rows[:, x : x + step])
+        strip = resize(strip, (strip.shape[1], new_h), resize_filter, False)
+        strip = (strip * 255).round().astype(np.uint8)
+        result[:, x : x + step] = strip.reshape((new_h, -1, c))
+    return result
+
+
+def dotgain20_resize_in_strips(
+    image: np.ndarray, new_size: tuple[int, int]
+) -> np.ndarray:
+    """
+    dotgain20_resize for uint8 images on disk, in strips like resize_in_strips. each strip
+    is blurred together with the rows around it the blur reaches
+    """
+    h, w, _ = get_h_w_c(image)
+    new_w, new_h = new_size
+    image = image.reshape((h, w))
+    blur_size = dotgain20_blur_size(h, new_h)
+    # PIL's gaussian blur is three box blurs, which reach at most this far
+    margin = math.ceil(3 * abs(blur_size)) + 3
+
+    linear = allocate_canvas((h, w), np.dtype(np.uint8), on_disk=True)
+    step = max(1, DISK_STRIP_PIXELS // w)
+    for y in range(0, h, step):
+        top = max(0, y - margin)
+        pil_image = Image.fromarray(
+            np.ascontiguousarray(image[top : y + step + margin]), mode="L"
+        )
+        pil_image = pil_image.filter(ImageFilter.GaussianBlur(radius=blur_size))
+        pil_image = ImageCms.applyTransform(
+            pil_image, dotgain20togamma1transform, False
+        )
+        strip = np.array(pil_image)[y - top : y - top + step]
+        linear[y : y + strip.shape[0]] = strip
+
+    result = resize_in_strips(linear, new_size, ResizeFilter.CubicCatrom)
+    del linear
+    result = result.reshape((new_h, new_w))
+    step = max(1, DISK_STRIP_PIXELS // new_w)
+    for y in range(0, new_h, step):
+        pil_image = Image.fromarray(
+            np.ascontiguousarray(result[y : y + step]), mode="L"
+        )
+        pil_image = ImageCms.applyTransform(
+            pil_image, gamma1todotgain20transform, False
+        )
+        result[y : y + step] = np.array(pil_image)
+    return result
+
+
+def disk_final_vips_image(
+    image: np.ndarray,
+    *,
+    target_scale: float,
+    target_width: int,
+    target_height: int,
+    original_width: int,
+    original_height: int,
+    is_grayscale: bool,
+) -> pyvips.Image:
+    """
+    to_uint8 and final_target_resize for images assembled on disk, with the same
+    conversion and resize filters applied in strips. the result is on disk as well and
+    read in strips while it is encoded
+    """
+    image = to_uint8_in_strips(image)
+
+    h, w, _ = get_h_w_c(image)
+    new_size = final_target_size(
+        w,
+        h,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        original_width=original_width,
+        original_height=original_height,
+    )
+    if new_size is not None:
+        if is_grayscale:
+            image = dotgain20_resize_in_strips(image, new_size)
+        else:
+            image = resize_in_strips(image, new_size, ResizeFilter.Lanczos)
+
+    h, w, c = get_h_w_c(image)
+    return pyvips.Image.new_from_memory(image, w, h, c, "uchar")
+
+
+def encode_image(
+    image: np.ndarray,
+    image_format: str,
+    *,
+    lossy_compression_quality: int,
+    use_lossless_compression: bool,
+    original_width: int,
+    original_height: int,
+    target_scale: float,
+    target_width: int,
+    target_height: int,
+    is_grayscale: bool,
+) -> bytes:
+    """
+    apply the final resize and encode the image, runs on an encoder worker
+    """
+    vips_image = final_vips_image(
+        image,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        original_width=original_width,
+        original_height=original_height,
+        is_grayscale=is_grayscale,
+    )
+
     # Convert the resized image back to bytes
     args = {"Q": int(lossy_compression_quality)}
     if image_format in {"webp"}:
         args["lossless"] = use_lossless_compression
-    buf_img = pyvips.Image.new_from_array(image).write_to_buffer(f".{image_format}", **args)
-    output_buffer = io.BytesIO(buf_img)  # type: ignore
-
-    upscaled_image_data = output_buffer.getvalue()
-
-    # Add the resized image to the output zip
-    output_zip.writestr(file_name, upscaled_image_data)
+    return vips_image.write_to_buffer(f".{image_format}", **args)
 
 
 def save_image(
@@ -512,212 +948,519 @@ def save_image(
 ) -> None:
     print(f"save image: {output_file_path}", flush=True)
 
-    image = to_uint8(image, normalized=True)
-
-    image = final_target_resize(
+    vips_image = final_vips_image(
         image,
-        target_scale,
-        target_width,
-        target_height,
-        original_width,
-        original_height,
-        is_grayscale,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        original_width=original_width,
+        original_height=original_height,
+        is_grayscale=is_grayscale,
     )
 
     args = {"Q": int(lossy_compression_quality)}
     if image_format in {"webp"}:
         args["lossless"] = use_lossless_compression
-    pyvips.Image.new_from_array(image).write_to_file(output_file_path, **args)
+    vips_image.write_to_file(output_file_path, **args)
 
 
-def preprocess_worker_archive(
-    upscale_queue: Queue,
-    input_archive_path: str,
-    output_archive_path: str,
+def open_manifest(
+    output_folder_path: str,
+    *,
+    image_format: str,
+    lossy_compression_quality: int,
+    use_lossless_compression: bool,
     target_scale: float | None,
     target_width: int,
     target_height: int,
     chains: list[dict[str, Any]],
-    loaded_models: dict[str, ModelDescriptor],
     grayscale_detection_threshold: int,
-) -> None:
+) -> UpscaleManifest | None:
     """
-    given a zip or rar path, read images out of the archive, apply auto levels, add the image to upscale queue
+    open the manifest of the output folder if enabled, keyed by all settings that affect the outputs
     """
+    if not use_manifest:
+        return None
+
+    return UpscaleManifest(
+        ensure_absolute_path(output_folder_path),
+        {
+            "image_format": image_format,
+            "lossy_compression_quality": lossy_compression_quality,
+            "use_lossless_compression": use_lossless_compression,
+            "target_scale": target_scale,
+            "target_width": target_width,
+            "target_height": target_height,
+            "grayscale_detection_threshold": grayscale_detection_threshold,
+            "use_fp16": settings["UseFp16"],
+            "quantize_inference_output": settings.get("QuantizeInferenceOutput", False),
+            "chains": chains,
+        },
+        [
+            ensure_absolute_path(get_model_abs_path(chain["ModelFilePath"]))
+            for chain in chains
+            if chain["ModelFilePath"] != "No Model"
+        ],
+    )
 
-    if input_archive_path.endswith(ZIP_EXTENSIONS):
-        with ZipFile(input_archive_path, "r") as input_zip:
-            preprocess_worker_archive_file(
-                upscale_queue,
-                input_zip,
-                output_archive_path,
-                target_scale,
-                target_width,
-                target_height,
-                chains,
-                loaded_models,
-                grayscale_detection_threshold,
-            )
-    elif input_archive_path.endswith(RAR_EXTENSIONS):
-        with rarfile.RarFile(input_archive_path, "r") as input_rar:
-            preprocess_worker_archive_file(
-                upscale_queue,
-                input_rar,
-                output_archive_path,
-                target_scale,
-                target_width,
-                target_height,
-                chains,
-                loaded_models,
-                grayscale_detection_threshold,
+
+def should_skip_output(
+    output_file_path: str,
+    overwrite_existing_files: bool,
+    manifest: UpscaleManifest | None,
+    manifest_entry: ManifestEntry | None,
+) -> bool:
+    """
+    outputs recorded in the manifest are skipped if neither their input nor the settings changed,
+    and redone otherwise. all other outputs are skipped if they exist and overwrite is not enabled
+    """
+    exists = os.path.isfile(ensure_absolute_path(output_file_path))
+
+    if manifest is not None and manifest_entry is not None:
+        recorded_output = manifest.get_unchanged_output(manifest_entry)
+        if exists and recorded_output == output_file_path:
+            print(f"unchanged, skip: {output_file_path}", flush=True)
+            return True
+        if manifest.is_recorded(manifest_entry):
+            return False
+
+    if not overwrite_existing_files and exists:
+        print(f"file exists, skip: {output_file_path}", flush=True)
+        return True
+
+    return False
+
+
+def get_chain_model(
+    chain: dict[str, Any],
+    loaded_models: dict[str, ModelDescriptor],
+    require_model: bool = False,
+) -> ModelDescriptor | None:
+    """
+    return the model of the given chain, loading it on first use
+    """
+    if chain["ModelFilePath"] == "No Model":
+        return None
+
+    model_abs_path = get_model_abs_path(chain["ModelFilePath"])
+
+    if require_model and not os.path.exists(ensure_absolute_path(model_abs_path)):
+        raise FileNotFoundError(model_abs_path)
+
+    # preprocess workers run concurrently, make sure every model is only loaded once
+    with model_load_lock:
+        if model_abs_path in loaded_models:
+            return loaded_models[model_abs_path]
+
+        if os.path.exists(ensure_absolute_path(model_abs_path)):
+            model, _, _ = load_model_node(
+                context, Path(ensure_absolute_path(model_abs_path))
             )
+            loaded_models[model_abs_path] = model
+            if uses_onnx_backend(model):
+                # imported lazily, onnxruntime is only required by this backend
+                from onnx_backend import warm_up  # noqa: PLC0415
+
+                # prepares the session while the first pages are decoded
+                warm_up(
+                    model,
+                    get_tile_size(chain["ModelTileSize"]),
+                    onnx_cache_directory,
+                    onnx_intra_op_threads,
+                    onnx_inter_op_threads,
+                )
+            return model
 
+    return None
 
-def preprocess_worker_archive_file(
-    upscale_queue: Queue,
-    input_archive: RarFile | ZipFile,
-    output_archive_path: str,
+
+def preprocess_image(
+    image: np.ndarray,
+    destination: str,
+    output_archive_path: str | None,
+    *,
     target_scale: float | None,
     target_width: int,
     target_height: int,
     chains: list[dict[str, Any]],
     loaded_models: dict[str, ModelDescriptor],
     grayscale_detection_threshold: int,
-) -> None:
+    require_model: bool = False,
+) -> UpscaleItem:
     """
-    given an input zip or rar archive, read images out of the archive, apply auto levels, add the image to upscale queue
+    given a decoded image, match it to a chain, apply the chain's pre-upscale resize and auto levels,
+    and return the item for the upscale queue
     """
-    os.makedirs(ensure_absolute_path(os.path.dirname(output_archive_path)), exist_ok=True)
-    namelist = input_archive.namelist()
-    print(f"TOTALZIP={len(namelist)}", flush=True)
-    for filename in namelist:
-        decoded_filename = filename
-        image_data = None
-        try:
-            decoded_filename = decoded_filename.encode("cp437").decode(
-                f"cp{system_codepage}"
+    chain, is_grayscale, original_width, original_height = get_chain_for_image(
+        image,
+        target_scale,
+        target_width,
+        target_height,
+        chains,
+        grayscale_detection_threshold,
+    )
+
+    if is_grayscale:
+        image = convert_image_to_grayscale(image)
+
+    model = None
+    tile_size_str = ""
+    uniform_tile_threshold = 0.0
+    tile_downscale = 1
+    content_crop: ContentCrop | None = None
+    if chain is not None:
+        resize_width_before_upscale = chain["ResizeWidthBeforeUpscale"]
+        resize_height_before_upscale = chain["ResizeHeightBeforeUpscale"]
+        resize_factor_before_upscale = chain["ResizeFactorBeforeUpscale"]
+
+        # resize width and height, distorting image
+        if resize_height_before_upscale != 0 and resize_width_before_upscale != 0:
+            h, w, _ = get_h_w_c(image)
+            image = standard_resize(
+                image, (resize_width_before_upscale, resize_height_before_upscale)
+            )
+        # resize height, keep proportional width
+        elif resize_height_before_upscale != 0:
+            h, w, _ = get_h_w_c(image)
+            image = standard_resize(
+                image,
+                (
+                    round(w * resize_height_before_upscale / h),
+                    resize_height_before_upscale,
+                ),
+            )
+        # resize width, keep proportional height
+        elif resize_width_before_upscale != 0:
+            h, w, _ = get_h_w_c(image)
+            image = standard_resize(
+                image,
+                (
+                    resize_width_before_upscale,
+                    round(h * resize_width_before_upscale / w),
+                ),
+            )
+        elif resize_factor_before_upscale != 100:
+            h, w, _ = get_h_w_c(image)
+            image = standard_resize(
+                image,
+                (
+                    round(w * resize_factor_before_upscale / 100),
+                    round(h * resize_factor_before_upscale / 100),
+                ),
             )
-        except:  # noqa: E722
-            pass
 
-        # Open the file inside the input zip
-        try:
-            with input_archive.open(filename) as file_in_archive:
-                # Read the image data
+        if is_grayscale and chain["AutoAdjustLevels"]:
+            image = enhance_contrast(image)
+        else:
+            image = normalize(image)
 
-                image_data = file_in_archive.read()
+        model = get_chain_model(chain, loaded_models, require_model)
+        if model is not None:
+            tile_size_str = chain["ModelTileSize"]
+            # in levels of 255, tiles with less variation are filled instead of upscaled
+            uniform_tile_threshold = chain.get("UniformTileThreshold", 0) / 255
 
-                # image_bytes = io.BytesIO(image_data)
-                image = _read_image(image_data, filename)
-                print("read image", filename, flush=True)
-                chain, is_grayscale, original_width, original_height = (
-                    get_chain_for_image(
-                        image,
-                        target_scale,
-                        target_width,
-                        target_height,
-                        chains,
-                        grayscale_detection_threshold,
-                    )
+            if downscale_tiles_to_target:
+                tile_downscale = get_tile_downscale(
+                    image,
+                    model.scale,
+                    target_scale=target_scale,
+                    target_width=target_width,
+                    target_height=target_height,
+                    original_width=original_width,
+                    original_height=original_height,
                 )
 
-                if is_grayscale:
-                    image = convert_image_to_grayscale(image)
-
-                model = None
-                tile_size_str = ""
-                if chain is not None:
-                    resize_width_before_upscale = chain["ResizeWidthBeforeUpscale"]
-                    resize_height_before_upscale = chain["ResizeHeightBeforeUpscale"]
-                    resize_factor_before_upscale = chain["ResizeFactorBeforeUpscale"]
-
-                    # resize width and height, distorting image
-                    if (
-                        resize_height_before_upscale != 0
-                        and resize_width_before_upscale != 0
-                    ):
-                        h, w, _ = get_h_w_c(image)
-                        image = standard_resize(
-                            image,
-                            (resize_width_before_upscale, resize_height_before_upscale),
-                        )
-                    # resize height, keep proportional width
-                    elif resize_height_before_upscale != 0:
-                        h, w, _ = get_h_w_c(image)
-                        image = standard_resize(
-                            image,
-                            (
-                                round(w * resize_height_before_upscale / h),
-                                resize_height_before_upscale,
-                            ),
-                        )
-                    # resize width, keep proportional height
-                    elif resize_width_before_upscale != 0:
-                        h, w, _ = get_h_w_c(image)
-                        image = standard_resize(
-                            image,
-                            (
-                                resize_width_before_upscale,
-                                round(h * resize_width_before_upscale / w),
-                            ),
-                        )
-                    elif resize_factor_before_upscale != 100:
-                        h, w, _ = get_h_w_c(image)
-                        image = standard_resize(
-                            image,
-                            (
-                                round(w * resize_factor_before_upscale / 100),
-                                round(h * resize_factor_before_upscale / 100),
-                            ),
-                        )
+            # only the content is upscaled, the margins are filled in after upscaling
+            border_crop_threshold = chain.get("BorderCropThreshold", 0)
+            if border_crop_threshold > 0:
+                image, content_crop = crop_to_content(
+                    image, border_crop_threshold / 255
+                )
+    else:
+        print("No chain!!!!!!!", flush=True)
+        image = normalize(image)
+
+    # image = np.ascontiguousarray(image)
+    return UpscaleItem(
+        image,
+        destination,
+        output_archive_path,
+        is_image=True,
+        is_grayscale=is_grayscale,
+        original_width=original_width,
+        original_height=original_height,
+        model_tile_size=get_tile_size(tile_size_str),
+        model=model,
+        uniform_tile_threshold=uniform_tile_threshold,
+        tile_downscale=tile_downscale,
+        content_crop=content_crop,
+    )
 
-                    if is_grayscale and chain["AutoAdjustLevels"]:
-                        image = enhance_contrast(image)
-                    else:
-                        image = normalize(image)
 
-                    model_abs_path = get_model_abs_path(chain["ModelFilePath"])
+def preprocess_worker_archive(
+    upscale_queue: ByteBudgetQueue[UpscaleQueueEntry],
+    input_archive_path: str,
+    output_archive_path: str,
+    target_scale: float | None,
+    target_width: int,
+    target_height: int,
+    chains: list[dict[str, Any]],
+    loaded_models: dict[str, ModelDescriptor],
+    grayscale_detection_threshold: int,
+    manifest: UpscaleManifest | None = None,
+    manifest_entry: ManifestEntry | None = None,
+) -> None:
+    """
+    given a zip or rar path, read images out of the archive, apply auto levels, add the image to upscale queue
+    """
+    with OrderedWorkerPool(
+        preprocess_worker_count, upscale_queue.put, name="preprocess"
+    ) as pool:
+        preprocess_archive(
+            pool,
+            input_archive_path,
+            output_archive_path,
+            target_scale=target_scale,
+            target_width=target_width,
+            target_height=target_height,
+            chains=chains,
+            loaded_models=loaded_models,
+            grayscale_detection_threshold=grayscale_detection_threshold,
+            manifest=manifest,
+            manifest_entry=manifest_entry,
+        )
 
-                    if model_abs_path in loaded_models:
-                        model = loaded_models[model_abs_path]
 
-                    elif os.path.exists(ensure_absolute_path(model_abs_path)):
-                        model, _, _ = load_model_node(context, Path(ensure_absolute_path(model_abs_path)))
-                        loaded_models[model_abs_path] = model
+def preprocess_archive(
+    pool: OrderedWorkerPool,
+    input_archive_path: str,
+    output_archive_path: str,
+    *,
+    target_scale: float | None,
+    target_width: int,
+    target_height: int,
+    chains: list[dict[str, Any]],
+    loaded_models: dict[str, ModelDescriptor],
+    grayscale_detection_threshold: int,
+    manifest: UpscaleManifest | None = None,
+    manifest_entry: ManifestEntry | None = None,
+) -> None:
+    """
+    given a zip or rar path, submit the files of the archive to the preprocess pool
+    """
 
-                    tile_size_str = chain["ModelTileSize"]
-                else:
-                    image = normalize(image)
-
-                # image = np.ascontiguousarray(image)
-                upscale_queue.put(
-                    (
-                        image,
-                        decoded_filename,
-                        True,
-                        is_grayscale,
-                        original_width,
-                        original_height,
-                        get_tile_size(tile_size_str),
-                        model,
-                    )
-                )
-        except Exception as e:
+    if input_archive_path.endswith(ZIP_EXTENSIONS):
+        with ZipFile(input_archive_path, "r") as input_zip:
+            preprocess_archive_file(
+                pool,
+                input_zip,
+                output_archive_path,
+                target_scale=target_scale,
+                target_width=target_width,
+                target_height=target_height,
+                chains=chains,
+                loaded_models=loaded_models,
+                grayscale_detection_threshold=grayscale_detection_threshold,
+                manifest=manifest,
+                manifest_entry=manifest_entry,
+            )
+    elif input_archive_path.endswith(RAR_EXTENSIONS):
+        with rarfile.RarFile(input_archive_path, "r") as input_rar:
+            preprocess_archive_file(
+                pool,
+                input_rar,
+                output_archive_path,
+                target_scale=target_scale,
+                target_width=target_width,
+                target_height=target_height,
+                chains=chains,
+                loaded_models=loaded_models,
+                grayscale_detection_threshold=grayscale_detection_threshold,
+                manifest=manifest,
+                manifest_entry=manifest_entry,
+            )
+
+
+def preprocess_archive_member(
+    image_data: bytes | None,
+    filename: str,
+    decoded_filename: str,
+    output_archive_path: str,
+    *,
+    archive_index: int,
+    manifest_entry: ManifestEntry | None,
+    target_scale: float | None,
+    target_width: int,
+    target_height: int,
+    chains: list[dict[str, Any]],
+    loaded_models: dict[str, ModelDescriptor],
+    grayscale_detection_threshold: int,
+) -> UpscaleItem:
+    """
+    decode and preprocess a single archive member, runs on a preprocess worker
+    """
+    try:
+        if image_data is None:
+            raise ValueError("could not read file from archive")
+
+        image = _read_image(image_data, filename)
+        print("read image", filename, flush=True)
+        item = preprocess_image(
+            image,
+            decoded_filename,
+            output_archive_path,
+            target_scale=target_scale,
+            target_width=target_width,
+            target_height=target_height,
+            chains=chains,
+            loaded_models=loaded_models,
+            grayscale_detection_threshold=grayscale_detection_threshold,
+        )
+        item.archive_index = archive_index
+        item.manifest_entry = manifest_entry
+        return item
+    except (pyvips.Error, ValueError) as e:
+        print(
+            f"could not read as image, copying file to zip instead of upscaling: {decoded_filename}, {e}",
+            flush=True,
+        )
+        return UpscaleItem(
+            image_data,
+            decoded_filename,
+            output_archive_path,
+            archive_index,
+            is_image=False,
+            manifest_entry=manifest_entry,
+        )
+
+
+def preprocess_archive_file(
+    pool: OrderedWorkerPool,
+    input_archive: RarFile | ZipFile,
+    output_archive_path: str,
+    *,
+    target_scale: float | None,
+    target_width: int,
+    target_height: int,
+    chains: list[dict[str, Any]],
+    loaded_models: dict[str, ModelDescriptor],
+    grayscale_detection_threshold: int,
+    manifest: UpscaleManifest | None = None,
+    manifest_entry: ManifestEntry | None = None,
+) -> None:
+    """
+    given an input zip or rar archive, read the files out of the archive and submit them to the preprocess pool,
+    between the start and end markers of the output archive.
+    with a manifest, pages of unchanged members are taken from the previous output archive
+    """
+    os.makedirs(ensure_absolute_path(os.path.dirname(output_archive_path)), exist_ok=True)
+    namelist = input_archive.namelist()
+
+    decoded_filenames = []
+    for filename in namelist:
+        decoded_filename = filename
+        try:
+            decoded_filename = decoded_filename.encode("cp437").decode(
+                f"cp{system_codepage}"
+            )
+        except:  # noqa: E722
+            pass
+        decoded_filenames.append(decoded_filename)
+
+    # pages finished by an earlier, interrupted run are taken from the archive's journal
+    finished = set()
+    if resume_archives:
+        finished = prepare_journal(output_archive_path, decoded_filenames)
+        if finished:
             print(
-                f"could not read as image, copying file to zip instead of upscaling: {decoded_filename}, {e}",
+                f"resuming {output_archive_path}, {len(finished)} of {len(namelist)} files are done",
                 flush=True,
             )
-            upscale_queue.put(
-                (image_data, decoded_filename, False, False, None, None, None, None)
+
+    pool.submit_result(
+        ArchiveStart(output_archive_path, len(namelist) - len(finished), manifest_entry)
+    )
+
+    previous_output = None
+    if manifest is not None and os.path.isfile(output_archive_path):
+        try:
+            previous_output = ZipFile(output_archive_path, "r")
+        except (OSError, BadZipFile) as e:
+            print(f"could not open previous output: {output_archive_path}, {e}", flush=True)
+    previous_names = set(previous_output.namelist()) if previous_output else set()
+
+    # archive members are read one after another on this thread, decoding and preprocessing
+    # happens on the pool, which hands the pages to the upscale queue in archive order
+    for archive_index, (filename, decoded_filename) in enumerate(
+        zip(namelist, decoded_filenames, strict=True)
+    ):
+        if archive_index in finished:
+            continue
+
+        member_entry = None
+        if manifest is not None and manifest_entry is not None:
+            info = input_archive.getinfo(filename)
+            member_entry = manifest.member_entry(
+                manifest_entry.input_path, filename, info.CRC, info.file_size
             )
-        #     pass
-    upscale_queue.put(UPSCALE_SENTINEL)
+            previous_name = manifest.get_unchanged_output(member_entry)
+            if previous_output is not None and previous_name in previous_names:
+                print(f"unchanged, reusing page: {decoded_filename}", flush=True)
+                pool.submit_result(
+                    UpscaleItem(
+                        previous_output.read(previous_name),
+                        previous_name,
+                        output_archive_path,
+                        archive_index,
+                        is_image=False,
+                        manifest_entry=member_entry,
+                    )
+                )
+                continue
+
+        image_data = None
+        # Read the file inside the input zip
+        try:
+            with input_archive.open(filename) as file_in_archive:
+                image_data = file_in_archive.read()
+        # encrypted members raise RuntimeError, unsupported compression methods
+        # NotImplementedError
+        except (
+            OSError,
+            BadZipFile,
+            rarfile.Error,
+            RuntimeError,
+            NotImplementedError,
+        ) as e:
+            print(f"could not read file from archive: {decoded_filename}, {e}", flush=True)
+
+        pool.submit(
+            preprocess_archive_member,
+            image_data,
+            filename,
+            decoded_filename,
+            output_archive_path,
+            archive_index=archive_index,
+            manifest_entry=member_entry,
+            target_scale=target_scale,
+            target_width=target_width,
+            target_height=target_height,
+            chains=chains,
+            loaded_models=loaded_models,
+            grayscale_detection_threshold=grayscale_detection_threshold,
+        )
+
+    # the previous output is replaced once the end marker reaches the postprocess stage
+    if previous_output is not None:
+        previous_output.close()
+    pool.submit_result(ArchiveEnd(output_archive_path))
 
     # print("preprocess_worker_archive exiting")
 
 
 def preprocess_worker_folder(
-    upscale_queue: Queue,
+    upscale_queue: ByteBudgetQueue[UpscaleQueueEntry],
     input_folder_path: str,
     output_folder_path: str,
     output_filename: str,
@@ -725,180 +1468,118 @@ def preprocess_worker_folder(
     upscale_archives: bool,
     overwrite_existing_files: bool,
     image_format: str,
-    lossy_compression_quality: int,
-    use_lossless_compression: bool,
     target_scale: float | None,
     target_width: int,
     target_height: int,
     chains: list[dict[str, Any]],
     loaded_models: dict[str, ModelDescriptor],
     grayscale_detection_threshold: int,
+    manifest: UpscaleManifest | None = None,
 ) -> None:
     """
-    given a folder path, recursively iterate the folder
+    given a folder path, recursively iterate the folder. images and the pages of archives
+    all go through the same pool and upscale queue, each tagged with its destination
     """
     print(
         f"preprocess_worker_folder entering {input_folder_path} {output_folder_path} {output_filename}",
         flush=True,
     )
-    for root, _dirs, files in os.walk(input_folder_path):
-        for filename in files:
-            # for output file, create dirs if necessary, or skip if file exists and overwrite not enabled
-            input_file_base = Path(filename).stem
-            filename_rel = os.path.relpath(
-                ensure_absolute_path(os.path.join(root, filename)), ensure_absolute_path(input_folder_path)
-            )
-            output_filename_rel = os.path.join(
-                os.path.dirname(filename_rel),
-                output_filename.replace("%filename%", input_file_base),
-            )
-            output_file_path = Path(
-                ensure_absolute_path(os.path.join(output_folder_path, output_filename_rel))
-            )
 
-            if filename.lower().endswith(IMAGE_EXTENSIONS):  # TODO if image
-                if upscale_images:
-                    output_file_path = str(
-                        Path(f"{output_file_path}.{image_format}")
-                    ).replace("%filename%", input_file_base)
-
-                    if not overwrite_existing_files and os.path.isfile(
-                        ensure_absolute_path(output_file_path)
-                    ):
-                        print(f"file exists, skip: {output_file_path}", flush=True)
-                        continue
-
-                    os.makedirs(ensure_absolute_path(os.path.dirname(output_file_path)), exist_ok=True)
-                    image = _read_image_from_path(ensure_absolute_path(os.path.join(root, filename)))
-
-                    chain, is_grayscale, original_width, original_height = (
-                        get_chain_for_image(
-                            image,
-                            target_scale,
-                            target_width,
-                            target_height,
-                            chains,
-                            grayscale_detection_threshold,
-                        )
-                    )
+    def read_and_preprocess(
+        input_file_path: str,
+        output_file_path: str,
+        manifest_entry: ManifestEntry | None,
+    ) -> UpscaleItem:
+        image = _read_image_from_path(input_file_path)
+        item = preprocess_image(
+            image,
+            output_file_path,
+            None,
+            target_scale=target_scale,
+            target_width=target_width,
+            target_height=target_height,
+            chains=chains,
+            loaded_models=loaded_models,
+            grayscale_detection_threshold=grayscale_detection_threshold,
+        )
+        item.manifest_entry = manifest_entry
+        return item
+
+    with OrderedWorkerPool(
+        preprocess_worker_count, upscale_queue.put, name="preprocess"
+    ) as pool:
+        for root, _dirs, files in os.walk(input_folder_path):
+            for filename in files:
+                # for output file, create dirs if necessary, or skip if file exists and overwrite not enabled
+                input_file_base = Path(filename).stem
+                filename_rel = os.path.relpath(
+                    ensure_absolute_path(os.path.join(root, filename)), ensure_absolute_path(input_folder_path)
+                )
+                output_filename_rel = os.path.join(
+                    os.path.dirname(filename_rel),
+                    output_filename.replace("%filename%", input_file_base),
+                )
+                output_file_path = Path(
+                    ensure_absolute_path(os.path.join(output_folder_path, output_filename_rel))
+                )
+                input_file_path = ensure_absolute_path(os.path.join(root, filename))
 
-                    if is_grayscale:
-                        image = convert_image_to_grayscale(image)
-
-                    model = None
-                    tile_size_str = ""
-                    if chain is not None:
-                        resize_width_before_upscale = chain["ResizeWidthBeforeUpscale"]
-                        resize_height_before_upscale = chain[
-                            "ResizeHeightBeforeUpscale"
-                        ]
-                        resize_factor_before_upscale = chain[
-                            "ResizeFactorBeforeUpscale"
-                        ]
-
-                        # resize width and height, distorting image
-                        if (
-                            resize_height_before_upscale != 0
-                            and resize_width_before_upscale != 0
+                if filename.lower().endswith(IMAGE_EXTENSIONS):  # TODO if image
+                    if upscale_images:
+                        output_file_path = str(
+                            Path(f"{output_file_path}.{image_format}")
+                        ).replace("%filename%", input_file_base)
+
+                        manifest_entry = (
+                            manifest.file_entry(input_file_path) if manifest else None
+                        )
+                        if should_skip_output(
+                            output_file_path,
+                            overwrite_existing_files,
+                            manifest,
+                            manifest_entry,
                         ):
-                            h, w, _ = get_h_w_c(image)
-                            image = standard_resize(
-                                image,
-                                (
-                                    resize_width_before_upscale,
-                                    resize_height_before_upscale,
-                                ),
-                            )
-                        # resize height, keep proportional width
-                        elif resize_height_before_upscale != 0:
-                            h, w, _ = get_h_w_c(image)
-                            image = standard_resize(
-                                image,
-                                (
-                                    round(w * resize_height_before_upscale / h),
-                                    resize_height_before_upscale,
-                                ),
-                            )
-                        # resize width, keep proportional height
-                        elif resize_width_before_upscale != 0:
-                            h, w, _ = get_h_w_c(image)
-                            image = standard_resize(
-                                image,
-                                (
-                                    resize_width_before_upscale,
-                                    round(h * resize_width_before_upscale / w),
-                                ),
-                            )
-                        elif resize_factor_before_upscale != 100:
-                            h, w, _ = get_h_w_c(image)
-                            image = standard_resize(
-                                image,
-                                (
-                                    round(w * resize_factor_before_upscale / 100),
-                                    round(h * resize_factor_before_upscale / 100),
-                                ),
-                            )
-
-                        if is_grayscale and chain["AutoAdjustLevels"]:
-                            image = enhance_contrast(image)
-                        else:
-                            image = normalize(image)
-
-                        model_abs_path = get_model_abs_path(chain["ModelFilePath"])
-
-                        if model_abs_path in loaded_models:
-                            model = loaded_models[model_abs_path]
-
-                        elif os.path.exists(ensure_absolute_path(model_abs_path)):
-                            model, _, _ = load_model_node(context, Path(ensure_absolute_path(model_abs_path)))
-                            loaded_models[model_abs_path] = model
-                        tile_size_str = chain["ModelTileSize"]
-                    else:
-                        image = normalize(image)
-
-                    # image = np.ascontiguousarray(image)
-
-                    upscale_queue.put(
-                        (
-                            image,
-                            output_filename_rel,
-                            True,
-                            is_grayscale,
-                            original_width,
-                            original_height,
-                            get_tile_size(tile_size_str),
-                            model,
+                            continue
+
+                        os.makedirs(ensure_absolute_path(os.path.dirname(output_file_path)), exist_ok=True)
+                        pool.submit(
+                            read_and_preprocess,
+                            input_file_path,
+                            output_file_path,
+                            manifest_entry,
                         )
-                    )
-            elif filename.lower().endswith(ARCHIVE_EXTENSIONS):
-                if upscale_archives:
-                    output_file_path = f"{output_file_path}.cbz"
-                    if not overwrite_existing_files and os.path.isfile(
-                        ensure_absolute_path(output_file_path)
-                    ):
-                        print(f"file exists, skip: {output_file_path}", flush=True)
-                        continue
-                    os.makedirs(ensure_absolute_path(os.path.dirname(output_file_path)), exist_ok=True)
-
-                    upscale_archive_file(
-                        ensure_absolute_path(os.path.join(root, filename)),
-                        ensure_absolute_path(output_file_path),
-                        image_format,
-                        lossy_compression_quality,
-                        use_lossless_compression,
-                        target_scale,
-                        target_width,
-                        target_height,
-                        chains,
-                        loaded_models,
-                        grayscale_detection_threshold,
-                    )  # TODO custom output extension
-    upscale_queue.put(UPSCALE_SENTINEL)
+                elif filename.lower().endswith(ARCHIVE_EXTENSIONS):
+                    if upscale_archives:
+                        output_file_path = f"{output_file_path}.cbz"
+                        manifest_entry = (
+                            manifest.file_entry(input_file_path) if manifest else None
+                        )
+                        if should_skip_output(
+                            output_file_path,
+                            overwrite_existing_files,
+                            manifest,
+                            manifest_entry,
+                        ):
+                            continue
+
+                        preprocess_archive(
+                            pool,
+                            input_file_path,
+                            ensure_absolute_path(output_file_path),
+                            target_scale=target_scale,
+                            target_width=target_width,
+                            target_height=target_height,
+                            chains=chains,
+                            loaded_models=loaded_models,
+                            grayscale_detection_threshold=grayscale_detection_threshold,
+                            manifest=manifest,
+                            manifest_entry=manifest_entry,
+                        )  # TODO custom output extension
     # print("preprocess_worker_folder exiting")
 
 
 def preprocess_worker_image(
-    upscale_queue: Queue,
+    upscale_queue: ByteBudgetQueue[UpscaleQueueEntry],
     input_image_path: str,
     output_image_path: str,
     overwrite_existing_files: bool,
@@ -908,270 +1589,415 @@ def preprocess_worker_image(
     chains: list[dict[str, Any]],
     loaded_models: dict[str, ModelDescriptor],
     grayscale_detection_threshold: int,
+    manifest: UpscaleManifest | None = None,
+    manifest_entry: ManifestEntry | None = None,
 ) -> None:
     """
     given an image path, apply auto levels and add to upscale queue
     """
     if input_image_path.lower().endswith(IMAGE_EXTENSIONS):
-        if not overwrite_existing_files and os.path.isfile(ensure_absolute_path(output_image_path)):
-            print(f"file exists, skip: {output_image_path}", flush=True)
+        if should_skip_output(
+            output_image_path, overwrite_existing_files, manifest, manifest_entry
+        ):
             return
 
         os.makedirs(ensure_absolute_path(os.path.dirname(output_image_path)), exist_ok=True)
         # with Image.open(input_image_path) as img:
         image = _read_image_from_path(input_image_path)
 
-        chain, is_grayscale, original_width, original_height = get_chain_for_image(
+        item = preprocess_image(
             image,
-            target_scale,
-            target_width,
-            target_height,
-            chains,
-            grayscale_detection_threshold,
+            output_image_path,
+            None,
+            target_scale=target_scale,
+            target_width=target_width,
+            target_height=target_height,
+            chains=chains,
+            loaded_models=loaded_models,
+            grayscale_detection_threshold=grayscale_detection_threshold,
+            require_model=True,
         )
+        item.manifest_entry = manifest_entry
+        upscale_queue.put(item)
 
-        if is_grayscale:
-            image = convert_image_to_grayscale(image)
-
-        model = None
-        tile_size_str = ""
-        if chain is not None:
-            resize_width_before_upscale = chain["ResizeWidthBeforeUpscale"]
-            resize_height_before_upscale = chain["ResizeHeightBeforeUpscale"]
-            resize_factor_before_upscale = chain["ResizeFactorBeforeUpscale"]
-
-            # resize width and height, distorting image
-            if resize_height_before_upscale != 0 and resize_width_before_upscale != 0:
-                h, w, _ = get_h_w_c(image)
-                image = standard_resize(
-                    image, (resize_width_before_upscale, resize_height_before_upscale)
-                )
-            # resize height, keep proportional width
-            elif resize_height_before_upscale != 0:
-                h, w, _ = get_h_w_c(image)
-                image = standard_resize(
-                    image,
-                    (
-                        round(w * resize_height_before_upscale / h),
-                        resize_height_before_upscale,
-                    ),
-                )
-            # resize width, keep proportional height
-            elif resize_width_before_upscale != 0:
-                h, w, _ = get_h_w_c(image)
-                image = standard_resize(
-                    image,
-                    (
-                        resize_width_before_upscale,
-                        round(h * resize_width_before_upscale / w),
-                    ),
-                )
-            elif resize_factor_before_upscale != 100:
-                h, w, _ = get_h_w_c(image)
-                image = standard_resize(
-                    image,
-                    (
-                        round(w * resize_factor_before_upscale / 100),
-                        round(h * resize_factor_before_upscale / 100),
-                    ),
-                )
-
-            if is_grayscale and chain["AutoAdjustLevels"]:
-                image = enhance_contrast(image)
-            else:
-                image = normalize(image)
-
-            if chain["ModelFilePath"] == "No Model":
-                pass
-            else:
-                model_abs_path = get_model_abs_path(chain["ModelFilePath"])
 
-                if not os.path.exists(ensure_absolute_path(model_abs_path)):
-                    raise FileNotFoundError(model_abs_path)
+def upscale_worker(
+    upscale_queue: ByteBudgetQueue[UpscaleQueueEntry],
+    postprocess_queue: Queue,
+    page_ring: SharedPageRing,
+) -> None:
+    """
+    wait for upscale queue, for each queue entry, upscale image and add result to postprocess queue.
+    consecutive pages for the same model are collected into micro-batches of up to upscale_batch_size
+    pages, waiting at most upscale_batch_wait for the next page, and upscaled in one forward pass.
+    long strips are upscaled in bands, which are sent on one by one (see long_strip_bands).
+    upscaled images are moved into the shared page ring, only their slot goes through the queue.
+    archive markers are passed on as they are, entries keep their order
+    """
+    # print("upscale_worker entering")
+    held: list[UpscaleQueueEntry] = []
 
-                if model_abs_path in loaded_models:
-                    model = loaded_models[model_abs_path]
+    def send_page(
+        item: UpscaleItem,
+        image: np.ndarray | bytes | None,
+        strip_band: StripBand | None = None,
+    ) -> None:
+        if item.is_image:
+            assert isinstance(image, np.ndarray)
 
-                elif os.path.exists(ensure_absolute_path(model_abs_path)):
-                    model, _, _ = load_model_node(context, Path(ensure_absolute_path(model_abs_path)))
-                    loaded_models[model_abs_path] = model
-                tile_size_str = chain["ModelTileSize"]
-        else:
-            print("No chain!!!!!!!")
-            image = normalize(image)
+            # convert back to grayscale
+            if item.is_grayscale:
+                image = convert_image_to_grayscale(image)
 
-        # image = np.ascontiguousarray(image)
+            # images assembled on disk are handed over as their file
+            disk_canvas_path = detach_disk_canvas(image)
+            if disk_canvas_path is not None:
+                image = DiskPage(disk_canvas_path, image.shape, image.dtype.str)
+            else:
+                image = page_ring.put(image)
 
-        upscale_queue.put(
-            (
+        postprocess_queue.put(
+            PostprocessItem(
                 image,
-                None,
-                True,
-                is_grayscale,
-                original_width,
-                original_height,
-                get_tile_size(tile_size_str),
-                model,
+                item.destination,
+                item.output_archive_path,
+                item.archive_index,
+                is_image=item.is_image,
+                is_grayscale=item.is_grayscale,
+                original_width=item.original_width,
+                original_height=item.original_height,
+                manifest_entry=item.manifest_entry,
+                content_crop=item.content_crop,
+                strip_band=strip_band,
             )
         )
-    upscale_queue.put(UPSCALE_SENTINEL)
 
+    def next_entry(timeout: float | None = None) -> UpscaleQueueEntry:
+        if held:
+            return held.pop()
+        return upscale_queue.get(timeout=timeout)
 
-def upscale_worker(upscale_queue: Queue, postprocess_queue: Queue) -> None:
-    """
-    wait for upscale queue, for each queue entry, upscale image and add result to postprocess queue
-    """
-    # print("upscale_worker entering")
     while True:
-        (
-            image,
-            file_name,
-            is_image,
-            is_grayscale,
-            original_width,
-            original_height,
-            model_tile_size,
-            model,
-        ) = upscale_queue.get()
-        if image is None:
+        entry: UpscaleQueueEntry = next_entry()
+        if entry is None:
             break
 
-        if is_image:
-            image = ai_upscale_image(image, model_tile_size, model)
-
-            # convert back to grayscale
-            if is_grayscale:
-                image = convert_image_to_grayscale(image)
+        if not isinstance(entry, UpscaleItem):
+            postprocess_queue.put(entry)
+            continue
+
+        if is_long_strip(entry):
+            assert isinstance(entry.image, np.ndarray)
+            height = get_h_w_c(entry.image)[0]
+            bands = long_strip_bands(height, get_tile_op_overlap(entry))
+            for index, (start, end, top, bottom) in enumerate(bands):
+                image = ai_upscale_image(
+                    entry.image[start:end],
+                    entry.model_tile_size,
+                    entry.model,
+                    uniform_tile_threshold=entry.uniform_tile_threshold,
+                    tile_op=get_tile_op(entry),
+                    tile_op_overlap=get_tile_op_overlap(entry),
+                )
+                scale = get_h_w_c(image)[0] // (end - start)
+                send_page(
+                    entry,
+                    image,
+                    StripBand(
+                        index, len(bands), height * scale, top * scale, bottom * scale
+                    ),
+                )
+            continue
+
+        batch = [entry]
+        if entry.is_image and entry.model is not None:
+            deadline = time.monotonic() + upscale_batch_wait
+            while len(batch) < upscale_batch_size:
+                try:
+                    candidate = next_entry(max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if isinstance(candidate, UpscaleItem) and can_batch_with(
+                    batch, candidate
+                ):
+                    batch.append(candidate)
+                else:
+                    # handled after the batch, so the order of the entries is kept
+                    held.append(candidate)
+                    break
+
+        images: list[np.ndarray | bytes | None] = [item.image for item in batch]
+        if entry.is_image:
+            images = list(
+                ai_upscale_images(
+                    [image for image in images if isinstance(image, np.ndarray)],
+                    entry.model_tile_size,
+                    entry.model,
+                    uniform_tile_threshold=entry.uniform_tile_threshold,
+                    tile_op=get_tile_op(entry),
+                    tile_op_overlap=get_tile_op_overlap(entry),
+                )
+            )
 
-        postprocess_queue.put(
-            (image, file_name, is_image, is_grayscale, original_width, original_height)
-        )
-    postprocess_queue.put(POSTPROCESS_SENTINEL)
+        for item, image in zip(batch, images, strict=True):
+            send_page(item, image)
+    postprocess_queue.put(None)
     # print("upscale_worker exiting")
 
 
-def postprocess_worker_zip(
+def postprocess_worker(
     postprocess_queue: Queue,
-    output_zip_path: str,
+    page_ring: SharedPageRing,
+    *,
     image_format: str,
     lossy_compression_quality: int,
     use_lossless_compression: bool,
     target_scale: float,
     target_width: int,
     target_height: int,
+    manifest: UpscaleManifest | None,
+    image_progress: str = "postprocess_worker_folder",
 ) -> None:
     """
-    wait for postprocess queue, for each queue entry, save the image to the zip file
+    wait for postprocess queue, for each queue entry, save or encode the image on the encoder pool.
+    written images that aren't part of an archive report `PROGRESS=<image_progress>`.
+    pages of archives are written to their output archive in the original page order,
+    and each output archive is finalized once its end marker comes through.
+    written outputs are recorded in the manifest, archives together with their pages once finalized
     """
-    # print("postprocess_worker_zip entering")
-    with ZipFile(output_zip_path, "w", ZIP_DEFLATED) as output_zip:
-        while True:
-            (
+    # print("postprocess_worker entering")
+    output_archives: dict[str, ArchiveWriter] = {}
+    # long strip pages whose bands are being blended
+    strips: dict[tuple[str | None, str], StreamingTileBlender] = {}
+    archive_manifest_entries: dict[
+        str, tuple[ManifestEntry | None, list[tuple[ManifestEntry, str]]]
+    ] = {}
+
+    def finish_entry(entry: PostprocessQueueEntry) -> None:
+        if isinstance(entry, ArchiveStart):
+            print(f"TOTALZIP={entry.entry_count}", flush=True)
+            output_archives[entry.output_archive_path] = open_archive_writer(
+                entry.output_archive_path, resume_archives
+            )
+            archive_manifest_entries[entry.output_archive_path] = (
+                entry.manifest_entry,
+                [],
+            )
+        elif isinstance(entry, ArchiveEnd):
+            output_archives.pop(entry.output_archive_path).finalize()
+            manifest_entry, pages = archive_manifest_entries.pop(
+                entry.output_archive_path
+            )
+            if manifest is not None and manifest_entry is not None:
+                manifest.record(manifest_entry, entry.output_archive_path, pages)
+            print("PROGRESS=postprocess_worker_zip_archive", flush=True)
+        elif isinstance(entry, PostprocessItem):
+            if entry.output_archive_path is None:
+                if manifest is not None and entry.manifest_entry is not None:
+                    manifest.record(entry.manifest_entry, entry.destination)
+                print(f"PROGRESS={image_progress}", flush=True)
+                return
+
+            data = entry.image if isinstance(entry.image, bytes) else None
+            if data is None:
+                print(f"no data, skipping: {entry.destination}", flush=True)
+            # Add the resized image to the output zip
+            output_archives[entry.output_archive_path].write(
+                entry.archive_index, entry.destination, data
+            )
+            if entry.manifest_entry is not None:
+                archive_manifest_entries[entry.output_archive_path][1].append(
+                    (entry.manifest_entry, entry.destination)
+                )
+            print("PROGRESS=postprocess_worker_zip_image", flush=True)
+
+    def open_page(page: SharedPage | DiskPage | np.ndarray) -> np.ndarray:
+        if isinstance(page, DiskPage):
+            return page.open()
+        if isinstance(page, SharedPage):
+            return page_ring.get(page)
+        return page
+
+    def close_page(page: SharedPage | DiskPage | np.ndarray) -> None:
+        if isinstance(page, DiskPage):
+            page.remove()
+        elif isinstance(page, SharedPage):
+            page_ring.release(page)
+
+    def add_strip_band(entry: PostprocessItem) -> np.ndarray | None:
+        """
+        blend a band of a long strip into its page, returns the page once all bands are in
+        """
+        band = entry.strip_band
+        page = entry.image
+        assert band is not None and isinstance(page, (SharedPage, DiskPage))
+        key = (entry.output_archive_path, entry.destination)
+        try:
+            image = open_page(page)
+            if image.ndim == 2:
+                image = image[..., np.newaxis]
+            blender = strips.get(key)
+            if blender is None:
+                _, w, c = get_h_w_c(image)
+                # the page is assembled on disk, only the band is held in memory
+                blender = StreamingTileBlender(
+                    w,
+                    band.page_height,
+                    c,
+                    blend_fn=half_sin_blend_fn,
+                    dtype=blend_dtype(image),
+                    on_disk=True,
+                )
+                strips[key] = blender
+            blender.add_tile(
                 image,
-                file_name,
-                is_image,
-                is_grayscale,
-                original_width,
-                original_height,
-            ) = postprocess_queue.get()
-            if image is None:
-                break
-            if is_image:
-                # image = postprocess_image(image)
-                save_image_zip(
+                TileOverlap(0, 0),
+                TileOverlap(band.overlap_top, band.overlap_bottom),
+            )
+        finally:
+            image = None
+            close_page(page)
+
+        if not band.is_last:
+            return None
+        result = strips.pop(key).get_result()
+        return result[..., 0] if result.shape[2] == 1 else result
+
+    def process_page(entry: PostprocessItem) -> PostprocessItem:
+        page = entry.image
+        assert isinstance(page, (SharedPage, DiskPage, np.ndarray))
+        try:
+            image = open_page(page)
+            if entry.content_crop is not None:
+                image = uncrop(image, entry.content_crop)
+
+            if entry.output_archive_path is None:
+                save_image(
                     image,
-                    str(Path(file_name).with_suffix(f".{image_format}")),
-                    output_zip,
+                    entry.destination,
                     image_format,
                     lossy_compression_quality,
                     use_lossless_compression,
-                    original_width,
-                    original_height,
+                    entry.original_width,
+                    entry.original_height,
                     target_scale,
                     target_width,
                     target_height,
-                    is_grayscale,
+                    entry.is_grayscale,
                 )
-            else:  # copy file
-                output_zip.writestr(file_name, image)
-            print("PROGRESS=postprocess_worker_zip_image", flush=True)
-        print("PROGRESS=postprocess_worker_zip_archive", flush=True)
-
+                return replace(entry, image=None)
 
-def postprocess_worker_folder(
-    postprocess_queue: Queue,
-    output_folder_path: str,
+            file_name = str(Path(entry.destination).with_suffix(f".{image_format}"))
+            print(f"save image to zip: {file_name}", flush=True)
+            data = encode_image(
+                image,
+                image_format,
+                lossy_compression_quality=lossy_compression_quality,
+                use_lossless_compression=use_lossless_compression,
+                original_width=entry.original_width,
+                original_height=entry.original_height,
+                target_scale=target_scale,
+                target_width=target_width,
+                target_height=target_height,
+                is_grayscale=entry.is_grayscale,
+            )
+            return replace(entry, image=data, destination=file_name)
+        finally:
+            # drop the mapping first, Windows can't delete mapped files
+            image = None
+            close_page(page)
+
+    try:
+        with OrderedWorkerPool(
+            encoder_worker_count, finish_entry, name="encoder"
+        ) as pool:
+            while True:
+                entry: PostprocessQueueEntry = postprocess_queue.get()
+                if entry is None:
+                    break
+                if isinstance(entry, PostprocessItem) and entry.strip_band is not None:
+                    # bands are blended in order here, only whole pages are encoded
+                    strip = add_strip_band(entry)
+                    if strip is not None:
+                        pool.submit(
+                            process_page, replace(entry, image=strip, strip_band=None)
+                        )
+                elif isinstance(entry, PostprocessItem) and entry.is_image:
+                    pool.submit(process_page, entry)
+                else:  # copy file or archive marker
+                    pool.submit_result(entry)
+    finally:
+        for output_archive in output_archives.values():
+            output_archive.close()
+        page_ring.close_reader()
+        if manifest is not None:
+            manifest.close()
+
+    # print("postprocess_worker exiting")
+
+
+def run_pipeline(
+    preprocess: Callable[[ByteBudgetQueue[UpscaleQueueEntry]], None],
+    *,
     image_format: str,
     lossy_compression_quality: int,
     use_lossless_compression: bool,
-    target_scale: float,
+    target_scale: float | None,
     target_width: int,
     target_height: int,
+    manifest: UpscaleManifest | None = None,
+    image_progress: str = "postprocess_worker_folder",
 ) -> None:
     """
-    wait for postprocess queue, for each queue entry, save the image to the output folder
+    run the preprocess thread, the upscale thread and the postprocess process.
+    `preprocess` fills the upscale queue, the pipeline shuts down once it returns.
+    the upscale queue is limited by the bytes of the pages in it, so small pages are
+    prefetched deeply while large ones are throttled
     """
-    # print("postprocess_worker_folder entering")
-    while True:
-        image, file_name, _, is_grayscale, original_width, original_height = (
-            postprocess_queue.get()
-        )
-        if image is None:
-            break
-        image = postprocess_image(image)
-        save_image(
-            image,
-            os.path.join(output_folder_path, str(Path(f"{file_name}.{image_format}"))),
-            image_format,
-            lossy_compression_quality,
-            use_lossless_compression,
-            original_width,
-            original_height,
-            target_scale,
-            target_width,
-            target_height,
-            is_grayscale,
-        )
-        print("PROGRESS=postprocess_worker_folder", flush=True)
+    upscale_queue = ByteBudgetQueue(
+        upscale_queue_budget, upscale_queue_entry_nbytes, max_items=upscale_queue_depth
+    )
+    page_ring = SharedPageRing(shared_memory_slots, shared_memory_budget)
+    postprocess_queue = MPQueue(maxsize=shared_memory_slots)
 
-    # print("postprocess_worker_folder exiting")
+    def preprocess_worker() -> None:
+        try:
+            preprocess(upscale_queue)
+        finally:
+            upscale_queue.put(None)
 
+    # start preprocess process
+    preprocess_process = Thread(target=preprocess_worker)
+    preprocess_process.start()
 
-def postprocess_worker_image(
-    postprocess_queue: Queue,
-    output_file_path: str,
-    image_format: str,
-    lossy_compression_quality: int,
-    use_lossless_compression: bool,
-    target_scale: float,
-    target_width: int,
-    target_height: int,
-) -> None:
-    """
-    wait for postprocess queue, for each queue entry, save the image to the output file path
-    """
-    while True:
-        image, _, _, is_grayscale, original_width, original_height = (
-            postprocess_queue.get()
-        )
-        if image is None:
-            break
-        # image = postprocess_image(image)
+    # start upscale process
+    upscale_process = Thread(
+        target=upscale_worker, args=(upscale_queue, postprocess_queue, page_ring)
+    )
+    upscale_process.start()
 
-        save_image(
-            image,
-            output_file_path,
-            image_format,
-            lossy_compression_quality,
-            use_lossless_compression,
-            original_width,
-            original_height,
-            target_scale,
-            target_width,
-            target_height,
-            is_grayscale,
-        )
-        print("PROGRESS=postprocess_worker_image", flush=True)
+    # start postprocess process
+    postprocess_process = Process(
+        target=postprocess_worker,
+        args=(postprocess_queue, page_ring),
+        kwargs={
+            "image_format": image_format,
+            "lossy_compression_quality": lossy_compression_quality,
+            "use_lossless_compression": use_lossless_compression,
+            "target_scale": target_scale,
+            "target_width": target_width,
+            "target_height": target_height,
+            "manifest": manifest,
+            "image_progress": image_progress,
+        },
+    )
+    postprocess_process.start()
+
+    # wait for all processes
+    preprocess_process.join()
+    upscale_process.join()
+    postprocess_process.join()
+    page_ring.close()
 
 
 def upscale_archive_file(
@@ -1186,16 +2012,11 @@ def upscale_archive_file(
     chains: list[dict[str, Any]],
     loaded_models: dict[str, ModelDescriptor],
     grayscale_detection_threshold: int,
+    manifest: UpscaleManifest | None = None,
+    manifest_entry: ManifestEntry | None = None,
 ) -> None:
-    # TODO accept multiple paths to reuse simple queues?
-
-    upscale_queue = Queue(maxsize=1)
-    postprocess_queue = MPQueue(maxsize=1)
-
-    # start preprocess zip process
-    preprocess_process = Thread(
-        target=preprocess_worker_archive,
-        args=(
+    run_pipeline(
+        lambda upscale_queue: preprocess_worker_archive(
             upscale_queue,
             input_zip_path,
             output_zip_path,
@@ -1205,36 +2026,17 @@ def upscale_archive_file(
             chains,
             loaded_models,
             grayscale_detection_threshold,
+            manifest,
+            manifest_entry,
         ),
+        image_format=image_format,
+        lossy_compression_quality=lossy_compression_quality,
+        use_lossless_compression=use_lossless_compression,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        manifest=manifest,
     )
-    preprocess_process.start()
-
-    # start upscale process
-    upscale_process = Thread(
-        target=upscale_worker, args=(upscale_queue, postprocess_queue)
-    )
-    upscale_process.start()
-
-    # start postprocess zip process
-    postprocess_process = Process(
-        target=postprocess_worker_zip,
-        args=(
-            postprocess_queue,
-            output_zip_path,
-            image_format,
-            lossy_compression_quality,
-            use_lossless_compression,
-            target_scale,
-            target_width,
-            target_height,
-        ),
-    )
-    postprocess_process.start()
-
-    # wait for all processes
-    preprocess_process.join()
-    upscale_process.join()
-    postprocess_process.join()
 
 
 def upscale_image_file(
@@ -1250,14 +2052,11 @@ def upscale_image_file(
     chains: list[dict[str, Any]],
     loaded_models: dict[str, ModelDescriptor],
     grayscale_detection_threshold: int,
+    manifest: UpscaleManifest | None = None,
+    manifest_entry: ManifestEntry | None = None,
 ) -> None:
-    upscale_queue = Queue(maxsize=1)
-    postprocess_queue = MPQueue(maxsize=1)
-
-    # start preprocess image process
-    preprocess_process = Thread(
-        target=preprocess_worker_image,
-        args=(
+    run_pipeline(
+        lambda upscale_queue: preprocess_worker_image(
             upscale_queue,
             input_image_path,
             output_image_path,
@@ -1268,36 +2067,18 @@ def upscale_image_file(
             chains,
             loaded_models,
             grayscale_detection_threshold,
+            manifest,
+            manifest_entry,
         ),
+        image_format=image_format,
+        lossy_compression_quality=lossy_compression_quality,
+        use_lossless_compression=use_lossless_compression,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        manifest=manifest,
+        image_progress="postprocess_worker_image",
     )
-    preprocess_process.start()
-
-    # start upscale process
-    upscale_process = Thread(
-        target=upscale_worker, args=(upscale_queue, postprocess_queue)
-    )
-    upscale_process.start()
-
-    # start postprocess image process
-    postprocess_process = Process(
-        target=postprocess_worker_image,
-        args=(
-            postprocess_queue,
-            output_image_path,
-            image_format,
-            lossy_compression_quality,
-            use_lossless_compression,
-            target_scale,
-            target_width,
-            target_height,
-        ),
-    )
-    postprocess_process.start()
-
-    # wait for all processes
-    preprocess_process.join()
-    upscale_process.join()
-    postprocess_process.join()
 
 
 def upscale_file(
@@ -1316,6 +2097,20 @@ def upscale_file(
     grayscale_detection_threshold: int,
 ) -> None:
     input_file_base = Path(input_file_path).stem
+    manifest = open_manifest(
+        output_folder_path,
+        image_format=image_format,
+        lossy_compression_quality=lossy_compression_quality,
+        use_lossless_compression=use_lossless_compression,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        chains=chains,
+        grayscale_detection_threshold=grayscale_detection_threshold,
+    )
+    manifest_entry = (
+        manifest.file_entry(ensure_absolute_path(input_file_path)) if manifest else None
+    )
 
     if input_file_path.lower().endswith(ARCHIVE_EXTENSIONS):
         output_file_path = str(
@@ -1324,8 +2119,9 @@ def upscale_file(
             )
         )
         print("output_file_path", output_file_path, flush=True)
-        if not overwrite_existing_files and os.path.isfile(output_file_path):
-            print(f"file exists, skip: {output_file_path}", flush=True)
+        if should_skip_output(
+            output_file_path, overwrite_existing_files, manifest, manifest_entry
+        ):
             return
 
         upscale_archive_file(
@@ -1340,6 +2136,8 @@ def upscale_file(
             chains,
             loaded_models,
             grayscale_detection_threshold,
+            manifest,
+            manifest_entry,
         )
 
     elif input_file_path.lower().endswith(IMAGE_EXTENSIONS):
@@ -1348,8 +2146,9 @@ def upscale_file(
                 f"{os.path.join(output_folder_path,output_filename.replace('%filename%', input_file_base))}.{image_format}"
             )
         )
-        if not overwrite_existing_files and os.path.isfile(output_file_path):
-            print(f"file exists, skip: {output_file_path}", flush=True)
+        if should_skip_output(
+            output_file_path, overwrite_existing_files, manifest, manifest_entry
+        ):
             return
 
         upscale_image_file(
@@ -1365,6 +2164,8 @@ def upscale_file(
             chains,
             loaded_models,
             grayscale_detection_threshold,
+            manifest,
+            manifest_entry,
         )
 
 
@@ -1386,15 +2187,21 @@ def upscale_folder(
     grayscale_detection_threshold: int,
 ) -> None:
     # print("upscale_folder: entering")
+    manifest = open_manifest(
+        output_folder_path,
+        image_format=image_format,
+        lossy_compression_quality=lossy_compression_quality,
+        use_lossless_compression=use_lossless_compression,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        chains=chains,
+        grayscale_detection_threshold=grayscale_detection_threshold,
+    )
 
-    # preprocess_queue = Queue(maxsize=1)
-    upscale_queue = Queue(maxsize=1)
-    postprocess_queue = MPQueue(maxsize=1)
-
-    # start preprocess folder process
-    preprocess_process = Thread(
-        target=preprocess_worker_folder,
-        args=(
+    # images and archives of the whole folder share a single pipeline
+    run_pipeline(
+        lambda upscale_queue: preprocess_worker_folder(
             upscale_queue,
             input_folder_path,
             output_folder_path,
@@ -1403,44 +2210,22 @@ def upscale_folder(
             upscale_archives,
             overwrite_existing_files,
             image_format,
-            lossy_compression_quality,
-            use_lossless_compression,
             target_scale,
             target_width,
             target_height,
             chains,
             loaded_models,
             grayscale_detection_threshold,
+            manifest,
         ),
+        image_format=image_format,
+        lossy_compression_quality=lossy_compression_quality,
+        use_lossless_compression=use_lossless_compression,
+        target_scale=target_scale,
+        target_width=target_width,
+        target_height=target_height,
+        manifest=manifest,
     )
-    preprocess_process.start()
-
-    # start upscale process
-    upscale_process = Thread(
-        target=upscale_worker, args=(upscale_queue, postprocess_queue)
-    )
-    upscale_process.start()
-
-    # start postprocess folder process
-    postprocess_process = Process(
-        target=postprocess_worker_folder,
-        args=(
-            postprocess_queue,
-            output_folder_path,
-            image_format,
-            lossy_compression_quality,
-            use_lossless_compression,
-            target_scale,
-            target_width,
-            target_height,
-        ),
-    )
-    postprocess_process.start()
-
-    # wait for all processes
-    preprocess_process.join()
-    upscale_process.join()
-    postprocess_process.join()
 
 
 current_file_directory = os.path.dirname(os.path.abspath(__file__))
@@ -1450,18 +2235,18 @@ def get_model_abs_path(chain_model_file_path: str) -> str:
     return os.path.abspath(os.path.join(models_directory, chain_model_file_path))
 
 
+gamma1icc_path = os.path.join(
+    current_file_directory, "../ImageMagick/Custom Gray Gamma 1.0.icc"
+)
+dotgain20icc_path = os.path.join(current_file_directory, "../ImageMagick/Dot Gain 20%.icc")
+
+
 def get_gamma_icc_profile() -> ImageCmsProfile:
-    profile_path = os.path.join(
-        current_file_directory, "../ImageMagick/Custom Gray Gamma 1.0.icc"
-    )
-    return ImageCms.getOpenProfile(profile_path)
+    return ImageCms.getOpenProfile(gamma1icc_path)
 
 
 def get_dot20_icc_profile() -> ImageCmsProfile:
-    profile_path = os.path.join(
-        current_file_directory, "../ImageMagick/Dot Gain 20%.icc"
-    )
-    return ImageCms.getOpenProfile(profile_path)
+    return ImageCms.getOpenProfile(dotgain20icc_path)
 
 
 def parse_settings_from_cli():
@@ -1496,10 +2281,30 @@ def parse_settings_from_cli():
                         type=int,
                         default=0,
                         help="Device used to run upscaling jobs in case more than one is available. Default: 0")
+    parser.add_argument("--encoder-workers",
+                        type=int,
+                        default=None,
+                        help="Number of threads resizing and encoding upscaled images. "
+                             "0 picks a value based on the CPU count. Default: EncoderWorkerCount from settings")
+    parser.add_argument("--preprocess-workers",
+                        type=int,
+                        default=None,
+                        help="Number of threads decoding and preprocessing images. "
+                             "0 picks a value based on the CPU count. Default: PreprocessWorkerCount from settings")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Journal finished archive pages next to the output archive, so an interrupted "
+                             "archive continues where it stopped on the next run. Default: ResumeArchives from settings")
+    parser.add_argument("--manifest",
+                        action="store_true",
+                        help="Record inputs, settings and outputs in a manifest in the output folder, and only "
+                             "redo inputs whose content or settings changed. Default: UseManifest from settings")
 
     args = parser.parse_args()
 
-    return parse_auto_settings(args) if args.settings else parse_manual_settings(args)
+    settings = parse_auto_settings(args) if args.settings else parse_manual_settings(args)
+
+    return apply_cli_overrides(settings, args)
 
 
 def parse_auto_settings(args):
@@ -1509,6 +2314,31 @@ def parse_auto_settings(args):
     return json_settings
 
 
+def apply_cli_overrides(
+    settings: dict[str, Any], args: argparse.Namespace
+) -> dict[str, Any]:
+    if args.preprocess_workers is not None:
+        settings["PreprocessWorkerCount"] = args.preprocess_workers
+    if args.encoder_workers is not None:
+        settings["EncoderWorkerCount"] = args.encoder_workers
+    if args.resume:
+        settings["ResumeArchives"] = True
+    if args.manifest:
+        settings["UseManifest"] = True
+
+    return settings
+
+
+def get_worker_count(configured_count: int) -> int:
+    """
+    worker count from settings, 0 means automatic
+    """
+    if configured_count > 0:
+        return configured_count
+
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
 def parse_manual_settings(args):
     with open(DEFAULT_FILE_PATH, "r") as default_file:
         default_json = json.load(default_file)
@@ -1536,16 +2366,35 @@ settings = parse_settings_from_cli()
 
 workflow = settings["Workflows"]["$values"][settings["SelectedWorkflowIndex"]]
 models_directory = settings["ModelsDirectory"]
+onnx_cache_directory = os.path.join(models_directory, "onnx")
 
-UPSCALE_SENTINEL = (None, None, None, None, None, None, None, None)
-POSTPROCESS_SENTINEL = (None, None, None, None, None, None)
 CV2_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
 IMAGE_EXTENSIONS = (*CV2_IMAGE_EXTENSIONS, ".avif")
 ZIP_EXTENSIONS = (".zip", ".cbz")
 RAR_EXTENSIONS = (".rar", ".cbr")
 ARCHIVE_EXTENSIONS = ZIP_EXTENSIONS + RAR_EXTENSIONS
 loaded_models = {}
+model_load_lock = Lock()
 system_codepage = get_system_codepage()
+preprocess_worker_count = get_worker_count(settings.get("PreprocessWorkerCount", 0))
+encoder_worker_count = get_worker_count(settings.get("EncoderWorkerCount", 0))
+shared_memory_slots = max(1, settings.get("SharedMemorySlots", 4))
+upscale_queue_budget = settings.get("UpscaleQueueBudgetMB", 2048) * 1024**2
+upscale_queue_depth = max(0, settings.get("UpscaleQueueDepth", 16))
+resume_archives = settings.get("ResumeArchives", False)
+use_manifest = settings.get("UseManifest", False)
+upscale_batch_size = max(1, settings.get("UpscaleBatchSize", 8))
+upscale_batch_wait = max(0, settings.get("UpscaleBatchWaitMs", 20)) / 1000
+upscale_batch_max_padding = 1.25
+downscale_tiles_to_target = settings.get("DownscaleTilesToTarget", False)
+backend = settings.get("Backend", "pytorch")
+onnx_intra_op_threads = settings.get("OnnxIntraOpThreads", 0)
+onnx_inter_op_threads = settings.get("OnnxInterOpThreads", 0)
+onnx_unsupported_architectures: set[str] = set()
+long_strip_aspect_ratio = settings.get("LongStripAspectRatio", 4)
+long_strip_band_height = max(1, settings.get("LongStripBandHeight", 2048))
+long_strip_overlap = 16
+shared_memory_budget = settings.get("SharedMemoryBudgetMB", 2048) * 1024**2
 
 settings_parser = SettingsParser(
     {
@@ -1553,9 +2402,22 @@ settings_parser = SettingsParser(
         "use_fp16": settings["UseFp16"],
         "gpu_index": settings["SelectedDeviceIndex"],
         "budget_limit": 0,
+        "output_uint8": settings.get("QuantizeInferenceOutput", False),
+        "tile_size_cache": models_directory,
+        "calibrate_memory": settings.get("CalibrateTileMemory", True),
+        "tile_size_probe_interval": settings.get("TileSizeProbeInterval", 16),
+        "seam_tolerance": settings.get("TileSeamTolerance", 0),
     }
 )
 
+if backend == "onnxruntime" and settings.get("TileSeamTolerance", 0) > 0:
+    # the calibration runs the model with pytorch
+    print(
+        "TileSeamTolerance only applies to models that run with pytorch, "
+        "models that run with onnxruntime use the default tile overlap",
+        flush=True,
+    )
+
 context = _ExecutorNodeContext(ProgressController(), settings_parser, Path())
 
 gamma1icc = get_gamma_icc_profile()
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from multiprocessing import Queue as MPQueue
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
+from threading import Lock
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class SharedPage:
+    """
+    A reference to an image stored in a slot of a `SharedPageRing`.
+
+    This is what crosses the process boundary instead of the image data itself.
+    """
+
+    slot: int
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+class SharedPageRing:
+    """
+    A ring of shared memory slots used to move images from the upscale thread to the
+    postprocess process without pickling them.
+
+    The producer copies an image into a free slot with `put` and sends the returned
+    `SharedPage` through a regular queue. The consumer maps it with `get` and hands the
+    slot back with `release` once it no longer needs the data. Released slots are
+    recycled, and segments are only reallocated when a page doesn't fit.
+
+    `put` blocks while all slots are in use or while the page would push the bytes in
+    flight above `max_bytes`. A single page larger than `max_bytes` is still accepted,
+    but only once nothing else is in flight.
+
+    `put` and `close` must only be called in the process that created the ring.
+    `get`, `release` and `close_reader` may be called in any process the ring was passed
+    to (e.g. as an argument of `multiprocessing.Process`), and from several threads of
+    that process.
+    """
+
+    def __init__(self, slot_count: int, max_bytes: int) -> None:
+        assert slot_count > 0
+        self.slot_count: int = slot_count
+        self.max_bytes: int = max_bytes
+        self._released: MPQueue = MPQueue()
+
+        # producer state
+        self._segments: dict[int, SharedMemory] = {}
+        self._free_slots: set[int] = set(range(slot_count))
+        self._in_flight: dict[int, int] = {}
+
+        # consumer state, guarded by the reader lock
+        self._reader_lock = Lock()
+        self._attached: dict[int, SharedMemory] = {}
+        self._stale: list[SharedMemory] = []
+
+        if os.name == "posix":
+            # Start the resource tracker before the consumer process is started, so
+            # that it shares ours. Otherwise, the consumer would start its own tracker,
+            # which unlinks every segment it attached to when the consumer exits.
+            resource_tracker.ensure_running()
+
+    def __getstate__(self) -> dict:
+        # only the release queue is shared, all other state is local to each side
+        return {
+            "slot_count": self.slot_count,
+            "max_bytes": self.max_bytes,
+            "_released": self._released,
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._segments = {}
+        self._free_slots = set()
+        self._in_flight = {}
+        self._reader_lock = Lock()
+        self._attached = {}
+        self._stale = []
+
+    # producer
+
+    def put(self, image: np.ndarray) -> SharedPage:
+        nbytes = image.nbytes
+
+        while not self._can_admit(nbytes):
+            self._collect_released(block=True)
+
+        slot = self._pick_slot(nbytes)
+        segment = self._segments.get(slot)
+        if segment is None or segment.size < nbytes:
+            if segment is not None:
+                self._free_segment(slot)
+            self._trim(nbytes)
+            segment = SharedMemory(create=True, size=max(1, nbytes))
+            self._segments[slot] = segment
+
+        np.ndarray(image.shape, image.dtype, buffer=segment.buf)[...] = image
+
+        self._free_slots.remove(slot)
+        self._in_flight[slot] = nbytes
+        return SharedPage(slot, segment.name, tuple(image.shape), image.dtype.str)
+
+    @property
+    def bytes_in_flight(self) -> int:
+        return sum(self._in_flight.values())
+
+    def close(self) -> None:
+        """
+        Frees all shared memory. Only call this after the consumer is done.
+        """
+        for slot in list(self._segments):
+            self._free_segment(slot)
+        self._released.close()
+
+    def _can_admit(self, nbytes: int) -> bool:
+        self._collect_released(block=False)
+        if not self._free_slots:
+            return False
+        return not self._in_flight or self.bytes_in_flight + nbytes <= self.max_bytes
+
+    def _collect_released(self, block: bool) -> None:
+        try:
+            slot = self._released.get(block=block)
+            while True:
+                self._in_flight.pop(slot, None)
+                self._free_slots.add(slot)
+                slot = self._released.get(block=False)
+        except Empty:
+            pass
+
+    def _pick_slot(self, nbytes: int) -> int:
+        # prefer the smallest existing segment the page fits into
+        fitting = [
+            s
+            for s in self._free_slots
+            if s in self._segments and self._segments[s].size >= nbytes
+        ]
+        if fitting:
+            return min(fitting, key=lambda s: self._segments[s].size)
+
+        unallocated = [s for s in self._free_slots if s not in self._segments]
+        if unallocated:
+            return unallocated[0]
+
+        return max(self._free_slots, key=lambda s: self._segments[s].size)
+
+    def _trim(self, nbytes: int) -> None:
+        """
+        Frees idle segments until a new segment of the given size fits into the budget.
+        """
+        idle = sorted(
+            (s for s in self._free_slots if s in self._segments),
+            key=lambda s: self._segments[s].size,
+            reverse=True,
+        )
+        allocated = sum(segment.size for segment in self._segments.values())
+        for slot in idle:
+            if allocated + nbytes <= self.max_bytes:
+                break
+            allocated -= self._segments[slot].size
+            self._free_segment(slot)
+
+    def _free_segment(self, slot: int) -> None:
+        segment = self._segments.pop(slot)
+        segment.close()
+        segment.unlink()
+
+    # consumer
+
+    def get(self, page: SharedPage) -> np.ndarray:
+        """
+        Returns a view of the page's data. The view is only valid until the page is released.
+        """
+        with self._reader_lock:
+            self._close_stale()
+
+            segment = self._attached.get(page.slot)
+            if segment is None or segment.name != page.name:
+                if segment is not None:
+                    self._stale.append(segment)
+                    self._close_stale()
+                segment = SharedMemory(name=page.name)
+                self._attached[page.slot] = segment
+
+            return np.ndarray(page.shape, np.dtype(page.dtype), buffer=segment.buf)
+
+    def release(self, page: SharedPage) -> None:
+        self._released.put(page.slot)
+
+    def close_reader(self) -> None:
+        with self._reader_lock:
+            self._stale.extend(self._attached.values())
+            self._attached.clear()
+            self._close_stale()
+
+    def _close_stale(self) -> None:
+        # only called with the reader lock held
+        still_in_use: list[SharedMemory] = []
+        for segment in self._stale:
+            try:
+                segment.close()
+            except BufferError:
+                # a view of the old page is still alive, try again later
+                still_in_use.append(segment)
+        self._stale = still_in_use
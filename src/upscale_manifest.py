@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+from collections.abc import Iterable
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any
+
+MANIFEST_FILE_NAME = ".mangajanai-manifest.sqlite"
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """
+    An input as recorded in the manifest: a file (`member` is empty), or a member of an
+    archive file.
+    """
+
+    input_path: str
+    member: str
+    input_hash: str
+    settings_hash: str
+    input_size: int = 0
+    input_mtime_ns: int = 0
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class UpscaleManifest:
+    """
+    An SQLite database in the output folder that records, for every input file and archive
+    member, the hash of the input, the hash of the effective settings and the output it
+    was written to. Re-runs use it to skip inputs that didn't change.
+
+    The settings hash covers the output format, the target size and the chains, including
+    the content of every chain's model file.
+
+    The manifest can be passed to other processes, each process opens its own connection.
+    """
+
+    def __init__(
+        self,
+        output_folder_path: str,
+        settings: dict[str, Any],
+        model_paths: Iterable[str],
+    ) -> None:
+        self.path: str = os.path.join(output_folder_path, MANIFEST_FILE_NAME)
+        self._pid = os.getpid()
+        self._lock = Lock()
+        self._connection: sqlite3.Connection | None = None
+
+        os.makedirs(output_folder_path, exist_ok=True)
+        with self._lock:
+            connection = self._connect()
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    input_path TEXT NOT NULL,
+                    member TEXT NOT NULL,
+                    input_size INTEGER NOT NULL,
+                    input_mtime_ns INTEGER NOT NULL,
+                    input_hash TEXT NOT NULL,
+                    settings_hash TEXT NOT NULL,
+                    output_path TEXT NOT NULL,
+                    PRIMARY KEY (input_path, member)
+                );
+                """
+            )
+
+        # model files are recorded like inputs, so they are only hashed again when they change
+        model_hashes = {}
+        for model_path in sorted(set(model_paths)):
+            if os.path.isfile(model_path):
+                model_entry = self._hash_file(model_path, "")
+                self.record(model_entry, "")
+                model_hashes[model_path] = model_entry.input_hash
+
+        self.settings_hash: str = hashlib.sha256(
+            json.dumps([settings, model_hashes], sort_keys=True).encode()
+        ).hexdigest()
+
+    def __getstate__(self) -> dict:
+        return {"path": self.path, "settings_hash": self.settings_hash}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._pid = os.getpid()
+        self._lock = Lock()
+        self._connection = None
+
+    def _check_process(self) -> None:
+        if self._pid != os.getpid():
+            # inherited through fork, the connection of the parent must not be used here
+            self._pid = os.getpid()
+            self._lock = Lock()
+            self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # the preprocess and postprocess stages use the manifest at the same time
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        return self._connection
+
+    def _get_row(self, input_path: str, member: str) -> tuple | None:
+        self._check_process()
+        with self._lock:
+            return (
+                self._connect()
+                .execute(
+                    "SELECT input_size, input_mtime_ns, input_hash, settings_hash, output_path"
+                    " FROM entries WHERE input_path = ? AND member = ?",
+                    (input_path, member),
+                )
+                .fetchone()
+            )
+
+    def file_entry(self, path: str) -> ManifestEntry:
+        """
+        Returns the entry of the given file. The file is only hashed if its size or
+        modification time differ from the recorded ones.
+        """
+        return self._hash_file(path, self.settings_hash)
+
+    def _hash_file(self, path: str, settings_hash: str) -> ManifestEntry:
+        stat = os.stat(path)
+        row = self._get_row(path, "")
+        if row is not None and (row[0], row[1]) == (stat.st_size, stat.st_mtime_ns):
+            input_hash = row[2]
+        else:
+            input_hash = hash_file(path)
+
+        return ManifestEntry(
+            path, "", input_hash, settings_hash, stat.st_size, stat.st_mtime_ns
+        )
+
+    def member_entry(
+        self, archive_path: str, member: str, crc: int, size: int
+    ) -> ManifestEntry:
+        """
+        Returns the entry of an archive member, hashed by the CRC32 and size stored in the
+        archive, so the member doesn't have to be read.
+        """
+        return ManifestEntry(
+            archive_path, member, f"crc32:{crc:08x}:{size}", self.settings_hash
+        )
+
+    def is_recorded(self, entry: ManifestEntry) -> bool:
+        return self._get_row(entry.input_path, entry.member) is not None
+
+    def get_unchanged_output(self, entry: ManifestEntry) -> str | None:
+        """
+        Returns the recorded output of the entry if neither the input nor the settings
+        changed since it was written.
+        """
+        row = self._get_row(entry.input_path, entry.member)
+        if row is None or (row[2], row[3]) != (entry.input_hash, entry.settings_hash):
+            return None
+        return row[4]
+
+    def record(
+        self,
+        entry: ManifestEntry,
+        output_path: str,
+        members: Iterable[tuple[ManifestEntry, str]] = (),
+    ) -> None:
+        """
+        Records a file and replaces all of its recorded members with the given ones.
+        """
+        self._check_process()
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                "DELETE FROM entries WHERE input_path = ?", (entry.input_path,)
+            )
+            self._insert(connection, entry, output_path)
+            for member_entry, member_output_path in members:
+                self._insert(connection, member_entry, member_output_path)
+
+    @staticmethod
+    def _insert(
+        connection: sqlite3.Connection, entry: ManifestEntry, output_path: str
+    ) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry.input_path,
+                entry.member,
+                entry.input_size,
+                entry.input_mtime_ns,
+                entry.input_hash,
+                entry.settings_hash,
+                output_path,
+            ),
+        )
+
+    def close(self) -> None:
+        self._check_process()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None